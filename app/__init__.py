@@ -1,2 +1,3 @@
+from app import cli
 from app import routes
 from app.app import app
@@ -3,6 +3,7 @@ import logging
 from werkzeug.exceptions import HTTPException
 
 from flask import Flask
+from flask import g
 from flask import request
 from flask_sqlalchemy import SQLAlchemy
 
@@ -62,6 +63,9 @@ def add_cors_and_cache_header(response):
     # no cache on these 5xx errors, they are supposed to be temporary
     if response.status_code in (502, 503, 504, 507):
         response.headers['Cache-Control'] = 'no-cache'
+    if response.status_code == 503 and g.get('wms_backend_overloaded'):
+        # Shortly cached to shed the load while the WMS backend recovers
+        response.headers['Cache-Control'] = settings.ERROR_5XX_DEFAULT_CACHE
     return response
 
 
@@ -0,0 +1,178 @@
+'''Flask CLI commands, e.g. FLASK_APP=service_wmts flask seed --help'''
+import click
+
+from app.app import app
+from app.helpers.coverage import load_geojson_file
+from app.helpers.purge import purge
+from app.helpers.seed import seed
+
+
+@app.cli.command('seed')
+@click.option('--layer', 'layer_id', required=True, help='Layer to seed')
+@click.option('--time', 'time_value', default='current', help='Layer timestamp')
+@click.option('--srid', type=int, default=2056, help='Tile grid srid')
+@click.option('--min-zoom', type=int, default=0)
+@click.option('--max-zoom', type=int, required=True)
+@click.option('--format', 'extension', help='Default to the first format')
+@click.option(
+    '--bbox',
+    type=float,
+    nargs=4,
+    default=None,
+    help='Area to seed: MINX MINY MAXX MAXY in the srid'
+)
+@click.option(
+    '--geojson',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Area to seed: GeoJSON file with coordinates in the srid'
+)
+@click.option('--processes', type=int, default=1, show_default=True)
+@click.option(
+    '--concurrency',
+    type=int,
+    default=4,
+    show_default=True,
+    help='Concurrent renderings per process'
+)
+@click.option(
+    '--rate',
+    type=float,
+    default=0,
+    help='Maximum renderings per second, 0 for no limit'
+)
+@click.option(
+    '--skip-existing',
+    is_flag=True,
+    help='Don\'t render the tiles already on S3'
+)
+@click.option(
+    '--checkpoint',
+    'checkpoint_path',
+    type=click.Path(dir_okay=False),
+    help='Progress file used to resume an interrupted seeding'
+)
+def seed_command(  # pylint: disable=too-many-arguments
+    layer_id,
+    time_value,
+    srid,
+    min_zoom,
+    max_zoom,
+    extension,
+    bbox,
+    geojson,
+    processes,
+    concurrency,
+    rate,
+    skip_existing,
+    checkpoint_path
+):
+    '''Render the tiles of a layer area and write them to the S3 cache'''
+    try:
+        stats = seed(
+            layer_id,
+            time_value,
+            srid, (min_zoom, max_zoom),
+            extension=extension,
+            bbox=list(bbox) if bbox else None,
+            polygons=load_geojson_file(geojson) if geojson else None,
+            processes=processes,
+            concurrency=concurrency,
+            rate=rate,
+            skip_existing=skip_existing,
+            checkpoint_path=checkpoint_path
+        )
+    except ValueError as error:
+        raise click.UsageError(str(error)) from error
+    click.echo(', '.join(f'{name}: {value}' for name, value in stats.items()))
+
+
+@app.cli.command('purge')
+@click.option('--layer', 'layer_id', required=True, help='Layer to purge')
+@click.option(
+    '--time',
+    'times',
+    multiple=True,
+    help='Layer timestamp (repeatable), default to all'
+)
+@click.option(
+    '--srid',
+    'srids',
+    type=int,
+    multiple=True,
+    help='Tile grid srid (repeatable), default to all'
+)
+@click.option(
+    '--format',
+    'extensions',
+    multiple=True,
+    help='Image format (repeatable), default to all'
+)
+@click.option('--min-zoom', type=int, default=0)
+@click.option('--max-zoom', type=int, default=30)
+@click.option(
+    '--bbox',
+    type=float,
+    nargs=4,
+    default=None,
+    help='Area to purge: MINX MINY MAXX MAXY in the geometry srid'
+)
+@click.option(
+    '--geojson',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Area to purge: GeoJSON file with coordinates in the geometry srid'
+)
+@click.option(
+    '--geometry-srid',
+    type=int,
+    default=2056,
+    show_default=True,
+    help='Srid of the bbox and of the GeoJSON coordinates'
+)
+@click.option(
+    '--concurrency',
+    type=int,
+    default=None,
+    help='Parallel S3 DeleteObjects requests'
+)
+@click.option('--dry-run', is_flag=True, help='Only count the tiles to purge')
+@click.option(
+    '--whole-layer',
+    is_flag=True,
+    help='Purge the whole layer (required without bbox and GeoJSON)'
+)
+def purge_command(  # pylint: disable=too-many-arguments
+    layer_id,
+    times,
+    srids,
+    extensions,
+    min_zoom,
+    max_zoom,
+    bbox,
+    geojson,
+    geometry_srid,
+    concurrency,
+    dry_run,
+    whole_layer
+):
+    '''Delete the cached tiles of a layer area from the S3 cache
+
+    NOTE: the tiles in the memory caches of the running service expire after
+    TILE_CACHE_MAX_TTL, use the /admin/purge endpoint to evict them as well.
+    '''
+    try:
+        stats = purge(
+            layer_id,
+            times=list(times),
+            srids=list(srids),
+            extensions=list(extensions),
+            zooms=(min_zoom, max_zoom),
+            bbox=list(bbox) if bbox else None,
+            polygons=load_geojson_file(geojson) if geojson else None,
+            geometry_srid=geometry_srid,
+            concurrency=concurrency,
+            dry_run=dry_run,
+            whole_layer=whole_layer
+        )
+    except ValueError as error:
+        raise click.UsageError(str(error)) from error
+    click.echo(', '.join(f'{name}: {value}' for name, value in stats.items()))
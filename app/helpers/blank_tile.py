@@ -0,0 +1,133 @@
+import io
+import logging
+import threading
+
+from PIL import Image
+
+from app import settings
+from app.helpers.utils import crop_image
+
+logger = logging.getLogger(__name__)
+
+# S3 metadata of the marker objects written instead of the blank tiles, the
+# value is the name of the canonical blank tile (x-amz-meta-blank-tile header)
+BLANK_TILE_METADATA = 'blank-tile'
+BLANK_TILE_S3_HEADER = f'x-amz-meta-{BLANK_TILE_METADATA}'
+
+# A uniform image compresses very well, images with less pixels per byte are
+# not decoded to check if they are uniform
+BLANK_TILE_MIN_PIXELS_PER_BYTE = 16
+
+# Maximum number of distinct canonical blank tiles kept in memory
+BLANK_TILES_MAX_SIZE = 256
+
+# name => content and content => name of the canonical blank tiles
+_BLANK_TILES = {}
+_BLANK_TILE_NAMES = {}
+_LOCK = threading.Lock()
+
+
+def get_blank_tile_name(img, extension):
+    '''Return the name of the canonical blank tile of a uniform image
+
+    A fully transparent image (whatever the color of its pixels) or an image
+    made of a single color is a blank tile.
+
+    Args:
+        img: PIL.Image
+            Decoded tile image
+        extension: str
+            Tile format (png or jpeg)
+
+    Returns:
+        The blank tile name (<extension>-<width>x<height>-<rgba hex color>) or
+        None if the image is not uniform
+    '''
+    bands = img.getbands()
+    extrema = img.getextrema()
+    if len(bands) == 1:
+        extrema = (extrema,)
+    if 'A' in bands and extrema[bands.index('A')] == (0, 0):
+        color = (0, 0, 0, 0)
+    elif all(low == high for low, high in extrema):
+        # the palette (and its transparency) is applied by the conversion
+        color = img.crop((0, 0, 1, 1)).convert('RGBA').getpixel((0, 0))
+        if color[3] == 0:
+            color = (0, 0, 0, 0)
+    else:
+        return None
+    if extension == 'jpeg':
+        color = color[:3] + (255,)
+    return f'{extension}-{img.width}x{img.height}-{bytes(color).hex()}'
+
+
+def find_blank_tile(content, extension, gutter=0):
+    '''Return the name of the canonical blank tile of a tile image
+
+    Only the images small enough to be uniform are decoded.
+
+    Args:
+        content: bytes
+            Tile image, with a gutter
+        extension: str
+            Tile format (png or jpeg)
+        gutter: int
+            Gutter in pixel around the tile
+
+    Returns:
+        The blank tile name or None if the tile is not blank
+    '''
+    with Image.open(io.BytesIO(content)) as img:
+        if len(content) * BLANK_TILE_MIN_PIXELS_PER_BYTE > \
+                img.width * img.height:
+            return None
+        if gutter > 0:
+            img = crop_image(img, gutter)
+        return get_blank_tile_name(img, extension)
+
+
+def get_blank_tile(name):
+    '''Return the content of a canonical blank tile
+
+    The canonical blank tiles are rendered once and shared, the same content
+    (and thus ETag) is returned for all the blank tiles of the same name.
+
+    Args:
+        name: str
+            Blank tile name (see get_blank_tile_name())
+
+    Raises:
+        ValueError if the name is invalid
+    '''
+    content = _BLANK_TILES.get(name)
+    if content is not None:
+        return content
+    extension, size, color = name.split('-')
+    width, height = (int(value) for value in size.split('x'))
+    color = tuple(bytes.fromhex(color))
+    if extension not in ('png', 'jpeg') or len(color) != 4:
+        raise ValueError(f'Invalid blank tile name {name}')
+    out = io.BytesIO()
+    if extension == 'jpeg':
+        Image.new('RGB', (width, height), color[:3]).save(
+            out, format='JPEG', quality=settings.WMS_METATILE_JPEG_QUALITY
+        )
+    else:
+        Image.new('RGBA', (width, height), color).save(out, format='PNG')
+    content = out.getvalue()
+    with _LOCK:
+        if name in _BLANK_TILES:
+            return _BLANK_TILES[name]
+        if len(_BLANK_TILES) < BLANK_TILES_MAX_SIZE:
+            _BLANK_TILES[name] = content
+            _BLANK_TILE_NAMES[content] = name
+        else:
+            logger.warning('Too many blank tiles, %s not shared', name)
+    return content
+
+
+def lookup_blank_tile(content):
+    '''Return the name of a canonical blank tile content, None otherwise'''
+    if not content:
+        return None
+    return _BLANK_TILE_NAMES.get(content)
@@ -0,0 +1,172 @@
+import gzip
+import logging
+import os
+import threading
+import time
+
+from flask import request
+
+from app import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# The documents are rendered with this url base which is replaced by the
+# request url root when served
+URL_BASE_PLACEHOLDER = '@@URL_BASE@@'
+# Maximum number of url base variants of a document kept in memory
+MAX_URL_BASE_VARIANTS = 8
+# Supported content encodings by order of preference
+CONTENT_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+IDENTITY = 'identity'
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(
+            content,
+            mode=brotli.MODE_TEXT,
+            quality=settings.GET_CAP_BROTLI_QUALITY
+        )
+    if encoding == 'gzip':
+        # mtime=0 gives the same compressed document on all workers
+        return gzip.compress(
+            content, compresslevel=settings.GET_CAP_GZIP_LEVEL, mtime=0
+        )
+    return content
+
+
+def get_content_encoding():
+    '''Return the preferred content encoding of the request
+
+    Returns:
+        One of CONTENT_ENCODINGS or IDENTITY
+    '''
+    return request.accept_encodings.best_match(
+        CONTENT_ENCODINGS, default=IDENTITY
+    )
+
+
+class CapabilitiesDocument:
+    '''GetCapabilities document rendered for any url base
+
+    The document is kept as the list of the encoded parts around the url base
+    placeholders, the document of a url base is built and compressed only
+    once per content encoding and memoized.
+    '''
+
+    def __init__(self, text):
+        self.parts = [
+            part.encode('utf-8') for part in text.split(URL_BASE_PLACEHOLDER)
+        ]
+        self._variants = {}
+
+    def render(self, url_base, encoding=IDENTITY):
+        variants = self._variants.get(url_base)
+        if variants is None:
+            if len(self._variants) >= MAX_URL_BASE_VARIANTS:
+                self._variants.clear()
+            variants = {IDENTITY: url_base.encode('utf-8').join(self.parts)}
+            self._variants[url_base] = variants
+        content = variants.get(encoding)
+        if content is None:
+            content = compress(variants[IDENTITY], encoding)
+            variants[encoding] = content
+        return content
+
+
+class CapabilitiesCache:  # pylint: disable=too-many-instance-attributes
+    '''Cache of the pre-rendered GetCapabilities documents
+
+    The documents are keyed by (epsg, lang, staging, is_default_lang,
+    is_default_epsg). The whole cache is replaced at once when the BOD
+    fingerprint changes (see start_refresher()).
+    '''
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.fingerprint = None
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, key):
+        document = self._documents.get(key)
+        if document is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return document
+
+    def set(self, key, document):
+        with self._lock:
+            self._documents[key] = document
+
+    def keys(self):
+        return list(self._documents)
+
+    def replace(self, documents, fingerprint):
+        with self._lock:
+            self._documents = documents
+            self.fingerprint = fingerprint
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+
+    def clear(self):
+        with self._lock:
+            self._documents = {}
+            self.fingerprint = None
+            self.refreshed_at = None
+
+    def stats(self):
+        return {
+            'documents': len(self._documents),
+            'fingerprint': self.fingerprint,
+            'refreshed_at': self.refreshed_at,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+        }
+
+    def start_refresher(self, refresh):
+        '''Start the background refresh in the current worker process
+
+        Args:
+            refresh: callable
+                Function called every GET_CAP_CACHE_REFRESH_INTERVAL seconds,
+                it must re-render the documents when the BOD has changed
+        '''
+        if settings.GET_CAP_CACHE_REFRESH_INTERVAL <= 0 or \
+                self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(
+            target=self._refresh_loop,
+            args=(refresh,),
+            name='capabilities-refresher',
+            daemon=True
+        ).start()
+
+    @staticmethod
+    def _refresh_loop(refresh):
+        while True:
+            time.sleep(settings.GET_CAP_CACHE_REFRESH_INTERVAL)
+            try:
+                refresh()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception(
+                    'Failed to refresh the capabilities cache: %s', error
+                )
+
+
+capabilities_cache = CapabilitiesCache()
@@ -0,0 +1,366 @@
+'''Tile coverage of areas (bbox and polygons) computed in batch with numpy
+
+The tiles are returned as (N, 2) integer arrays of (col, row) in the tile grid
+order, row by row. Use to_path_order() to get them in the order of the
+request path (col and row are swapped for EPSG:21781).
+'''
+import json
+
+import numpy as np
+
+
+def load_geojson_polygons(geojson):
+    '''Return the polygons of a GeoJSON object
+
+    Args:
+        geojson: dict
+            GeoJSON FeatureCollection, Feature or geometry, its coordinates
+            must be in the srid of the tile grid
+
+    Returns:
+        List of polygons, a polygon being a list of rings (list of (x, y))
+    '''
+    if not isinstance(geojson, dict):
+        raise ValueError(f'Invalid GeoJSON object {geojson!r}')
+    geo_type = geojson.get('type')
+    if geo_type == 'FeatureCollection':
+        polygons = []
+        for feature in geojson['features']:
+            polygons.extend(load_geojson_polygons(feature))
+        return polygons
+    if geo_type == 'Feature':
+        return load_geojson_polygons(geojson['geometry'])
+    if geo_type == 'GeometryCollection':
+        polygons = []
+        for geometry in geojson['geometries']:
+            polygons.extend(load_geojson_polygons(geometry))
+        return polygons
+    if geo_type == 'Polygon':
+        return [_to_rings(geojson['coordinates'])]
+    if geo_type == 'MultiPolygon':
+        return [_to_rings(polygon) for polygon in geojson['coordinates']]
+    raise ValueError(f'Unsupported GeoJSON type {geo_type}')
+
+
+def load_geojson_file(path):
+    with open(path, 'r', encoding='utf-8') as fd:
+        return load_geojson_polygons(json.load(fd))
+
+
+def _to_rings(coordinates):
+    return [[(float(point[0]), float(point[1]))
+             for point in ring]
+            for ring in coordinates]
+
+
+def get_polygons_bbox(polygons):
+    xs = [x for polygon in polygons for x, _ in polygon[0]]
+    ys = [y for polygon in polygons for _, y in polygon[0]]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def get_polygons_edges(polygons):
+    '''Return the edges of all the polygons rings
+
+    Returns:
+        (N, 4) float array of [x_1, y_1, x_2, y_2] and (N,) integer array of
+        the index of the polygon of each edge
+    '''
+    edges = []
+    polygon_ids = []
+    for polygon_id, polygon in enumerate(polygons):
+        for ring in polygon:
+            points = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+            if len(points) and (points[0] == points[-1]).all():
+                points = points[:-1]
+            if len(points) < 2:
+                continue
+            edges.append(np.hstack([points, np.roll(points, -1, axis=0)]))
+            polygon_ids.append(np.full(len(points), polygon_id))
+    if not edges:
+        return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+    return np.vstack(edges), np.concatenate(polygon_ids)
+
+
+def get_tile_ranges(grid, zooms, bbox=None):
+    '''Return the tile ranges of the bbox at several zoom levels
+
+    The bbox is clipped to the grid extent and a tile only touching the bbox
+    (on its max edges) is not part of it, unlike gatilegrid
+    getExtentAddress() which isn't consistent about it.
+
+    Args:
+        grid: TileGrid
+            Tile grid (see app.helpers.grids)
+        zooms: list
+            Valid zoom levels of the grid
+        bbox: list
+            [min_x, min_y, max_x, max_y] in the grid srid, default to the grid
+            extent
+
+    Returns:
+        (len(zooms), 4) integer array of [min_col, min_row, max_col, max_row]
+        in the tile grid order, a range is empty when min_col > max_col (the
+        bbox doesn't intersect the grid extent)
+    '''
+    zooms = np.asarray(zooms, dtype=np.int64)
+    extent = np.asarray(grid.extent, dtype=np.float64)
+    bbox = extent if bbox is None else np.asarray(bbox, dtype=np.float64)
+    if not grid.intersectsExtent(bbox):
+        ranges = np.zeros((len(zooms), 4), dtype=np.int64)
+        ranges[:, 0] = 1
+        return ranges
+    bbox = np.clip(bbox, extent[[0, 1, 0, 1]], extent[[2, 3, 2, 3]])
+    tile_sizes = np.asarray(grid.tile_sizes, dtype=np.float64)[zooms, None]
+    cols = (bbox[[0, 2]] - grid.min_x) / tile_sizes
+    if grid.top_left:
+        rows = (grid.max_y - bbox[[3, 1]]) / tile_sizes
+    else:
+        rows = (bbox[[1, 3]] - grid.min_y) / tile_sizes
+    min_cols = np.floor(cols[:, 0])
+    min_rows = np.floor(rows[:, 0])
+    ranges = np.stack([
+        min_cols,
+        min_rows,
+        np.maximum(np.ceil(cols[:, 1]) - 1, min_cols),
+        np.maximum(np.ceil(rows[:, 1]) - 1, min_rows),
+    ],
+                      axis=1).astype(np.int64)
+    # [min_row, min_col, max_row, max_col] of the grid extent per zoom
+    addresses = np.asarray(grid.extent_addresses, dtype=np.int64)[zooms]
+    return np.clip(
+        ranges, addresses[:, [1, 0, 1, 0]], addresses[:, [3, 2, 3, 2]]
+    )
+
+
+def get_tile_range(grid, zoom, bbox):
+    '''Return the tile range of the bbox at zoom (see get_tile_ranges())
+
+    Returns:
+        [min_col, min_row, max_col, max_row] in the tile grid order or None
+        if the bbox doesn't intersect the grid extent
+    '''
+    tile_range = get_tile_ranges(grid, [zoom], bbox)[0].tolist()
+    if tile_range[0] > tile_range[2]:
+        return None
+    return tile_range
+
+
+def _to_tile_units(grid, zoom, edges):
+    # Edges coordinates in tile units, the tile (col, row) covers
+    # [col, col + 1[ x [row, row + 1[
+    tile_size = grid.tile_sizes[zoom]
+    u = (edges[:, [0, 2]] - grid.min_x) / tile_size
+    if grid.top_left:
+        v = (grid.max_y - edges[:, [1, 3]]) / tile_size
+    else:
+        v = (edges[:, [1, 3]] - grid.min_y) / tile_size
+    return u, v
+
+
+def _expand(starts, counts):
+    # Return the (index, value) pairs of the ranges
+    # [starts[index], starts[index] + counts[index][
+    index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(index.size
+                       ) - np.repeat(np.cumsum(counts) - counts, counts)
+    return index, starts[index] + offsets
+
+
+def _mark(mask, tile_range, cols, rows):
+    min_col, min_row, max_col, max_row = tile_range
+    inside = (cols >= min_col) & (cols <= max_col) & \
+        (rows >= min_row) & (rows <= max_row)
+    mask[rows[inside] - min_row, cols[inside] - min_col] = True
+
+
+def _mark_grid_lines(mask, tile_range, u, v):
+    # Mark the tiles on both sides of the crossings of the edges with the
+    # vertical grid lines u = k (called with u and v swapped for the
+    # horizontal ones)
+    min_col, _, max_col, _ = tile_range
+    u_min = u.min(axis=1)
+    u_max = u.max(axis=1)
+    starts = np.maximum(np.ceil(u_min), min_col).astype(np.int64)
+    stops = np.minimum(np.floor(u_max), max_col + 1).astype(np.int64)
+    counts = np.where(u_max > u_min, np.maximum(stops - starts + 1, 0), 0)
+    index, k = _expand(starts, counts)
+    u_1, u_2 = u[index, 0], u[index, 1]
+    v_1, v_2 = v[index, 0], v[index, 1]
+    v_k = v_1 + (k - u_1) * (v_2 - v_1) / (u_2 - u_1)
+    # a crossing on a tile corner touches the tiles of both rows
+    for rows in (np.floor(v_k), np.ceil(v_k) - 1):
+        for cols in (k - 1, k):
+            _mark(mask, tile_range, cols, rows.astype(np.int64))
+
+
+def _row_crossings(u, v, polygon_ids):
+    # Return the (row, u) crossings of the edges with the rows centers
+    # (row + 0.5) sorted by polygon, row and u
+    v_min = v.min(axis=1)
+    v_max = v.max(axis=1)
+    # rows whose center is in [v_min, v_max[
+    starts = np.ceil(v_min - 0.5).astype(np.int64)
+    counts = np.maximum(np.ceil(v_max - 0.5).astype(np.int64) - starts, 0)
+    index, rows = _expand(starts, counts)
+    u_1, u_2 = u[index, 0], u[index, 1]
+    v_1, v_2 = v[index, 0], v[index, 1]
+    u_c = u_1 + (rows + 0.5 - v_1) * (u_2 - u_1) / (v_2 - v_1)
+    order = np.lexsort((u_c, rows, polygon_ids[index]))
+    return rows[order], u_c[order]
+
+
+def _mark_interior(mask, tile_range, u, v, polygon_ids):
+    # Even-odd scanline on the rows centers applied per polygon (its holes
+    # included): the tiles whose center is between two consecutive crossings
+    # of its row by a polygon are inside it. The spans of all the polygons are
+    # then summed, so the overlapping polygons are merged (union).
+    min_col, min_row, max_col, max_row = tile_range
+    rows, u_c = _row_crossings(u, v, polygon_ids)
+    if not rows.size:
+        return
+    # the rings are closed, each polygon row has an even number of crossings
+    rows = rows[::2]
+    # columns whose center (col + 0.5) is in [u_in, u_out[
+    first = np.maximum(np.ceil(u_c[::2] - 0.5), min_col).astype(np.int64)
+    last = np.minimum(np.ceil(u_c[1::2] - 0.5) - 1, max_col).astype(np.int64)
+    keep = (rows >= min_row) & (rows <= max_row) & (first <= last)
+    rows = rows[keep] - min_row
+    # fill the column spans with a cumulated difference array
+    diff = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype=np.int32)
+    np.add.at(diff, (rows, first[keep] - min_col), 1)
+    np.add.at(diff, (rows, last[keep] - min_col + 1), -1)
+    mask |= np.cumsum(diff[:, :-1], axis=1) > 0
+
+
+def get_coverage_mask(grid, zoom, tile_range, polygons):
+    '''Return the tiles of the range intersecting the polygons as a mask
+
+    A tile intersects the polygons when its center is inside one of them
+    (even-odd rule per polygon, its holes are excluded) or when a ring goes
+    through or touches it.
+
+    Returns:
+        Boolean array of shape (rows, cols) of the tile range
+    '''
+    min_col, min_row, max_col, max_row = tile_range
+    mask = np.zeros((max_row - min_row + 1, max_col - min_col + 1), dtype=bool)
+    edges, polygon_ids = get_polygons_edges(polygons)
+    if not edges.size:
+        return mask
+    u, v = _to_tile_units(grid, zoom, edges)
+    _mark(
+        mask,
+        tile_range,
+        np.floor(u[:, 0]).astype(np.int64),
+        np.floor(v[:, 0]).astype(np.int64)
+    )
+    _mark_grid_lines(mask, tile_range, u, v)
+    _mark_grid_lines(mask.T, [min_row, min_col, max_row, max_col], v, u)
+    _mark_interior(mask, tile_range, u, v, polygon_ids)
+    return mask
+
+
+def get_tile_array(grid, zoom, bbox=None, polygons=None):
+    '''Return the tiles at zoom intersecting the bbox and the polygons
+
+    Args:
+        grid: TileGrid
+            Tile grid (see app.helpers.grids)
+        zoom: int
+            Zoom level
+        bbox: list
+            [min_x, min_y, max_x, max_y] in the grid srid, default to the
+            polygons bbox or to the grid extent
+        polygons: list
+            Polygons (see load_geojson_polygons()) in the grid srid
+
+    Returns:
+        (N, 2) integer array of (col, row) in the tile grid order, row by row
+    '''
+    if bbox is None and polygons:
+        bbox = get_polygons_bbox(polygons)
+    tile_range = get_tile_range(grid, zoom, bbox)
+    if tile_range is None:
+        return np.empty((0, 2), dtype=np.int64)
+    return _get_range_tiles(grid, zoom, tile_range, polygons)
+
+
+def _get_range_tiles(grid, zoom, tile_range, polygons):
+    min_col, min_row, max_col, max_row = tile_range
+    if polygons:
+        rows, cols = np.nonzero(
+            get_coverage_mask(grid, zoom, tile_range, polygons)
+        )
+        return np.stack([cols + min_col, rows + min_row], axis=1)
+    cols, rows = np.meshgrid(
+        np.arange(min_col, max_col + 1), np.arange(min_row, max_row + 1)
+    )
+    return np.stack([cols.ravel(), rows.ravel()], axis=1)
+
+
+def iter_tile_blocks(grid, zoom, size, bbox=None, polygons=None):
+    '''Yield the tiles of get_tile_array() by blocks of at most size tiles
+
+    The tile range is split in bands of rows (and of columns when a row has
+    more than size tiles), so that the tiles of a large area are never all in
+    memory. The tiles are in the tile grid order within each block only.
+    '''
+    if bbox is None and polygons:
+        bbox = get_polygons_bbox(polygons)
+    tile_range = get_tile_range(grid, zoom, bbox)
+    if tile_range is None:
+        return
+    min_col, min_row, max_col, max_row = tile_range
+    cols = min(max_col - min_col + 1, size)
+    rows = max(size // cols, 1)
+    for row in range(min_row, max_row + 1, rows):
+        for col in range(min_col, max_col + 1, cols):
+            block = [
+                col,
+                row,
+                min(col + cols - 1, max_col),
+                min(row + rows - 1, max_row),
+            ]
+            tiles = _get_range_tiles(grid, zoom, block, polygons)
+            if len(tiles):
+                yield tiles
+
+
+def get_tiles(grid, zoom, bbox=None, polygons=None):
+    '''Return the tiles of get_tile_array() as a list of (col, row)'''
+    tiles = get_tile_array(grid, zoom, bbox, polygons)
+    return [tuple(tile) for tile in tiles.tolist()]
+
+
+def iter_tile_arrays(grid, zooms, bbox=None, polygons=None):
+    '''Yield (zoom, tiles) for each zoom level (see get_tile_array())'''
+    for zoom in zooms:
+        yield zoom, get_tile_array(grid, zoom, bbox, polygons)
+
+
+def count_tiles(grid, zooms, bbox=None, polygons=None):
+    '''Return the number of tiles intersecting the area per zoom level
+
+    Without polygons the counts are computed from the tile ranges only.
+    '''
+    if polygons:
+        return {
+            zoom: len(tiles)
+            for zoom, tiles in iter_tile_arrays(grid, zooms, bbox, polygons)
+        }
+    ranges = get_tile_ranges(grid, zooms, bbox)
+    counts = np.maximum(ranges[:, 2] - ranges[:, 0] + 1, 0) * \
+        np.maximum(ranges[:, 3] - ranges[:, 1] + 1, 0)
+    return dict(zip(zooms, counts.tolist()))
+
+
+def to_path_order(srid, tiles):
+    '''Return the tiles in the order of the request path
+
+    NOTE: for EPSG:21781 the col and row are swapped in the request path (see
+    app.helpers.wmts.get_tile_address()).
+    '''
+    if srid == 21781:
+        return tiles[:, ::-1]
+    return tiles
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app import settings
+from app.helpers.layer_purges import get_tile_purge_time
+
+logger = logging.getLogger(__name__)
+
+
+class EtagIndex:  # pylint: disable=too-many-instance-attributes
+    '''In process LRU index of the tile ETags bounded by a number of entries
+
+    Only the ETag and the Cache-Control of a tile are kept (a few hundred
+    bytes per tile), so the index covers many more tiles than the memory tile
+    cache and answers the conditional requests of the tiles evicted from it.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.purged = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key, purged=0.0):
+        '''Return the indexed (etag, cache_control) or None
+
+        The entry indexed before the purged time (unix timestamp) is dropped.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, etag, cache_control, indexed = entry
+            if expires <= now or indexed <= purged:
+                del self._entries[key]
+                if expires <= now:
+                    self.expirations += 1
+                else:
+                    self.purged += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return etag, cache_control
+
+    def set(self, key, etag, cache_control, ttl):
+        if not self.enabled or ttl <= 0 or not etag:
+            return False
+        expires = time.monotonic() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (expires, etag, cache_control, time.time())
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'purged': self.purged,
+        }
+
+
+etag_index = EtagIndex(settings.ETAG_INDEX_MAX_ENTRIES)
+
+
+def etag_matches(if_none_match, etag):
+    '''Return True if the If-None-Match header value matches the ETag
+
+    The header can list several ETags, weak ETags are compared weakly.
+    '''
+    if not if_none_match or not etag:
+        return False
+    etag = etag.removeprefix('W/')
+    return any(
+        value.strip().removeprefix('W/') in (etag, '*')
+        for value in if_none_match.split(',')
+    )
+
+
+def index_tile_etag(wmts_path, headers, ttl):
+    '''Put the ETag of a tile in the index
+
+    Args:
+        wmts_path: str
+            Path of the tile (without leading '/')
+        headers: dict
+            Tile headers, the ETag and Cache-Control are kept
+        ttl: int
+            Time to live in seconds of the entry
+    '''
+    if not etag_index.enabled:
+        return
+    etag = None
+    cache_control = None
+    for name, value in headers.items():
+        # S3 and the WMS don't use the same header names case (ETag/Etag)
+        if name.lower() == 'etag':
+            etag = value
+        elif name.lower() == 'cache-control':
+            cache_control = value
+    if etag_index.set(wmts_path, etag, cache_control, ttl):
+        logger.debug('Tile %s ETag %s indexed', wmts_path, etag)
+
+
+def prepare_etag_index_response(wmts_path, if_none_match):
+    '''Return the headers of a 304 response if the tile ETag is indexed
+
+    Returns:
+        The 304 response headers or None if the ETag is not indexed or
+        doesn't match
+    '''
+    if not if_none_match or not etag_index.enabled:
+        return None
+    indexed = etag_index.get(wmts_path, get_tile_purge_time(wmts_path))
+    if indexed is None or not etag_matches(if_none_match, indexed[0]):
+        return None
+    etag, cache_control = indexed
+    headers = {'ETag': etag, 'X-Tiles-ETag-Index': 'hit'}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    return headers
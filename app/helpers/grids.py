@@ -0,0 +1,100 @@
+from gatilegrid import getTileGrid
+
+SUPPORTED_SRIDS = (21781, 2056, 3857, 4326)
+
+
+class TileGrid:  # pylint: disable=too-many-instance-attributes,invalid-name
+    '''gatilegrid tile grid with precomputed per zoom tables
+
+    The methods used on each tile request are table lookups and plain
+    arithmetic, any other attribute is the one of the wrapped gatilegrid tile
+    grid.
+
+    NOTE: the zoom level must be validated with is_valid_zoom() before
+    calling the methods below, they don't check it.
+    '''
+
+    def __init__(self, gagrid):
+        self._gagrid = gagrid
+        self.srid = gagrid.spatialReference
+        self.RESOLUTIONS = tuple(gagrid.RESOLUTIONS)
+        self.tileSizePx = gagrid.tileSizePx
+        self.extent = tuple(gagrid.extent)
+        self.origin = tuple(gagrid.origin)
+        self.top_left = gagrid.originCorner == 'top-left'
+        self.min_x = gagrid.MINX
+        self.min_y = gagrid.MINY
+        self.max_y = gagrid.MAXY
+        zooms = range(len(self.RESOLUTIONS))
+        self.tile_sizes = tuple(gagrid.tileSize(zoom) for zoom in zooms)
+        self.resolutions = tuple(gagrid.getResolution(zoom) for zoom in zooms)
+        self.scales = tuple(gagrid.getScale(zoom) for zoom in zooms)
+        self.extent_addresses = tuple(
+            tuple(gagrid.getExtentAddress(zoom)) for zoom in zooms
+        )
+        # (matrix width, matrix height)
+        self.matrix_sizes = tuple(
+            (max_col - min_col + 1, max_row - min_row + 1)
+            for min_row, min_col, max_row, max_col in self.extent_addresses
+        )
+        self._closest_zooms = {}
+
+    def __getattr__(self, name):
+        return getattr(self._gagrid, name)
+
+    def is_valid_zoom(self, zoom):
+        return 0 <= zoom < len(self.RESOLUTIONS)
+
+    def tileBounds(self, zoom, tileCol, tileRow):
+        '''Return the bounds of a tile (see gatilegrid tileBounds())'''
+        tile_size = self.tile_sizes[zoom]
+        min_x = self.min_x + tileCol * tile_size
+        max_x = self.min_x + (tileCol + 1) * tile_size
+        if self.top_left:
+            return [
+                min_x,
+                self.max_y - (tileRow + 1) * tile_size,
+                max_x,
+                self.max_y - tileRow * tile_size
+            ]
+        return [
+            min_x,
+            self.min_y + tileRow * tile_size,
+            max_x,
+            self.min_y + (tileRow + 1) * tile_size
+        ]
+
+    def intersectsExtent(self, extent):
+        return (
+            self.extent[0] <= extent[2] and self.extent[2] >= extent[0] and
+            self.extent[1] <= extent[3] and self.extent[3] >= extent[1]
+        )
+
+    def getResolution(self, zoom):
+        return self.resolutions[zoom]
+
+    def getScale(self, zoom):
+        return self.scales[zoom]
+
+    def getExtentAddress(self, zoom, extent=None, contained=False):
+        '''Return [minRow, minCol, maxRow, maxCol] of the extent at zoom'''
+        if extent is None and not contained:
+            return list(self.extent_addresses[zoom])
+        return self._gagrid.getExtentAddress(zoom, extent, contained)
+
+    def getClosestZoom(self, resolution, unit='meters'):
+        key = (resolution, unit)
+        zoom = self._closest_zooms.get(key)
+        if zoom is None:
+            zoom = self._gagrid.getClosestZoom(resolution, unit)
+            self._closest_zooms[key] = zoom
+        return zoom
+
+
+# The tile grids are built once at import time and shared by all requests
+TILE_GRIDS = {srid: TileGrid(getTileGrid(srid)()) for srid in SUPPORTED_SRIDS}
+
+
+def get_tile_grid(srid):
+    '''Return the tile grid of the srid or None if not supported'''
+    return TILE_GRIDS.get(srid)
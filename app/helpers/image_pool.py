@@ -0,0 +1,110 @@
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gevent import monkey
+from gevent.threadpool import ThreadPool
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+# Hashing smaller contents inline is cheaper than a thread switch
+HASH_OFFLOAD_MIN_BYTES = 65536
+
+
+class ImagePool:  # pylint: disable=too-many-instance-attributes
+    '''Pool of native threads for the CPU bound image work
+
+    With gevent, the image decoding, cropping, encoding and hashing done
+    inline block the event loop and thus all the other requests of the
+    worker (e.g. the S3 hits) for their whole duration. Those tasks are run
+    in native threads instead while the calling greenlet waits
+    cooperatively; PIL and hashlib release the GIL during the heavy work.
+
+    At most size tasks run at once and max_queue tasks wait for a thread,
+    further callers wait for a queue slot. The pool is started lazily in each
+    worker process and the tasks run in a copy of the caller context (Flask
+    request context, tracing).
+    '''
+
+    def __init__(self, size, max_queue):
+        self.size = size
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(size + max_queue)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self.pending = 0
+        self.tasks = 0
+        self.waited = 0
+
+    def run(self, func, *args, **kwargs):
+        '''Run func(*args, **kwargs) in the pool and return its result
+
+        The function is run inline when the pool is disabled (size 0).
+        '''
+        if self.size <= 0:
+            return func(*args, **kwargs)
+        submit = self._get_pool()
+        if self.pending >= self.size + self.max_queue:
+            self.waited += 1
+        with self._slots:
+            self.pending += 1
+            self.tasks += 1
+            try:
+                return submit(
+                    contextvars.copy_context().run, func, *args, **kwargs
+                )
+            finally:
+                self.pending -= 1
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'tasks': self.tasks,
+            'waited': self.waited,
+        }
+
+    def _get_pool(self):
+        # The threads must be started in the worker process, after the fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = self._create_pool()
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _create_pool(self):
+        if monkey.is_module_patched('threading'):
+            # gevent threads are greenlets, a gevent thread pool runs the
+            # tasks in native threads and wakes the waiting greenlet up
+            pool = ThreadPool(self.size)
+            logger.debug('Image gevent thread pool of %d started', self.size)
+            return lambda func, *args, **kwargs: pool.spawn(
+                func, *args, **kwargs
+            ).get()
+        executor = ThreadPoolExecutor(self.size, thread_name_prefix='image')
+        logger.debug('Image thread pool of %d started', self.size)
+        return lambda func, *args, **kwargs: executor.submit(
+            func, *args, **kwargs
+        ).result()
+
+
+image_pool = ImagePool(settings.IMAGE_POOL_SIZE, settings.IMAGE_POOL_MAX_QUEUE)
+
+
+def run_in_image_pool(func, *args, **kwargs):
+    '''Run a CPU bound image function in the image pool (see ImagePool)'''
+    return image_pool.run(func, *args, **kwargs)
+
+
+def hash_in_image_pool(func, content):
+    '''Return func(content), in the image pool if content is big enough'''
+    if len(content) < HASH_OFFLOAD_MIN_BYTES:
+        return func(content)
+    return image_pool.run(func, content)
@@ -0,0 +1,56 @@
+import hashlib
+import mmap
+import struct
+import time
+
+# Purge time (unix timestamp) of the layers hashed to a slot
+PURGE_MARK = struct.Struct('d')
+PURGE_MARK_SLOTS = 4096
+
+
+class LayerPurges:
+    '''Time of the latest purge of the layers, shared by the workers of a node
+
+    The purge times live in an anonymous shared memory map created on import,
+    i.e. before the workers are forked, so that a purge run by a worker
+    invalidates the tiles cached in memory by the other workers. A layer is
+    hashed to one of the slots, the layers sharing a slot are invalidated
+    together.
+    '''
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._mmap = mmap.mmap(-1, slots * PURGE_MARK.size)
+
+    def mark(self, layer_id):
+        '''Record that the layer has been purged now'''
+        PURGE_MARK.pack_into(self._mmap, self._offset(layer_id), time.time())
+
+    def get(self, layer_id):
+        '''Return the time of the latest purge of the layer or 0'''
+        return PURGE_MARK.unpack_from(self._mmap, self._offset(layer_id))[0]
+
+    def clear(self):
+        self._mmap[:] = bytes(len(self._mmap))
+
+    def _offset(self, layer_id):
+        digest = hashlib.blake2b(layer_id.encode('utf-8'), digest_size=8)
+        slot = int.from_bytes(digest.digest(), 'little') % self.slots
+        return slot * PURGE_MARK.size
+
+
+layer_purges = LayerPurges(PURGE_MARK_SLOTS)
+
+
+def get_tile_purge_time(wmts_path):
+    '''Return the time of the latest purge of the layer of a tile path
+
+    Args:
+        wmts_path: str
+            Path of the tile (without leading '/'), e.g.
+            1.0.0/{layer_id}/default/{time}/{srid}/{zoom}/{col}/{row}.{ext}
+    '''
+    parts = wmts_path.split('/', 2)
+    if len(parts) < 3:
+        return 0.0
+    return layer_purges.get(parts[1])
@@ -0,0 +1,117 @@
+import io
+import json
+import zlib
+
+from PIL import Image
+
+# zlib strategies of the PNG image data compression
+PNG_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman_only': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+
+def parse_png_profile(value):
+    '''Parse and validate a layer PNG encoding profile (BOD png_profile)
+
+    The profile is a JSON object with the optional keys:
+
+        colors: int
+            Quantize the tile to a palette (PNG8) of at most colors (2-256)
+        dither: bool
+            Dither the quantized tile, default to false
+        compress_level: int
+            zlib compression level (0-9)
+        strategy: str
+            zlib compression strategy (see PNG_STRATEGIES)
+        optimize: bool
+            Lossless re-optimization of the compression (slower)
+
+    Args:
+        value: dict | str | None
+            Profile as returned by the DB (json or text column)
+
+    Returns:
+        The profile dict or None if no profile is set
+
+    Raises:
+        ValueError if the profile is invalid
+    '''
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not isinstance(value, dict):
+        raise ValueError(f'PNG profile must be an object: {value}')
+    unknown = value.keys() - {
+        'colors', 'dither', 'compress_level', 'strategy', 'optimize'
+    }
+    if unknown:
+        raise ValueError(f'Unknown PNG profile keys {sorted(unknown)}')
+    profile = {
+        'colors': value.get('colors'),
+        'dither': bool(value.get('dither', False)),
+        'compress_level': value.get('compress_level'),
+        'strategy': value.get('strategy', 'default'),
+        'optimize': bool(value.get('optimize', False)),
+    }
+    if profile['colors'] is not None and (
+        not isinstance(profile['colors'], int) or
+        not 2 <= profile['colors'] <= 256
+    ):
+        raise ValueError(f'Invalid PNG profile colors {profile["colors"]}')
+    if profile['compress_level'] is not None and (
+        not isinstance(profile['compress_level'], int) or
+        not 0 <= profile['compress_level'] <= 9
+    ):
+        raise ValueError(
+            f'Invalid PNG profile compress_level {profile["compress_level"]}'
+        )
+    if profile['strategy'] not in PNG_STRATEGIES:
+        raise ValueError(f'Invalid PNG profile strategy {profile["strategy"]}')
+    return profile
+
+
+def get_png_save_options(profile):
+    '''Return the PIL save options of a PNG profile'''
+    options = {'format': 'PNG'}
+    if not profile:
+        return options
+    if profile['compress_level'] is not None:
+        options['compress_level'] = profile['compress_level']
+    options['compress_type'] = PNG_STRATEGIES[profile['strategy']]
+    if profile['optimize']:
+        options['optimize'] = True
+    return options
+
+
+def encode_png(img, profile):
+    '''Encode an image in PNG with a layer PNG profile
+
+    Args:
+        img: PIL.Image
+            Tile image
+        profile: dict | None
+            PNG profile (see parse_png_profile()), PIL defaults without
+            profile
+
+    Returns:
+        The PNG content
+    '''
+    if profile and profile['colors'] and img.mode != 'P':
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        # The fast octree is the only built-in method supporting the alpha
+        # channel, it is exact when the tile has at most colors colors
+        img = img.quantize(
+            profile['colors'],
+            method=Image.Quantize.FASTOCTREE,
+            dither=Image.Dither.FLOYDSTEINBERG
+            if profile['dither'] else Image.Dither.NONE
+        )
+    out = io.BytesIO()
+    img.save(out, **get_png_save_options(profile))
+    return out.getvalue()
@@ -0,0 +1,408 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from itertools import islice
+
+import numpy as np
+import pyproj
+
+from app import settings
+from app.helpers.coverage import count_tiles
+from app.helpers.coverage import get_polygons_bbox
+from app.helpers.coverage import iter_tile_blocks
+from app.helpers.coverage import to_path_order
+from app.helpers.grids import SUPPORTED_SRIDS
+from app.helpers.grids import get_tile_grid
+from app.helpers.layer_purges import layer_purges
+from app.helpers.s3 import S3_DELETE_MAX_KEYS
+from app.helpers.s3 import delete_s3_files
+from app.helpers.s3_write_queue import s3_write_queue
+from app.helpers.seed import get_seed_zooms
+from app.helpers.tile_cache import evict_cached_tile
+from app.helpers.variants import get_variant_formats
+from app.helpers.wmts_config import get_wmts_config_by_layer
+
+logger = logging.getLogger(__name__)
+
+# Number of finished purge jobs kept for their status
+PURGE_JOBS_HISTORY = 100
+
+# Points added along each edge of the reprojected areas, the edges being
+# curved in the other tile grids
+DENSIFY_PTS = 21
+
+
+def get_transformer(from_srid, to_srid):
+    return pyproj.Transformer.from_crs(
+        f'EPSG:{from_srid}', f'EPSG:{to_srid}', always_xy=True
+    )
+
+
+def transform_bbox(bbox, from_srid, to_srid):
+    '''Return the bbox of the bbox reprojected to to_srid'''
+    if from_srid == to_srid:
+        return bbox
+    return list(
+        get_transformer(from_srid, to_srid
+                       ).transform_bounds(*bbox, densify_pts=DENSIFY_PTS)
+    )
+
+
+def densify_ring(ring, densify_pts=DENSIFY_PTS):
+    '''Return the closed ring with densify_pts points added along each edge'''
+    points = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+    if len(points) and (points[0] == points[-1]).all():
+        points = points[:-1]
+    if len(points) < 2:
+        return points
+    starts = points[:, np.newaxis, :]
+    ends = np.roll(points, -1, axis=0)[:, np.newaxis, :]
+    steps = (np.arange(densify_pts + 1) / (densify_pts + 1))[:, np.newaxis]
+    dense = (starts + (ends - starts) * steps).reshape(-1, 2)
+    return np.vstack([dense, dense[:1]])
+
+
+def transform_polygons(polygons, from_srid, to_srid):
+    '''Return the polygons densified and reprojected to to_srid'''
+    if from_srid == to_srid:
+        return polygons
+    transformer = get_transformer(from_srid, to_srid)
+    transformed = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            points = densify_ring(ring)
+            xs, ys = transformer.transform(points[:, 0], points[:, 1])
+            rings.append(list(zip(xs.tolist(), ys.tolist())))
+        transformed.append(rings)
+    return transformed
+
+
+def _get_srid_areas(srids, bbox, polygons, geometry_srid):
+    # Yield (srid, grid, bbox, polygons) of the area reprojected to each grid
+    for srid in srids:
+        yield (
+            srid,
+            get_tile_grid(srid),
+            transform_bbox(bbox, geometry_srid, srid) if bbox else None,
+            transform_polygons(polygons, geometry_srid, srid)
+            if polygons else None
+        )
+
+
+def get_purge_keys(  # pylint: disable=too-many-arguments
+    layer_id,
+    restriction,
+    times,
+    srids,
+    extensions,
+    zooms,
+    bbox=None,
+    polygons=None,
+    geometry_srid=2056
+):
+    '''Yield the S3 keys of the tiles of a layer intersecting an area
+
+    Only the zoom levels cached on S3 are considered. The area (bbox and/or
+    polygons) is given in geometry_srid and reprojected to each tile grid.
+    The tiles are enumerated by blocks of S3_DELETE_MAX_KEYS tiles.
+    '''
+    for srid, grid, srid_bbox, srid_polygons in _get_srid_areas(
+        srids, bbox, polygons, geometry_srid
+    ):
+        for zoom in get_seed_zooms(grid, restriction, *zooms):
+            for tiles in iter_tile_blocks(
+                grid, zoom, S3_DELETE_MAX_KEYS, srid_bbox, srid_polygons
+            ):
+                tiles = to_path_order(srid, tiles).tolist()
+                for time_value in times:
+                    prefix = f'1.0.0/{layer_id}/default/{time_value}/' \
+                        f'{srid}/{zoom}'
+                    yield from _get_tile_keys(prefix, tiles, extensions)
+
+
+def _get_tile_keys(prefix, tiles, extensions):
+    for extension in extensions:
+        for col, row in tiles:
+            yield f'{prefix}/{col}/{row}.{extension}'
+
+
+def count_max_purge_keys(  # pylint: disable=too-many-arguments
+    restriction,
+    times,
+    srids,
+    extensions,
+    zooms,
+    bbox=None,
+    polygons=None,
+    geometry_srid=2056
+):
+    '''Return an upper bound of the number of keys of get_purge_keys()
+
+    It is computed from the tile ranges of the area bbox (the polygons bbox),
+    without enumerating the tiles.
+    '''
+    tiles = 0
+    for _, grid, srid_bbox, srid_polygons in _get_srid_areas(
+        srids, bbox, polygons, geometry_srid
+    ):
+        if srid_bbox is None and srid_polygons:
+            srid_bbox = get_polygons_bbox(srid_polygons)
+        zoom_levels = get_seed_zooms(grid, restriction, *zooms)
+        if zoom_levels:
+            tiles += sum(count_tiles(grid, zoom_levels, srid_bbox).values())
+    return tiles * len(times) * len(extensions)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _evict(keys):
+    evicted = 0
+    dequeued = 0
+    for key in keys:
+        evicted += evict_cached_tile(key)
+        dequeued += s3_write_queue.discard(key)
+    return evicted, dequeued
+
+
+def prepare_purge(  # pylint: disable=too-many-arguments
+    layer_id,
+    times=None,
+    srids=None,
+    extensions=None,
+    zooms=None,
+    bbox=None,
+    polygons=None,
+    geometry_srid=2056,
+    whole_layer=False,
+    max_keys=None
+):
+    '''Validate a purge and return the generator of its S3 keys
+
+    Args:
+        layer_id: str
+            Layer to purge
+        times: list
+            Layer timestamps, default to all the layer timestamps
+        srids: list
+            Tile grids srid, default to all the supported srids
+        extensions: list
+            Image formats, default to all the layer formats and the tile
+            variant formats
+        zooms: tuple
+            (min_zoom, max_zoom), default to all the zoom levels
+        bbox: list
+            Area to purge [min_x, min_y, max_x, max_y] in geometry_srid
+        polygons: list
+            Area to purge (see app.helpers.coverage.load_geojson_polygons())
+            in geometry_srid
+        geometry_srid: int
+            Srid of the bbox and polygons
+        whole_layer: bool
+            Must be set to purge the whole layer (without bbox and polygons)
+        max_keys: int
+            Maximum number of keys of the purge (estimated from the area
+            bbox), default to unbounded
+
+    Raises:
+        ValueError if the purge is invalid
+    '''
+    restriction = get_wmts_config_by_layer(layer_id)
+    if restriction is None:
+        raise ValueError(f'Unknown layer {layer_id}')
+    if not bbox and not polygons and not whole_layer:
+        raise ValueError('A bbox or a geometry is required to purge an area')
+    srids = srids or SUPPORTED_SRIDS
+    for srid in list(srids) + [geometry_srid]:
+        if get_tile_grid(srid) is None:
+            raise ValueError(f'Unsupported srid {srid}')
+    args = (
+        times or restriction['timestamps'],
+        srids,
+        extensions or
+        list(restriction['formats']) + list(get_variant_formats()),
+        zooms or (0, 30),
+    )
+    kwargs = {
+        'bbox': bbox, 'polygons': polygons, 'geometry_srid': geometry_srid
+    }
+    if max_keys:
+        max_purge_keys = count_max_purge_keys(restriction, *args, **kwargs)
+        if max_purge_keys > max_keys:
+            raise ValueError(
+                f'Too many tiles to purge: up to {max_purge_keys} keys, '
+                f'the maximum is {max_keys}'
+            )
+    return get_purge_keys(layer_id, restriction, *args, **kwargs)
+
+
+def purge_keys(layer_id, keys, concurrency=None, dry_run=False):
+    '''Delete the tiles of a purge (see prepare_purge())
+
+    The tiles are deleted on S3 with batched DeleteObjects requests run in
+    parallel, and evicted from the memory caches of the current process
+    (including the shared memory cache) and from its S3 write queue. The
+    layer is then marked as purged, so that the other workers of the node
+    drop the tiles of the layer from their memory caches.
+
+    Args:
+        layer_id: str
+            Purged layer
+        keys: iterable
+            S3 keys of the tiles to purge
+        concurrency: int
+            Number of parallel DeleteObjects requests, default to
+            PURGE_CONCURRENCY
+        dry_run: bool
+            Only count the tiles to purge
+
+    Returns:
+        dict with the number of keys, of deleted keys, of errors, of tiles
+        evicted from the memory caches and removed from the S3 write queue
+    '''
+    stats = {'keys': 0, 'deleted': 0, 'errors': 0, 'evicted': 0, 'dequeued': 0}
+    started = time.monotonic()
+    concurrency = concurrency or settings.PURGE_CONCURRENCY
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = set()
+        for batch in _batches(keys, S3_DELETE_MAX_KEYS):
+            stats['keys'] += len(batch)
+            # let the other greenlets run between the batches
+            time.sleep(0)
+            if dry_run:
+                continue
+            evicted, dequeued = _evict(batch)
+            stats['evicted'] += evicted
+            stats['dequeued'] += dequeued
+            # bound the number of batches kept in memory
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _count_deleted(stats, done)
+            pending.add(executor.submit(_delete, batch))
+        _count_deleted(stats, wait(pending).done)
+    if not dry_run:
+        # The other workers of the node drop their cached tiles of the layer
+        layer_purges.mark(layer_id)
+    logger.info(
+        'Purge of layer %s done in %.1fs: %s',
+        layer_id,
+        time.monotonic() - started,
+        stats
+    )
+    return stats
+
+
+def purge(layer_id, concurrency=None, dry_run=False, **kwargs):
+    '''Delete the cached tiles of a layer intersecting an area
+
+    See prepare_purge() for the purge arguments and purge_keys() for the
+    returned stats.
+    '''
+    return purge_keys(
+        layer_id,
+        prepare_purge(layer_id, **kwargs),
+        concurrency=concurrency,
+        dry_run=dry_run
+    )
+
+
+class PurgeJobs:
+    '''Purges run in the background (in greenlets with gevent)
+
+    The jobs are kept in the memory of the worker running them, the latest
+    max_jobs finished jobs are kept for their status.
+    '''
+
+    def __init__(self, max_running, max_jobs):
+        self.max_running = max_running
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, layer_id, keys, dry_run=False):
+        '''Start a purge of the keys (see purge_keys())
+
+        Returns:
+            The job id or None if too many purges are running
+        '''
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if self._running() >= self.max_running:
+                return None
+            self._jobs[job_id] = {
+                'id': job_id,
+                'layer': layer_id,
+                'dry_run': dry_run,
+                'status': 'running',
+                'stats': None,
+            }
+            finished = [
+                key for key, job in self._jobs.items()
+                if job['status'] != 'running'
+            ]
+            for key in finished[:max(len(self._jobs) - self.max_jobs, 0)]:
+                del self._jobs[key]
+        threading.Thread(
+            target=self._run,
+            args=(job_id, layer_id, keys, dry_run),
+            name='tile-purge',
+            daemon=True
+        ).start()
+        return job_id
+
+    def get(self, job_id):
+        '''Return a copy of the job status or None if unknown'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._running(), 'jobs': len(self._jobs)}
+
+    def _running(self):
+        return sum(job['status'] == 'running' for job in self._jobs.values())
+
+    def _run(self, job_id, layer_id, keys, dry_run):
+        try:
+            stats = purge_keys(layer_id, keys, dry_run=dry_run)
+            status = 'done'
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception('Purge job %s failed: %s', job_id, error)
+            stats = None
+            status = 'failed'
+        with self._lock:
+            self._jobs[job_id].update(status=status, stats=stats)
+
+
+purge_jobs = PurgeJobs(settings.PURGE_MAX_RUNNING_JOBS, PURGE_JOBS_HISTORY)
+
+
+def _delete(batch):
+    try:
+        errors = len(delete_s3_files(batch))
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception(
+            'Failed to delete %d files on S3: %s', len(batch), error
+        )
+        errors = len(batch)
+    return len(batch) - errors, errors
+
+
+def _count_deleted(stats, futures):
+    for future in futures:
+        deleted, errors = future.result()
+        stats['deleted'] += deleted
+        stats['errors'] += errors
@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import importlib
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+RENDER_LEASE_BACKEND = None
+
+# Number of lock files of the file lease backend
+LEASE_LOCK_STRIPES = 64
+# Time [seconds] after which a lease lock is given up and its poll interval
+LEASE_LOCK_TIMEOUT = 0.1
+LEASE_LOCK_RETRY_INTERVAL = 0.001
+
+
+class LocalLeaseBackend:
+    '''Render lease backend local to the worker process
+
+    This is a stand-in of a distributed backend, e.g. for development and
+    tests, it doesn't coordinate anything between the workers.
+    '''
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease[0] > now:
+                return None
+            token = uuid.uuid4().hex
+            self._leases[key] = (now + ttl, token)
+            return token
+
+    def release(self, key, token):
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease[1] == token:
+                del self._leases[key]
+
+    def held(self, key):
+        lease = self._leases.get(key)
+        return lease is not None and lease[0] > time.time()
+
+
+class FileLeaseBackend:
+    '''Render lease backend based on lease files
+
+    A lease is a file in a directory shared by all the workers of a node (e.g.
+    in /dev/shm) containing its expiration timestamp and its owner token. The
+    leases are acquired (or taken over once expired) and released under an
+    exclusive flock of one of LEASE_LOCK_STRIPES lock files, released by the
+    kernel if the worker dies, and written atomically with a rename. The lock
+    is polled without blocking the process (and its greenlets); when it can't
+    be acquired within LEASE_LOCK_TIMEOUT the lease is not acquired (or not
+    released, it expires).
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory or settings.RENDER_LEASE_DIRECTORY
+        os.makedirs(self.directory, exist_ok=True)
+
+    def acquire(self, key, ttl):
+        path = self._path(key)
+        token = uuid.uuid4().hex
+        with self._locked(key) as locked:
+            if not locked:
+                return None
+            lease = self._read(path)
+            if lease is not None and lease[0] > time.time():
+                return None
+            if lease is not None:
+                logger.debug('Taking over expired render lease %s', key)
+            tmp_path = f'{path}.{token}.tmp'
+            with open(tmp_path, 'w', encoding='ascii') as fd:
+                fd.write(f'{time.time() + ttl} {token}')
+            os.replace(tmp_path, path)
+        return token
+
+    def release(self, key, token):
+        path = self._path(key)
+        with self._locked(key) as locked:
+            if not locked:
+                logger.error('Cannot release the render lease %s', key)
+                return
+            lease = self._read(path)
+            if lease is not None and lease[1] == token:
+                self._remove(path)
+
+    def held(self, key):
+        lease = self._read(self._path(key))
+        return lease is not None and lease[0] > time.time()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{self._digest(key)}.lease')
+
+    @contextmanager
+    def _locked(self, key):
+        stripe = int(self._digest(key), 16) % LEASE_LOCK_STRIPES
+        fd = os.open(
+            os.path.join(self.directory, f'{stripe}.lock'),
+            os.O_CREAT | os.O_RDWR,
+            0o644
+        )
+        try:
+            yield self._lock(fd, stripe)
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+    @staticmethod
+    def _lock(fd, stripe):
+        '''Return True once the lock file is locked or False on timeout'''
+        deadline = time.monotonic() + LEASE_LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    logger.warning('Render lease lock %d timed out', stripe)
+                    return False
+                time.sleep(LEASE_LOCK_RETRY_INTERVAL)
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r', encoding='ascii') as fd:
+                expires, token = fd.read().split(' ', 1)
+            return float(expires), token
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_render_lease_backend(name):
+    '''Return a lease backend instance
+
+    Args:
+        name: str
+            'local', 'file' or the dotted path of a backend class (e.g.
+            'my_package.leases.RedisLeaseBackend') implementing
+            acquire(key, ttl) -> token or None, release(key, token) and
+            held(key) -> bool
+    '''
+    if name == 'local':
+        return LocalLeaseBackend()
+    if name == 'file':
+        return FileLeaseBackend()
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def get_render_lease_backend():
+    '''Return the configured lease backend or None when disabled'''
+    global RENDER_LEASE_BACKEND  # pylint: disable=global-statement
+    if RENDER_LEASE_BACKEND is None and settings.RENDER_LEASE_BACKEND:
+        RENDER_LEASE_BACKEND = load_render_lease_backend(
+            settings.RENDER_LEASE_BACKEND
+        )
+        logger.info('Render lease backend %s loaded', RENDER_LEASE_BACKEND)
+    return RENDER_LEASE_BACKEND
+
+
+def acquire_render_lease(key):
+    '''Acquire the render lease of a tile (or of a metatile)
+
+    Returns:
+        The lease token, True when the leases are disabled or None when the
+        lease is held by another worker
+    '''
+    backend = get_render_lease_backend()
+    if backend is None:
+        return True
+    try:
+        return backend.acquire(key, settings.RENDER_LEASE_TTL)
+    except Exception as error:  # pylint: disable=broad-except
+        # Without lease backend the tile is rendered, like without lease
+        logger.error('Failed to acquire render lease %s: %s', key, error)
+        return True
+
+
+def release_render_lease(key, token):
+    backend = get_render_lease_backend()
+    if backend is None or token is None or token is True:
+        return
+    try:
+        backend.release(key, token)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error('Failed to release render lease %s: %s', key, error)
+
+
+def is_render_lease_held(key):
+    backend = get_render_lease_backend()
+    if backend is None:
+        return False
+    try:
+        return backend.held(key)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error('Failed to check render lease %s: %s', key, error)
+        return False
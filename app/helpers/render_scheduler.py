@@ -0,0 +1,228 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import abort
+from flask import g
+from flask import request
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+# Render classes, by order of priority
+INTERACTIVE_LOW_ZOOM = 'interactive-low-zoom'
+INTERACTIVE_HIGH_ZOOM = 'interactive-high-zoom'
+PREVIEW = 'preview'
+BACKGROUND = 'background'
+RENDER_CLASSES = (
+    INTERACTIVE_LOW_ZOOM, INTERACTIVE_HIGH_ZOOM, PREVIEW, BACKGROUND
+)
+
+# Smoothing factor of the render time moving average
+RENDER_TIME_SMOOTHING = 0.2
+
+
+class RenderSchedulerFull(Exception):
+    pass
+
+
+class _Waiter:
+
+    def __init__(self, render_class, deadline):
+        self.render_class = render_class
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.granted = False
+
+
+class RenderScheduler:  # pylint: disable=too-many-instance-attributes
+    '''Weighted fair scheduler of the WMS renders of a worker
+
+    At most `slots` renders run at once. When all slots are busy, the renders
+    wait in a queue per class (see RENDER_CLASSES) and a freed slot is given
+    to the class with the smallest virtual time, which advances by 1 / weight
+    at each render of the class; the classes thus share the slots in
+    proportion to their weights and an idle class can't bank its share.
+
+    A render is dropped (RenderSchedulerFull) when the queue of its class is
+    full, when its expected wait exceeds the class maximum wait or when it is
+    still queued at its deadline.
+    '''
+
+    def __init__(self, slots, weights, max_queues, max_waits):
+        self.slots = slots
+        self.weights = dict(zip(RENDER_CLASSES, weights))
+        self.max_queues = dict(zip(RENDER_CLASSES, max_queues))
+        self.max_waits = dict(zip(RENDER_CLASSES, max_waits))
+        self._queues = {render_class: deque() for render_class in RENDER_CLASSES}
+        self._vtimes = dict.fromkeys(RENDER_CLASSES, 0.0)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.render_time = 0.0
+        self.rendered = dict.fromkeys(RENDER_CLASSES, 0)
+        self.dropped = dict.fromkeys(RENDER_CLASSES, 0)
+
+    @property
+    def enabled(self):
+        return self.slots > 0
+
+    def acquire(self, render_class):
+        '''Wait for a render slot
+
+        Raises:
+            RenderSchedulerFull if the render is dropped
+        '''
+        with self._lock:
+            if self.in_use < self.slots and not any(self._queues.values()):
+                self._grant(render_class)
+                return
+            queue = self._queues[render_class]
+            max_wait = self.max_waits[render_class]
+            if len(queue) >= self.max_queues[render_class]:
+                self.dropped[render_class] += 1
+                raise RenderSchedulerFull(f'{render_class} queue full')
+            if self._expected_wait(render_class) > max_wait:
+                self.dropped[render_class] += 1
+                raise RenderSchedulerFull(
+                    f'{render_class} render would wait more than {max_wait}s'
+                )
+            if not queue:
+                # An idle class restarts at the current virtual time
+                self._vtimes[render_class] = max(
+                    self._vtimes[render_class], self._min_vtime()
+                )
+            waiter = _Waiter(render_class, time.monotonic() + max_wait)
+            queue.append(waiter)
+        waiter.event.wait(max_wait)
+        with self._lock:
+            if waiter.granted:
+                return
+            if waiter in queue:
+                queue.remove(waiter)
+            self.dropped[render_class] += 1
+        raise RenderSchedulerFull(f'{render_class} render deadline exceeded')
+
+    def release(self, render_time):
+        with self._lock:
+            self.render_time += RENDER_TIME_SMOOTHING * (
+                render_time - self.render_time
+            )
+            self.in_use -= 1
+            now = time.monotonic()
+            while self.in_use < self.slots:
+                waiter = self._next_waiter()
+                if waiter is None:
+                    return
+                if waiter.deadline <= now:
+                    # Expired, dropped by the waiter itself once woken up and
+                    # the class share is not consumed
+                    waiter.event.set()
+                    continue
+                waiter.granted = True
+                self._grant(waiter.render_class)
+                waiter.event.set()
+
+    def stats(self):
+        return {
+            'slots': self.slots,
+            'in_use': self.in_use,
+            'render_time': round(self.render_time, 3),
+            'queued': {
+                render_class: len(queue)
+                for render_class, queue in self._queues.items()
+            },
+            'rendered': dict(self.rendered),
+            'dropped': dict(self.dropped),
+        }
+
+    def _grant(self, render_class):
+        self.in_use += 1
+        self.rendered[render_class] += 1
+        self._vtimes[render_class] += 1 / self.weights[render_class]
+
+    def _min_vtime(self):
+        active = [
+            self._vtimes[render_class]
+            for render_class, queue in self._queues.items()
+            if queue
+        ]
+        return min(active) if active else max(self._vtimes.values())
+
+    def _next_waiter(self):
+        '''Pop the next waiter of the active class with the smallest virtual
+        time (the first class by priority on a tie)
+        '''
+        active = [
+            render_class for render_class in RENDER_CLASSES
+            if self._queues[render_class]
+        ]
+        if not active:
+            return None
+        render_class = min(active, key=lambda cls: self._vtimes[cls])
+        return self._queues[render_class].popleft()
+
+    def _expected_wait(self, render_class):
+        '''Estimate the wait of a new render of the class
+
+        The renders of the class get a share of the slots proportional to
+        its weight among the classes waiting for a slot.
+        '''
+        active = {cls for cls, queue in self._queues.items() if queue
+                 } | {render_class}
+        share = self.weights[render_class] / sum(
+            self.weights[cls] for cls in active
+        )
+        ahead = len(self._queues[render_class]) + 1
+        return ahead * self.render_time / (self.slots * share)
+
+
+render_scheduler = RenderScheduler(
+    settings.RENDER_SCHEDULER_SLOTS,
+    settings.RENDER_SCHEDULER_WEIGHTS,
+    settings.RENDER_SCHEDULER_MAX_QUEUES,
+    settings.RENDER_SCHEDULER_MAX_WAITS
+)
+
+
+def get_render_class():
+    '''Return the render class of the current request'''
+    if g.get('render_class'):
+        return g.render_class
+    purpose = request.headers.get(
+        'Sec-Purpose', request.headers.get('Purpose', '')
+    )
+    if 'prefetch' in purpose:
+        return BACKGROUND
+    if request.args.get('mode') == 'preview':
+        return PREVIEW
+    if (request.view_args or {}).get('zoom', 0) <= \
+            settings.RENDER_SCHEDULER_LOW_ZOOM_MAX:
+        return INTERACTIVE_LOW_ZOOM
+    return INTERACTIVE_HIGH_ZOOM
+
+
+@contextmanager
+def scheduled_render():
+    '''Hold a render slot of the scheduler (if enabled) while rendering
+
+    A dropped render is answered with a 503, shortly cached like the WMS
+    backend overload.
+    '''
+    if not render_scheduler.enabled:
+        yield
+        return
+    render_class = get_render_class()
+    try:
+        render_scheduler.acquire(render_class)
+    except RenderSchedulerFull as error:
+        logger.warning('WMS render dropped: %s', error)
+        g.wms_backend_overloaded = True
+        abort(503, 'WMS backend overloaded, please retry later')
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        render_scheduler.release(time.monotonic() - started)
@@ -0,0 +1,121 @@
+import logging
+import threading
+
+from flask import g
+
+from app import settings
+from app.app import app
+from app.helpers.render_scheduler import BACKGROUND
+from app.helpers.tile_cache import cache_tile
+from app.helpers.wmts import prepare_wmts_response
+from app.helpers.wmts_config import get_wmts_config_by_layer
+
+logger = logging.getLogger(__name__)
+
+
+class Revalidator:
+    '''Background revalidation of the stale S3 tiles
+
+    A stale tile is re-rendered at most once at a time per worker and the
+    number of revalidations in progress is bounded, the tiles that can't be
+    revalidated right away are revalidated on a later request.
+
+    The revalidations run in threads (greenlets when running with gevent).
+    '''
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.skipped = 0
+        self.revalidated = 0
+        self.failed = 0
+
+    def schedule(self, wmts_path, revalidate):
+        '''Run revalidate(wmts_path) in the background
+
+        Returns:
+            True if the revalidation has been scheduled, False if the tile is
+            already being revalidated or if too many tiles are being
+            revalidated
+        '''
+        with self._lock:
+            if wmts_path in self._pending:
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.skipped += 1
+                return False
+            self._pending.add(wmts_path)
+            self.scheduled += 1
+        threading.Thread(
+            target=self._run,
+            args=(wmts_path, revalidate),
+            name='tile-revalidation',
+            daemon=True
+        ).start()
+        return True
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'max_pending': self.max_pending,
+            'scheduled': self.scheduled,
+            'skipped': self.skipped,
+            'revalidated': self.revalidated,
+            'failed': self.failed,
+        }
+
+    def _run(self, wmts_path, revalidate):
+        try:
+            if revalidate(wmts_path):
+                self.revalidated += 1
+            else:
+                self.failed += 1
+        except Exception as error:  # pylint: disable=broad-except
+            self.failed += 1
+            logger.exception(
+                'Failed to revalidate tile %s: %s', wmts_path, error
+            )
+        finally:
+            with self._lock:
+                self._pending.discard(wmts_path)
+
+
+revalidator = Revalidator(settings.STALE_WHILE_REVALIDATE_MAX_PENDING)
+
+
+def revalidate_tile(wmts_path):
+    '''Re-render a tile and overwrite it on S3 and in the memory caches
+
+    Returns:
+        True if the tile has been rendered and queued for S3
+    '''
+    with app.test_request_context(f'/{wmts_path}'):
+        g.render_class = BACKGROUND
+        status_code, content, headers, on_close = prepare_wmts_response(
+            'default', None
+        )
+        if status_code != 200 or on_close is None:
+            # not rendered, not cached on S3 or rendered and written by a
+            # concurrent request
+            logger.warning(
+                'Tile %s not revalidated: status_code=%d',
+                wmts_path,
+                status_code
+            )
+            return False
+        on_close()
+        cache_tile(
+            wmts_path,
+            content,
+            headers,
+            get_wmts_config_by_layer(wmts_path.split('/')[1])
+        )
+    logger.debug('Tile %s revalidated', wmts_path)
+    return True
+
+
+def schedule_revalidation(wmts_path):
+    '''Revalidate a stale tile in the background (see Revalidator)'''
+    return revalidator.schedule(wmts_path, revalidate_tile)
@@ -1,6 +1,7 @@
 import hashlib
 import http.client
 import logging
+import threading
 from base64 import b64encode
 from socket import timeout as socket_timeout
 from time import perf_counter
@@ -8,14 +9,19 @@ from time import perf_counter
 import boto3
 import botocore.exceptions
 from botocore.client import Config
-from requests.exceptions import ChunkedEncodingError
 
 from flask import g
 
 from app import settings
+from app.helpers.blank_tile import BLANK_TILE_METADATA
+from app.helpers.blank_tile import lookup_blank_tile
+from app.helpers.image_pool import hash_in_image_pool
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of keys of a S3 DeleteObjects request
+S3_DELETE_MAX_KEYS = 1000
+
 
 def _get_s3_base_path():
     if settings.AWS_S3_ENDPOINT_URL:
@@ -40,20 +46,230 @@ def get_s3_client():
     )
 
 
-def get_s3_file(wmts_path, etag=None):
+class S3PoolTimeoutError(socket_timeout):
+    pass
+
+
+class S3ConnectionPool:  # pylint: disable=too-many-instance-attributes
+    '''Pool of keep-alive HTTP connections to the S3 bucket
+
+    The pool is bounded, when all connections are in use a request waits up
+    to `timeout` seconds for a free connection. The pool relies on the
+    threading primitives which are patched by gevent, so waiting for a
+    connection only blocks the current greenlet.
+
+    Idle connections older than `idle_timeout` are discarded as S3 closes idle
+    connections on its side. Reused connections that have been closed or
+    reset by S3 are detected when sending the request and the request is
+    transparently retried once with a new connection.
+    '''
+
+    def __init__(self, host, timeout, maxsize, idle_timeout):
+        self.host = host
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._semaphore = threading.BoundedSemaphore(maxsize)
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.saturated = 0
+
+    def acquire(self):
+        '''Return a (connection, reused) tuple
+
+        Raises:
+            S3PoolTimeoutError if no connection is available within the pool
+            timeout
+        '''
+        # pylint: disable=consider-using-with
+        if not self._semaphore.acquire(blocking=False):
+            self.saturated += 1
+            logger.warning(
+                'S3 connection pool saturated (%d connections in use)',
+                self.in_use
+            )
+            if not self._semaphore.acquire(timeout=self.timeout):
+                raise S3PoolTimeoutError('No S3 connection available')
+        self.in_use += 1
+        now = perf_counter()
+        while self._idle:
+            connection, last_used = self._idle.pop()
+            if now - last_used < self.idle_timeout:
+                self.reused += 1
+                return connection, True
+            connection.close()
+        self.created += 1
+        return http.client.HTTPConnection(
+            self.host, timeout=self.timeout
+        ), False
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            self._idle.append((connection, perf_counter()))
+        else:
+            connection.close()
+        self.in_use -= 1
+        self._semaphore.release()
+
+    def request(self, method, path, headers):
+        '''Send a request using a pooled connection
+
+        The caller must read the response and then release the connection.
+
+        Returns:
+            (connection, response)
+        '''
+        connection, reused = self.acquire()
+        try:
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except ConnectionError as error:
+            self.release(connection, reusable=False)
+            if not reused:
+                raise
+            # When reusing a keep-alive connection, it might have been closed
+            # or reset by S3 meanwhile, retry with a new connection. The other
+            # idle connections are most probably stale as well.
+            logger.debug('Reconnecting stale S3 connection: %s', error)
+            self.reconnects += 1
+            self.clear()
+            connection, _ = self.acquire()
+            try:
+                connection.request(method, path, headers=headers)
+                return connection, connection.getresponse()
+            except BaseException:
+                self.release(connection, reusable=False)
+                raise
+        except BaseException:
+            self.release(connection, reusable=False)
+            raise
+
+    def clear(self):
+        while self._idle:
+            connection, _ = self._idle.pop()
+            connection.close()
+
+    def stats(self):
+        return {
+            'maxsize': self.maxsize,
+            'in_use': self.in_use,
+            'idle': len(self._idle),
+            'created': self.created,
+            'reused': self.reused,
+            'reconnects': self.reconnects,
+            'saturated': self.saturated,
+        }
+
+
+s3_connection_pool = S3ConnectionPool(
+    settings.AWS_BUCKET_HOST,
+    settings.HTTP_CLIENT_TIMEOUT,
+    settings.S3_POOL_MAXSIZE,
+    settings.S3_POOL_IDLE_TIMEOUT
+)
+
+
+class S3FileStream:
+    '''Iterable streaming the body of a S3 response in chunks
+
+    The pooled connection is held until the stream is closed (WSGI servers
+    close the response iterable once sent or when the client aborted), it is
+    only reused if the whole body has been read. The callbacks added before
+    the iteration are called with the whole body once it has been read.
+    '''
+
+    def __init__(self, connection, response, wmts_path, length):
+        self.connection = connection
+        self.response = response
+        self.wmts_path = wmts_path
+        self.length = length
+        self.completed = False
+        self._callbacks = []
+
+    def add_done_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def __iter__(self):
+        chunks = [] if self._callbacks else None
+        try:
+            while True:
+                chunk = self.response.read(settings.S3_STREAM_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+        except (
+            ConnectionError, http.client.HTTPException, socket_timeout
+        ) as error:
+            # The headers are already sent, the response can only be aborted
+            logger.error(
+                'Failed to stream S3 file %s: %s', self.wmts_path, error
+            )
+            raise
+        self.completed = True
+        if chunks is not None:
+            content = b''.join(chunks)
+            for callback in self._callbacks:
+                callback(content)
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if not self.completed:
+            logger.debug('S3 file %s stream not completed', self.wmts_path)
+        s3_connection_pool.release(
+            connection, self.completed and not self.response.will_close
+        )
+
+
+def get_s3_stream_length(response):
+    '''Return the body length of a S3 hit if it should be streamed, else None'''
+    if settings.S3_STREAM_MIN_BYTES <= 0 or response.status != 200:
+        return None
+    try:
+        length = int(response.getheader('Content-Length', ''))
+    except ValueError:
+        return None
+    if length < settings.S3_STREAM_MIN_BYTES:
+        return None
+    return length
+
+
+def get_s3_file(wmts_path, etag=None, stream=False):
     '''Get a file from S3
 
+    See fetch_s3_file, the hits are flagged in the request context for the
+    access logs.
+    '''
+    response, content = fetch_s3_file(wmts_path, etag, stream)
+    if response is not None:
+        g.setdefault('from_s3_cache', True)
+    return response, content
+
+
+def fetch_s3_file(wmts_path, etag=None, stream=False):
+    '''Get a file from S3 (can be called outside of a request context)
+
     Args:
         wmts_path: str
             Path correspond to the S3 key (without leading '/')
         etag: str | None
             ETag to pass as If-None-Match header
+        stream: bool
+            Return the body of the hits of at least S3_STREAM_MIN_BYTES as a
+            S3FileStream instead of reading it
 
     Returns:
         S3 object or None if the file is not found or any other errors happened
     '''
-    http_client = None
+    connection = None
     response = None
+    reusable = False
     headers = {}
     if etag:
         headers['If-None-Match'] = etag
@@ -61,31 +277,23 @@ def get_s3_file(wmts_path, etag=None):
     try:
         path = f"{_get_s3_base_path()}/{wmts_path}"
         logger.debug('Get file from S3: %s%s', settings.AWS_BUCKET_HOST, path)
-        http_client = http.client.HTTPConnection(
-            settings.AWS_BUCKET_HOST, timeout=settings.HTTP_CLIENT_TIMEOUT
-        )
-        try:
-            http_client.request("GET", path, headers=headers)
-            response = http_client.getresponse()
-        except ChunkedEncodingError as error:
-            # When reading from S3, sporadically TCP connections
-            # have been reset, raising 104 errors. We tried to active TCP
-            # keep alive to avoid such errors, but this did not help
-            logger.warning(
-                'TCP connection has been reset.' \
-                'when requesting file %s. error=%s',
-                path,
-                error
-            )
-            return None, None
+        connection, response = s3_connection_pool.request("GET", path, headers)
+        length = get_s3_stream_length(response) if stream else None
+        if length is not None:
+            logger.debug('Streaming file %s from S3', wmts_path)
+            # The stream releases the connection once closed
+            content = S3FileStream(connection, response, wmts_path, length)
+            connection = None
+            return response, content
+        content = response.read()
+        reusable = not response.will_close
         if response.status in (200, 304):
             logger.debug('File %s found on S3', wmts_path)
-            g.setdefault('from_s3_cache', True)
-            return response, response.read()
+            return response, content
         if response.status in (404, 403):
             # Note depending on S3 configuration, it might return a 403 when an
-            # object is not found. Also in this case we don't read the content
-            # as we don't need it.
+            # object is not found. The content is read anyway to be able to
+            # reuse the connection.
             logger.debug(
                 'S3 file %s not found: status_code=%d %s',
                 wmts_path,
@@ -93,23 +301,37 @@ def get_s3_file(wmts_path, etag=None):
                 response.reason
             )
             return None, None
+    except ConnectionError as error:
+        # When reading from S3, sporadically TCP connections
+        # have been reset, raising 104 errors.
+        logger.warning(
+            'TCP connection has been reset.' \
+            'when requesting file %s. error=%s',
+            wmts_path,
+            error
+        )
+        return None, None
     except (http.client.HTTPException, socket_timeout) as error:
         logger.error('Failed to get S3 file %s: %s', wmts_path, error)
         return None, None
     finally:
-        if http_client:
-            http_client.close()
+        if connection:
+            s3_connection_pool.release(connection, reusable)
     logger.error(
         'Failed to get S3 file %s: status_code=%d %s, headers=%s, body=%s',
         wmts_path,
         response.status,
         response.reason,
         response.getheaders(),
-        response.read()
+        content
     )
     return None, None
 
 
+def md5_digest(content):
+    return hashlib.md5(content).digest()
+
+
 '''
 S3 client used by write the Tile on S3.
 '''
@@ -119,7 +341,8 @@ s3_client = get_s3_client()
 def put_s3_file(content, wmts_path, headers):
     '''Put a file on S3 synchronously
 
-    This method upload the file to S3
+    This method upload the file to S3, the canonical blank tiles (see
+    app.helpers.blank_tile) are written as empty marker objects.
 
     Args:
         content: str
@@ -130,7 +353,13 @@ def put_s3_file(content, wmts_path, headers):
             header to set with the S3 object
     '''
     logger.debug('Inserting tile %s in S3', wmts_path)
-    md5 = b64encode(hashlib.md5(content).digest()).decode('utf-8')
+    options = {}
+    blank = lookup_blank_tile(content)
+    if blank:
+        # Only a marker of the canonical blank tile is stored
+        content = b''
+        options['Metadata'] = {BLANK_TILE_METADATA: blank}
+    md5 = b64encode(hash_in_image_pool(md5_digest, content)).decode('utf-8')
     try:
         started = perf_counter()
         s3_client.put_object(
@@ -142,7 +371,8 @@ def put_s3_file(content, wmts_path, headers):
             ),
             ContentLength=len(content),
             ContentType=headers['Content-Type'],
-            ContentMD5=md5
+            ContentMD5=md5,
+            **options
         )
         logger.debug(
             'Written file to S3 in %.2f ms', (perf_counter() - started) * 1000
@@ -158,3 +388,50 @@ def put_s3_file(content, wmts_path, headers):
             error,
             exc_info=True
         )
+
+
+def s3_file_exists(wmts_path):
+    '''Return True if the file exists on S3
+
+    Args:
+        wmts_path: str
+            S3 key (usually the wmts path without leading '/')
+    '''
+    try:
+        s3_client.head_object(Bucket=settings.AWS_S3_BUCKET_NAME, Key=wmts_path)
+    except botocore.exceptions.ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+def delete_s3_files(wmts_paths):
+    '''Delete files on S3 with a single DeleteObjects request
+
+    Args:
+        wmts_paths: list
+            S3 keys (usually the wmts path without leading '/'), at most
+            S3_DELETE_MAX_KEYS
+
+    Returns:
+        The list of the keys that could not be deleted
+    '''
+    response = s3_client.delete_objects(
+        Bucket=settings.AWS_S3_BUCKET_NAME,
+        Delete={
+            'Objects': [{
+                'Key': wmts_path
+            } for wmts_path in wmts_paths],
+            'Quiet': True
+        }
+    )
+    errors = response.get('Errors', [])
+    for error in errors:
+        logger.error(
+            'Failed to delete file %s on S3: %s %s',
+            error.get('Key'),
+            error.get('Code'),
+            error.get('Message')
+        )
+    return [error.get('Key') for error in errors]
@@ -0,0 +1,254 @@
+import logging
+import math
+import queue
+import threading
+from collections import deque
+from fnmatch import fnmatchcase
+from time import perf_counter
+
+from flask import copy_current_request_context
+from flask import g
+
+from app import settings
+from app.helpers.render_scheduler import PREVIEW
+from app.helpers.s3 import S3FileStream
+from app.helpers.s3 import fetch_s3_file
+from app.helpers.s3 import s3_connection_pool
+from app.helpers.wmts import prepare_wmts_response
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of S3 GET latencies recorded before hedging
+HEDGE_MIN_SAMPLES = 20
+
+# Attempts of a hedged S3 read
+S3 = 's3'
+HEDGE = 'hedge'
+RENDER = 'render'
+
+
+class LatencyTracker:
+    '''Rolling window of the latest S3 GET latencies (per worker)'''
+
+    def __init__(self, window):
+        self._latencies = deque(maxlen=window)
+
+    def record(self, latency):
+        self._latencies.append(latency)
+
+    def percentile(self, percent):
+        '''Return the percentile of the recorded latencies or None if there are
+        not enough of them
+        '''
+        latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        index = math.ceil(percent / 100 * len(latencies)) - 1
+        return latencies[max(0, min(index, len(latencies) - 1))]
+
+    def clear(self):
+        self._latencies.clear()
+
+
+class S3Hedger:  # pylint: disable=too-many-instance-attributes
+    '''Hedging policy and counters of the S3 reads'''
+
+    def __init__(self, window, percent, min_delay, max_ratio):
+        self.latencies = LatencyTracker(window)
+        self.percent = percent
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.requests = 0
+        self.hedged = 0
+        self.rendered = 0
+        self.wins = dict.fromkeys((S3, HEDGE, RENDER), 0)
+
+    def get_delay(self):
+        '''Return the time after which a S3 GET is hedged or None if the GETs
+        are not hedged (yet)
+        '''
+        delay = self.latencies.percentile(self.percent)
+        if delay is None:
+            return None
+        return max(delay, self.min_delay)
+
+    def allow_hedge(self):
+        '''Return True if a second S3 GET can be sent
+
+        The hedged GETs are bounded to a ratio of the GETs, so that a slow S3
+        does not get twice the load, and are not sent when the S3 connection
+        pool is exhausted.
+        '''
+        if self.hedged >= self.max_ratio * self.requests:
+            return False
+        return s3_connection_pool.in_use < s3_connection_pool.maxsize
+
+    def reset(self):
+        self.latencies.clear()
+        self.requests = 0
+        self.hedged = 0
+        self.rendered = 0
+        self.wins = dict.fromkeys(self.wins, 0)
+
+    def stats(self):
+        delay = self.get_delay()
+        return {
+            'delay': None if delay is None else round(delay, 3),
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'rendered': self.rendered,
+            'wins': dict(self.wins),
+        }
+
+
+s3_hedger = S3Hedger(
+    settings.S3_HEDGE_WINDOW,
+    settings.S3_HEDGE_PERCENTILE,
+    settings.S3_HEDGE_MIN_DELAY,
+    settings.S3_HEDGE_MAX_RATIO
+)
+
+
+def discard_result(kind, result):
+    '''Release the result of an attempt that lost the race'''
+    if kind != RENDER and result is not None:
+        _, content = result
+        if isinstance(content, S3FileStream):
+            content.close()
+
+
+def is_answer(kind, result):
+    '''Return True if the result of an attempt answers the request'''
+    if result is None:
+        return False
+    if kind == RENDER:
+        return result[0] in (200, 304)
+    return result[0] is not None
+
+
+class _Race:
+    '''Attempts run concurrently (in greenlets with gevent), the results
+    arriving once the race is over are discarded
+    '''
+
+    def __init__(self):
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._over = False
+        # Attempts started whose result has not been waited for yet
+        self.pending = 0
+
+    def start(self, kind, func):
+        '''Run the attempt, its (kind, result) is queued when done, the result
+        being None if it raised
+        '''
+
+        def run():
+            result = None
+            try:
+                result = func()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning('S3 hedge %s attempt failed: %s', kind, error)
+            with self._lock:
+                if not self._over:
+                    self._results.put((kind, result))
+                    return
+            discard_result(kind, result)
+
+        self.pending += 1
+        threading.Thread(target=run, daemon=True).start()
+
+    def wait(self, timeout=None):
+        '''Return the next (kind, result) or None on timeout'''
+        try:
+            result = self._results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.pending -= 1
+        return result
+
+    def finish(self):
+        with self._lock:
+            self._over = True
+        while True:
+            try:
+                discard_result(*self._results.get_nowait())
+            except queue.Empty:
+                return
+
+
+def get_speculative_render(layer_id, etag):
+    '''Return a function rendering the requested tile as a preview (neither
+    written to S3 nor cached) or None if the layer is not cheap to render
+    '''
+    if not any(
+        fnmatchcase(layer_id, pattern)
+        for pattern in settings.S3_HEDGE_RENDER_LAYERS
+    ):
+        return None
+
+    @copy_current_request_context
+    def render():
+        g.render_class = PREVIEW
+        status_code, content, headers, _ = prepare_wmts_response(
+            'preview', etag
+        )
+        return status_code, content, headers
+
+    return render
+
+
+def get_hedged_s3_file(wmts_path, etag=None, stream=False, render=None):
+    '''Get a file from S3, hedging the slow GETs
+
+    When the S3 GET takes longer than the hedging delay (see S3Hedger), a
+    second GET is sent and the optional `render` function is started; the
+    first S3 hit or successful render is used, a S3 miss or error only once
+    all the attempts failed. The other attempts can't be
+    interrupted, they are abandoned and their result is discarded.
+
+    Returns:
+        (kind, result) where result is the (s3_resp, content) of get_s3_file
+        or the (status_code, content, headers) of the render
+    '''
+    s3_hedger.requests += 1
+
+    def fetch():
+        started = perf_counter()
+        result = fetch_s3_file(wmts_path, etag, stream)
+        s3_hedger.latencies.record(perf_counter() - started)
+        return result
+
+    delay = s3_hedger.get_delay()
+    if delay is None:
+        kind, result = S3, fetch()
+    else:
+        race = _Race()
+        race.start(S3, fetch)
+        first = race.wait(delay)
+        if first is None:
+            logger.debug('Hedging S3 GET of %s after %.3fs', wmts_path, delay)
+            if s3_hedger.allow_hedge():
+                s3_hedger.hedged += 1
+                race.start(HEDGE, fetch)
+            if render is not None:
+                s3_hedger.rendered += 1
+                race.start(RENDER, render)
+            first = race.wait()
+            failed = None
+            while not is_answer(*first) and race.pending:
+                # A failed attempt is not an answer while others are pending
+                if first[0] != RENDER and failed is None:
+                    failed = first
+                first = race.wait()
+            if not is_answer(*first) and failed is not None:
+                # All the attempts failed, the S3 miss is used
+                first = failed
+        race.finish()
+        kind, result = first
+    s3_hedger.wins[kind] += 1
+    if kind != RENDER:
+        result = result or (None, None)
+        if result[0] is not None:
+            g.setdefault('from_s3_cache', True)
+    return kind, result
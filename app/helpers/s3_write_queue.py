@@ -0,0 +1,234 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from app import settings
+from app.helpers.s3 import put_s3_file
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop-oldest'
+BACKPRESSURE = 'backpressure'
+
+
+class S3WriteQueue:  # pylint: disable=too-many-instance-attributes
+    '''Bounded write-behind queue for the S3 tile uploads
+
+    Tiles are queued by S3 key, a tile queued again before being uploaded
+    replaces the queued one (the callbacks of both are kept). The queue is
+    bounded by the total size of the queued tiles; when full, either the
+    oldest queued tiles are dropped (drop-oldest policy) or the caller waits
+    for some free space up to a timeout (backpressure policy).
+
+    The tiles are uploaded by a fixed number of uploader threads (greenlets
+    when running with gevent) started lazily in each worker process.
+    '''
+
+    def __init__(self, max_bytes, workers, policy, backpressure_timeout):
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.policy = policy
+        self.backpressure_timeout = backpressure_timeout
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._uploaders = []
+        self._pid = None
+        self._in_flight = 0
+        self.size = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+
+    def put(self, content, wmts_path, headers, callback=None):
+        '''Queue a tile to be written on S3
+
+        Args:
+            callback: callable
+                Called without argument once the tile is done with: written
+                (or failed to be written), dropped or discarded
+
+        Returns:
+            True if the tile has been queued (or written when the queue is
+            disabled), False if it has been dropped
+        '''
+        callbacks = [callback] if callback else []
+        if self.workers <= 0:
+            try:
+                put_s3_file(content, wmts_path, headers)
+            finally:
+                self._done(callbacks)
+            return True
+        self._start_uploaders()
+        size = len(content)
+        if size > self.max_bytes:
+            logger.warning('Tile %s too big for the S3 write queue', wmts_path)
+            self.dropped += 1
+            self._done(callbacks)
+            return False
+        dropped = []
+        with self._condition:
+            previous = self._pending.pop(wmts_path, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+                self.coalesced += 1
+                callbacks = previous[2] + callbacks
+            queued = self._reserve(size, dropped)
+            if queued:
+                self._pending[wmts_path] = (content, headers, callbacks)
+                self.size += size
+                self.queued += 1
+                self._condition.notify_all()
+            else:
+                logger.warning(
+                    'S3 write queue full, dropping tile %s', wmts_path
+                )
+                self.dropped += 1
+                dropped.append(callbacks)
+        for dropped_callbacks in dropped:
+            self._done(dropped_callbacks)
+        return queued
+
+    def discard(self, wmts_path):
+        '''Remove a queued tile (e.g. a purged tile)
+
+        NOTE: a tile being uploaded is not discarded.
+
+        Returns:
+            True if the tile was queued
+        '''
+        with self._condition:
+            previous = self._pending.pop(wmts_path, None)
+            if previous is None:
+                return False
+            self.size -= len(previous[0])
+            self._condition.notify_all()
+        self._done(previous[2])
+        return True
+
+    def flush(self, timeout):
+        '''Wait until all queued tiles have been written
+
+        Returns:
+            True if the queue has been flushed within the timeout
+        '''
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._in_flight, timeout
+            )
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'max_size': self.max_bytes,
+            'pending': len(self._pending),
+            'in_flight': self._in_flight,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'written': self.written,
+        }
+
+    def _reserve(self, size, dropped):
+        '''Make room for size bytes, must be called with the condition held
+
+        The callbacks of the tiles dropped to make room are appended to
+        dropped.
+        '''
+        if self.policy == BACKPRESSURE:
+            return self._condition.wait_for(
+                lambda: self.size + size <= self.max_bytes,
+                self.backpressure_timeout
+            )
+        while self._pending and self.size + size > self.max_bytes:
+            wmts_path, (content, _,
+                        callbacks) = self._pending.popitem(last=False)
+            self.size -= len(content)
+            self.dropped += 1
+            dropped.append(callbacks)
+            logger.warning(
+                'S3 write queue full, dropping oldest tile %s', wmts_path
+            )
+        return True
+
+    def _start_uploaders(self):
+        # The uploaders must be started in the worker process, after the fork
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._uploaders = [
+                threading.Thread(
+                    target=self._upload, name=f's3-uploader-{i}', daemon=True
+                ) for i in range(self.workers)
+            ]
+        for uploader in self._uploaders:
+            uploader.start()
+
+    def _upload(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                wmts_path, (content, headers,
+                            callbacks) = self._pending.popitem(last=False)
+                self.size -= len(content)
+                self._in_flight += 1
+                # wake up the producers waiting for free space
+                self._condition.notify_all()
+            try:
+                put_s3_file(content, wmts_path, headers)
+                self.written += 1
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception(
+                    'Failed to write tile %s on S3: %s', wmts_path, error
+                )
+            finally:
+                self._done(callbacks)
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    @staticmethod
+    def _done(callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception('S3 write queue callback failed: %s', error)
+
+
+s3_write_queue = S3WriteQueue(
+    settings.S3_WRITE_QUEUE_MAX_BYTES,
+    settings.S3_WRITE_QUEUE_WORKERS,
+    settings.S3_WRITE_QUEUE_POLICY,
+    settings.S3_WRITE_QUEUE_BACKPRESSURE_TIMEOUT
+)
+
+
+def queue_s3_file(content, wmts_path, headers, callback=None):
+    '''Queue a file to be written on S3 asynchronously
+
+    Args:
+        content: bytes
+            File content
+        wmts_path: str
+            S3 key to use (usually the wmts path without leading '/')
+        headers: dict
+            header to set with the S3 object
+        callback: callable
+            Called once the file has been written, or dropped from the queue
+    '''
+    return s3_write_queue.put(content, wmts_path, headers, callback)
+
+
+def flush_s3_write_queue():
+    '''Wait until all queued files are written on S3 (e.g. on worker exit)'''
+    if not s3_write_queue.flush(settings.S3_WRITE_QUEUE_FLUSH_TIMEOUT):
+        logger.error(
+            'S3 write queue not flushed within %ss, %d tiles lost',
+            settings.S3_WRITE_QUEUE_FLUSH_TIMEOUT,
+            s3_write_queue.stats()['pending']
+        )
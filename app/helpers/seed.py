@@ -0,0 +1,348 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from werkzeug.exceptions import HTTPException
+
+from flask import g
+
+from app.app import app
+from app.helpers.coverage import get_tile_array
+from app.helpers.grids import get_tile_grid
+from app.helpers.render_scheduler import BACKGROUND
+from app.helpers.s3 import s3_file_exists
+from app.helpers.s3_write_queue import flush_s3_write_queue
+from app.helpers.wmts import get_tile_path
+from app.helpers.wmts import prepare_wmts_response
+from app.helpers.wmts_config import get_wmts_config_by_layer
+
+logger = logging.getLogger(__name__)
+
+RENDERED = 'rendered'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+NOT_CACHED = 'not_cached'
+
+# Settings of the seeding process (see init_seed_worker())
+SEED_WORKER = {}
+
+
+class RateLimiter:
+    '''Token bucket limiting the number of renderings per second'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            # The token is reserved even when the bucket is empty, the caller
+            # waits until it would have been available.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint:
+    '''Seeding progress saved in a JSON file to resume an interrupted seeding
+
+    The progress is the list of the completed chunks per zoom level, it is
+    only resumed for the same seeding job.
+    '''
+
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        self.done = {}
+        self.stats = {RENDERED: 0, SKIPPED: 0, FAILED: 0, NOT_CACHED: 0}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fd:
+                data = json.load(fd)
+            if data.get('job') == job:
+                self.done = {
+                    zoom: set(chunks) for zoom, chunks in data['done'].items()
+                }
+                self.stats = data['stats']
+                logger.info('Resuming seeding from checkpoint %s', path)
+            else:
+                logger.warning(
+                    'Checkpoint %s is for another seeding job, ignoring it',
+                    path
+                )
+
+    def is_done(self, zoom, chunk):
+        return chunk in self.done.get(str(zoom), ())
+
+    def mark_done(self, zoom, chunk, stats):
+        self.done.setdefault(str(zoom), set()).add(chunk)
+        for name, value in stats.items():
+            self.stats[name] += value
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump({
+                'job': self.job,
+                'done': {
+                    zoom: sorted(chunks) for zoom, chunks in self.done.items()
+                },
+                'stats': self.stats
+            },
+                      fd)
+        os.replace(tmp_path, self.path)
+
+
+def hilbert_index(order, col, row):
+    '''Return the index of (col, row) on the Hilbert curve of side 2**order
+
+    col and row can be integers or integer arrays.
+    '''
+    col = np.array(col, dtype=np.int64)
+    row = np.array(row, dtype=np.int64)
+    side = 1 << order
+    index = np.zeros_like(col)
+    step = side >> 1
+    while step > 0:
+        rot_x = (col & step) > 0
+        rot_y = (row & step) > 0
+        index += step * step * ((3 * rot_x) ^ rot_y)
+        flip = rot_x & ~rot_y
+        col = np.where(flip, side - 1 - col, col)
+        row = np.where(flip, side - 1 - row, row)
+        col, row = np.where(rot_y, col, row), np.where(rot_y, row, col)
+        step >>= 1
+    return index if index.ndim else int(index)
+
+
+def sort_tiles(tiles):
+    '''Sort the tiles along a Hilbert curve, neighbour tiles stay close
+
+    Args:
+        tiles: array
+            (N, 2) integer array of (col, row)
+    '''
+    tiles = np.asarray(tiles, dtype=np.int64).reshape(-1, 2)
+    if tiles.size == 0:
+        return tiles
+    offsets = tiles - tiles.min(axis=0)
+    order = max(int(offsets.max()).bit_length(), 1)
+    return tiles[np.argsort(
+        hilbert_index(order, offsets[:, 0], offsets[:, 1]), kind='stable'
+    )]
+
+
+def get_seed_zooms(grid, restriction, min_zoom, max_zoom):
+    '''Return the zoom levels in the range whose tiles are cached on S3'''
+    zooms = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        if not grid.is_valid_zoom(zoom):
+            continue
+        resolution = grid.getResolution(zoom)
+        if grid.srid == 4326:
+            resolution = resolution * grid.metersPerUnit
+        if resolution < restriction['resolution_max'] or \
+                resolution < restriction['s3_resolution_max']:
+            logger.warning('Zoom level %d is not cached on S3, skipped', zoom)
+            continue
+        zooms.append(zoom)
+    return zooms
+
+
+def get_seed_tiles(grid, zoom, metatile, bbox=None, polygons=None):
+    '''Return the tiles to render at zoom, ordered along a Hilbert curve
+
+    With metatiles, only one tile per metatile is rendered, the siblings are
+    written to S3 with it.
+    '''
+    tiles = get_tile_array(grid, zoom, bbox, polygons)
+    if metatile > 1:
+        _, first = np.unique(tiles // metatile, axis=0, return_index=True)
+        tiles = tiles[np.sort(first)]
+    return sort_tiles(tiles)
+
+
+def seed_tile(wmts_path):
+    '''Render a tile and write it on S3
+
+    Returns:
+        RENDERED, SKIPPED, FAILED or NOT_CACHED
+    '''
+    if SEED_WORKER['skip_existing'] and s3_file_exists(wmts_path):
+        logger.debug('Tile %s already on S3, skipped', wmts_path)
+        return SKIPPED
+    SEED_WORKER['rate_limiter'].acquire()
+    with app.test_request_context(f'/{wmts_path}'):
+        # The seeding renders don't compete with the tile requests
+        g.render_class = BACKGROUND
+        try:
+            status_code, _, _, on_close = prepare_wmts_response('default', None)
+        except HTTPException as error:
+            logger.error('Failed to render tile %s: %s', wmts_path, error)
+            return FAILED
+    if status_code != 200:
+        logger.error('Failed to render tile %s: %s', wmts_path, status_code)
+        return FAILED
+    if on_close is None:
+        return NOT_CACHED
+    on_close()
+    return RENDERED
+
+
+def init_seed_worker(concurrency, rate, skip_existing):
+    SEED_WORKER['concurrency'] = concurrency
+    SEED_WORKER['rate_limiter'] = RateLimiter(rate)
+    SEED_WORKER['skip_existing'] = skip_existing
+
+
+def seed_chunk(task):
+    '''Seed a chunk of tiles (in a seeding process)
+
+    Returns:
+        (zoom, chunk, stats)
+    '''
+    zoom, chunk, paths = task
+    stats = {RENDERED: 0, SKIPPED: 0, FAILED: 0, NOT_CACHED: 0}
+    with ThreadPoolExecutor(SEED_WORKER['concurrency']) as executor:
+        for result in executor.map(seed_tile, paths):
+            stats[result] += 1
+    flush_s3_write_queue()
+    return zoom, chunk, stats
+
+
+def seed(  # pylint: disable=too-many-arguments,too-many-locals
+    layer_id,
+    time_value,
+    srid,
+    zooms,
+    extension=None,
+    bbox=None,
+    polygons=None,
+    processes=1,
+    concurrency=4,
+    rate=0,
+    skip_existing=False,
+    checkpoint_path=None,
+    chunk_size=256
+):
+    '''Render the tiles of an area and write them on S3
+
+    Args:
+        layer_id: str
+            Layer to seed
+        time_value: str
+            Layer timestamp
+        srid: int
+            Tile grid srid
+        zooms: tuple
+            (min_zoom, max_zoom)
+        extension: str
+            Image format, default to the first layer format
+        bbox: list
+            Area to seed [min_x, min_y, max_x, max_y] in the srid
+        polygons: list
+            Area to seed (see app.helpers.coverage.load_geojson_polygons())
+        processes: int
+            Number of seeding processes
+        concurrency: int
+            Number of concurrent renderings per process
+        rate: float
+            Maximum number of renderings per second (all processes), 0 for
+            no limit
+        skip_existing: bool
+            Don't render the tiles already on S3
+        checkpoint_path: str
+            File in which the progress is saved, the seeding is resumed from
+            it when it exists
+        chunk_size: int
+            Number of tiles per chunk (unit of work and of progress)
+
+    Returns:
+        The number of tiles per result (rendered, skipped, failed,
+        not_cached)
+    '''
+    restriction = get_wmts_config_by_layer(layer_id)
+    if restriction is None:
+        raise ValueError(f'Unknown layer {layer_id}')
+    grid = get_tile_grid(srid)
+    if grid is None:
+        raise ValueError(f'Unsupported srid {srid}')
+    extension = extension or restriction['formats'][0]
+    metatile = restriction.get('wms_metatile') or 1
+    checkpoint = Checkpoint(
+        checkpoint_path,
+        {
+            'layer_id': layer_id,
+            'time': time_value,
+            'srid': srid,
+            'zooms': list(zooms),
+            'extension': extension,
+            'bbox': bbox,
+            'polygons':
+                hashlib.md5(json.dumps(polygons).encode('utf-8')).hexdigest(),
+            'chunk_size': chunk_size,
+        }
+    )
+
+    def get_tasks():
+        for zoom in get_seed_zooms(grid, restriction, *zooms):
+            view_args = {
+                'version': '1.0.0',
+                'layer_id': layer_id,
+                'style_name': 'default',
+                'time': time_value,
+                'srid': srid,
+                'zoom': zoom,
+                'extension': extension,
+            }
+            tiles = get_seed_tiles(grid, zoom, metatile, bbox, polygons)
+            logger.info('%d tiles to seed at zoom %d', len(tiles), zoom)
+            for chunk, start in enumerate(range(0, len(tiles), chunk_size)):
+                if checkpoint.is_done(zoom, chunk):
+                    continue
+                yield zoom, chunk, [
+                    get_tile_path(col, row, view_args)
+                    for col, row in tiles[start:start + chunk_size].tolist()
+                ]
+
+    started = time.monotonic()
+    if processes > 1:
+        with multiprocessing.get_context('fork').Pool(
+            processes,
+            initializer=init_seed_worker,
+            initargs=(concurrency, rate / processes, skip_existing)
+        ) as pool:
+            for zoom, chunk, stats in pool.imap_unordered(seed_chunk,
+                                                          get_tasks()):
+                checkpoint.mark_done(zoom, chunk, stats)
+                logger.info('Seeding progress: %s', checkpoint.stats)
+    else:
+        init_seed_worker(concurrency, rate, skip_existing)
+        for task in get_tasks():
+            checkpoint.mark_done(*seed_chunk(task))
+            logger.info('Seeding progress: %s', checkpoint.stats)
+    logger.info(
+        'Seeding done in %.1fs: %s',
+        time.monotonic() - started,
+        checkpoint.stats
+    )
+    return checkpoint.stats
@@ -0,0 +1,240 @@
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+# Index entry: key digest, expiration timestamp, headers length, content length
+INDEX_ENTRY = struct.Struct('16sdII')
+EMPTY_DIGEST = bytes(16)
+# Number of slots per hash set (set associative index)
+WAYS = 4
+LOCK_STRIPES = 16
+# Maximum time [seconds] to wait for a stripe lock, the lookup is then a miss
+LOCK_TIMEOUT = 0.05
+LOCK_RETRY_INTERVAL = 0.001
+
+SHARED_TILE_CACHE = None
+
+
+class SharedTileCache:  # pylint: disable=too-many-instance-attributes
+    '''Tile cache shared between the worker processes
+
+    The cache lives in an anonymous shared memory map that must be created
+    before the workers are forked. The memory is split in a hash index and in
+    fixed size slots (one tile per slot). A tile key is hashed to a set of
+    WAYS slots, when the set is full the entry that expires first is evicted.
+
+    The index and slots are protected by locks striped by hash set, only held
+    while copying the tile in or out of the shared memory (the tiles read are
+    copies). A stripe lock is made of a lock of the process, so the greenlets
+    wait for it cooperatively, and of a fcntl lock of a byte of a lock file
+    shared with the other processes. The latter is polled without blocking
+    the process and is released by the kernel when a worker dies. A lock that
+    can't be acquired within LOCK_TIMEOUT is given up, the lookup being a
+    miss.
+    '''
+
+    def __init__(self, slots, slot_size):
+        self.slots = max(slots - slots % WAYS, WAYS)
+        self.sets = self.slots // WAYS
+        self.slot_size = slot_size
+        self.data_offset = self.slots * INDEX_ENTRY.size
+        self._mmap = mmap.mmap(-1, self.data_offset + self.slots * slot_size)
+        # The (unlinked) lock file is inherited by the forked workers
+        self._lock_file = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+        self._locks = None
+        self._pid = None
+        # Counters are per process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock_timeouts = 0
+
+    def get(self, key):
+        '''Return the cached (content, headers) or None'''
+        digest, set_index = self._hash(key)
+        now = time.time()
+        headers = None
+        content = None
+        stripe = set_index % LOCK_STRIPES
+        if self._acquire(stripe):
+            try:
+                slot = self._find(digest, set_index)
+                if slot is not None:
+                    _, expires, headers_length, content_length = self._read(
+                        slot
+                    )
+                    if expires > now:
+                        offset = self.data_offset + slot * self.slot_size
+                        headers = self._mmap[offset:offset + headers_length]
+                        offset += headers_length
+                        content = self._mmap[offset:offset + content_length]
+            finally:
+                self._release(stripe)
+        if content is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content, json.loads(headers)
+
+    def set(self, key, content, headers, ttl):
+        headers = json.dumps(headers).encode('utf-8')
+        if ttl <= 0 or len(headers) + len(content) > self.slot_size:
+            return False
+        digest, set_index = self._hash(key)
+        now = time.time()
+        stripe = set_index % LOCK_STRIPES
+        if not self._acquire(stripe):
+            return False
+        try:
+            slot = self._find(digest, set_index)
+            if slot is None:
+                slot = self._find_free_slot(set_index, now)
+            offset = self.data_offset + slot * self.slot_size
+            self._mmap[offset:offset + len(headers)] = headers
+            offset += len(headers)
+            self._mmap[offset:offset + len(content)] = content
+            INDEX_ENTRY.pack_into(
+                self._mmap,
+                slot * INDEX_ENTRY.size,
+                digest,
+                now + ttl,
+                len(headers),
+                len(content)
+            )
+        finally:
+            self._release(stripe)
+        return True
+
+    def delete(self, key):
+        digest, set_index = self._hash(key)
+        stripe = set_index % LOCK_STRIPES
+        if not self._acquire(stripe):
+            logger.error('Tile %s not deleted from the shared cache', key)
+            return False
+        try:
+            slot = self._find(digest, set_index)
+            if slot is not None:
+                INDEX_ENTRY.pack_into(
+                    self._mmap, slot * INDEX_ENTRY.size, EMPTY_DIGEST, 0, 0, 0
+                )
+                return True
+        finally:
+            self._release(stripe)
+        return False
+
+    def clear(self):
+        locked = []
+        try:
+            for stripe in range(LOCK_STRIPES):
+                if not self._acquire(stripe):
+                    logger.error('Shared tile cache not cleared')
+                    return False
+                locked.append(stripe)
+            self._mmap[0:self.data_offset] = bytes(self.data_offset)
+            return True
+        finally:
+            for stripe in locked:
+                self._release(stripe)
+
+    def stats(self):
+        return {
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'lock_timeouts': self.lock_timeouts,
+        }
+
+    def _acquire(self, stripe):
+        '''Return True once the stripe is locked or False on timeout'''
+        if self._pid != os.getpid():
+            # The process locks are created in each worker (after the gevent
+            # monkey patching)
+            self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+            self._pid = os.getpid()
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        lock = self._locks[stripe]
+        if lock.acquire(timeout=LOCK_TIMEOUT):
+            while True:
+                try:
+                    fcntl.lockf(
+                        self._lock_file,
+                        fcntl.LOCK_EX | fcntl.LOCK_NB,
+                        1,
+                        stripe
+                    )
+                    return True
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        break
+                    time.sleep(LOCK_RETRY_INTERVAL)
+            lock.release()
+        self.lock_timeouts += 1
+        logger.warning('Shared tile cache lock %d timed out', stripe)
+        return False
+
+    def _release(self, stripe):
+        fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, stripe)
+        self._locks[stripe].release()
+
+    def _hash(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        return digest, int.from_bytes(digest[:8], 'little') % self.sets
+
+    def _read(self, slot):
+        return INDEX_ENTRY.unpack_from(self._mmap, slot * INDEX_ENTRY.size)
+
+    def _find(self, digest, set_index):
+        for slot in range(set_index * WAYS, (set_index + 1) * WAYS):
+            if self._read(slot)[0] == digest:
+                return slot
+        return None
+
+    def _find_free_slot(self, set_index, now):
+        candidate = None
+        candidate_expires = None
+        for slot in range(set_index * WAYS, (set_index + 1) * WAYS):
+            digest, expires, _, _ = self._read(slot)
+            if digest == EMPTY_DIGEST or expires <= now:
+                return slot
+            if candidate is None or expires < candidate_expires:
+                candidate = slot
+                candidate_expires = expires
+        self.evictions += 1
+        return candidate
+
+
+def get_shared_tile_cache():
+    return SHARED_TILE_CACHE
+
+
+def init_shared_tile_cache():
+    '''Create the shared tile cache
+
+    NOTE: This must be called before forking the workers (e.g. in gunicorn
+    on_starting hook) in order to be shared between the workers.
+    '''
+    global SHARED_TILE_CACHE  # pylint: disable=global-statement
+    if settings.SHARED_TILE_CACHE_SLOTS <= 0:
+        logger.debug('Shared tile cache disabled')
+        return
+    SHARED_TILE_CACHE = SharedTileCache(
+        settings.SHARED_TILE_CACHE_SLOTS, settings.SHARED_TILE_CACHE_SLOT_SIZE
+    )
+    logger.info(
+        'Shared tile cache initialized with %d slots of %d bytes',
+        SHARED_TILE_CACHE.slots,
+        SHARED_TILE_CACHE.slot_size
+    )
@@ -0,0 +1,96 @@
+import logging
+import threading
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''Coalesce concurrent identical calls within a worker
+
+    The first caller of a key (the leader) executes the function while the
+    concurrent callers of the same key (the followers) wait for its result.
+    A follower that doesn't get the result within the timeout, or whose
+    leader has been killed, executes the function itself.
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+
+    def do(self, key, func, timeout):
+        '''Execute func or wait for the result of the identical call in flight
+
+        Returns:
+            (result, shared) shared is True when the result comes from the
+            call of another caller
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            self.followers += 1
+            if call.event.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                if call.done:
+                    return call.result, True
+            else:
+                self.timeouts += 1
+                logger.warning(
+                    'Timeout after %ss while waiting for %s, executing it',
+                    timeout,
+                    key
+                )
+            return func(), False
+
+        self.leaders += 1
+        try:
+            call.result = func()
+            call.done = True
+            return call.result, False
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'timeouts': self.timeouts,
+        }
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(key, func):
+    '''Coalesce the identical calls in flight, see SingleFlight
+
+    Returns:
+        (result, shared)
+    '''
+    if settings.SINGLE_FLIGHT_TIMEOUT <= 0:
+        return func(), False
+    return single_flight.do(key, func, settings.SINGLE_FLIGHT_TIMEOUT)
@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app import settings
+from app.helpers.etag_index import etag_index
+from app.helpers.etag_index import index_tile_etag
+from app.helpers.layer_purges import get_tile_purge_time
+from app.helpers.shared_tile_cache import get_shared_tile_cache
+
+logger = logging.getLogger(__name__)
+
+# Headers of a cached tile that are replayed on a cache hit, any other header
+# (e.g. Date or x-amz-request-id) is specific to the original response.
+CACHED_HEADERS = {
+    'content-type': 'Content-Type',
+    'cache-control': 'Cache-Control',
+    'etag': 'ETag',
+    'last-modified': 'Last-Modified',
+}
+
+# Approximate memory overhead of an entry (key, tuple, dict, ...) in bytes
+ENTRY_OVERHEAD = 512
+
+
+class TileCache:  # pylint: disable=too-many-instance-attributes
+    '''In process LRU tile cache bounded by a byte budget
+
+    Each entry has its own time to live; expired entries are dropped on
+    access or evicted like any other entry when the byte budget is exceeded.
+    '''
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.purged = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key, purged=0.0):
+        '''Return the cached (content, headers) or None
+
+        The entry cached before the purged time (unix timestamp) is dropped.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, content, headers, size, cached = entry
+            if expires <= now or cached <= purged:
+                self._remove(key, size)
+                if expires <= now:
+                    self.expirations += 1
+                else:
+                    self.purged += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return content, headers
+
+    def set(self, key, content, headers, ttl):
+        size = len(key) + len(content) + ENTRY_OVERHEAD
+        if not self.enabled or ttl <= 0 or size > self.max_item_bytes:
+            return False
+        expires = time.monotonic() + ttl
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[3]
+            while self._entries and self.size + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[3]
+                self.evictions += 1
+            self._entries[key] = (expires, content, headers, size, time.time())
+            self.size += size
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(key, entry[3])
+                return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'purged': self.purged,
+        }
+
+    def _remove(self, key, size):
+        del self._entries[key]
+        self.size -= size
+
+
+tile_cache = TileCache(
+    settings.TILE_CACHE_MAX_BYTES, settings.TILE_CACHE_MAX_ITEM_BYTES
+)
+
+
+def get_tile_cache_ttl(restriction):
+    '''Return the in memory time to live of a tile in seconds
+
+    This is the layer cache_ttl bounded by TILE_CACHE_MAX_TTL
+    '''
+    cache_ttl = (restriction or {}).get('cache_ttl')
+    if not cache_ttl:
+        return settings.TILE_CACHE_MAX_TTL
+    return min(cache_ttl, settings.TILE_CACHE_MAX_TTL)
+
+
+def get_cached_tile(wmts_path):
+    '''Get a tile from the in memory cache or from the shared memory cache
+
+    Returns:
+        (content, headers) or None if the tile is not in the cache
+    '''
+    if tile_cache.enabled:
+        cached = tile_cache.get(wmts_path, get_tile_purge_time(wmts_path))
+        if cached is not None:
+            logger.debug('Tile %s found in memory cache', wmts_path)
+            content, headers = cached
+            return content, dict(headers)
+    shared_tile_cache = get_shared_tile_cache()
+    if shared_tile_cache is not None:
+        cached = shared_tile_cache.get(wmts_path)
+        if cached is not None:
+            logger.debug('Tile %s found in shared memory cache', wmts_path)
+            return cached
+    return None
+
+
+def cache_tile(wmts_path, content, headers, restriction):
+    '''Put a tile in the in memory cache and in the shared memory cache
+
+    The tile ETag is put in the ETag index as well.
+
+    Args:
+        wmts_path: str
+            Path of the tile (without leading '/')
+        content: bytes
+            Tile content
+        headers: dict
+            Tile headers, only the CACHED_HEADERS are kept
+        restriction: dict
+            Layer WMTS configuration used for the cache_ttl
+    '''
+    if not content:
+        return
+    ttl = get_tile_cache_ttl(restriction)
+    index_tile_etag(wmts_path, headers, ttl)
+    shared_tile_cache = get_shared_tile_cache()
+    if not tile_cache.enabled and shared_tile_cache is None:
+        return
+    cached_headers = {}
+    for name, value in headers.items():
+        # S3 and the WMS don't use the same header names case (ETag/Etag)
+        name = CACHED_HEADERS.get(name.lower())
+        if name:
+            cached_headers[name] = value
+    if tile_cache.set(wmts_path, content, cached_headers, ttl):
+        logger.debug('Tile %s put in memory cache', wmts_path)
+    if shared_tile_cache is not None and shared_tile_cache.set(
+        wmts_path, content, cached_headers, ttl
+    ):
+        logger.debug('Tile %s put in shared memory cache', wmts_path)
+
+
+def evict_cached_tile(wmts_path):
+    '''Remove a tile from the in memory cache, the shared memory cache and
+    the ETag index
+
+    NOTE: only the in memory cache and ETag index of the current worker are
+    evicted, the other workers of the node drop their copies once the layer
+    is marked as purged (see app.helpers.layer_purges).
+
+    Returns:
+        True if the tile was in one of the caches
+    '''
+    evicted = tile_cache.delete(wmts_path)
+    evicted = etag_index.delete(wmts_path) or evicted
+    shared_tile_cache = get_shared_tile_cache()
+    if shared_tile_cache is not None:
+        evicted = shared_tile_cache.delete(wmts_path) or evicted
+    return evicted
@@ -1,8 +1,11 @@
+import functools
 import hashlib
 import logging
 import math
 import re
 from datetime import datetime
+from datetime import timezone
+from email.utils import parsedate_to_datetime
 
 from gatilegrid import getTileGrid
 from pyproj import Proj
@@ -11,6 +14,7 @@ from pyproj import transform
 from flask import jsonify
 from flask import make_response
 
+from app.helpers.grids import get_tile_grid
 from app.settings import GET_TILE_BROWSER_CACHE_MAX_TTL
 from app.settings import GET_TILE_CACHE_TEMPLATE
 
@@ -50,6 +54,18 @@ def digest(data):
     return hashlib.md5(data).hexdigest()
 
 
+def get_header(headers, name):
+    '''Return the value of a header looked up case-insensitively
+
+    S3 and the WMS don't use the same header names case (e.g. ETag/Etag).
+    '''
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
 dateRe = re.compile(r'expiry-date="(.*)GMT"')
 
 
@@ -58,6 +74,41 @@ def is_still_valid_tile(exp_header, current_time):
     return current_time < datetime.strptime(expiration, '%d %b %Y %H:%M:%S')
 
 
+def is_stale_tile(headers, cache_ttl, now=None):
+    '''Return True if a S3 tile is older than its cache time to live
+
+    A tile is stale when its S3 Last-Modified date is older than cache_ttl
+    seconds or when its S3 lifecycle expiration date (x-amz-expiration
+    header) is past.
+
+    Args:
+        headers: dict
+            S3 response headers
+        cache_ttl: int
+            Layer cache time to live in seconds
+        now: datetime
+            Current time (timezone aware), default to now
+    '''
+    now = now or datetime.now(timezone.utc)
+    headers = {name.lower(): value for name, value in headers.items()}
+    expiration = headers.get('x-amz-expiration')
+    try:
+        if expiration and \
+                not is_still_valid_tile(expiration, now.replace(tzinfo=None)):
+            return True
+    except (AttributeError, IndexError, ValueError):
+        logger.warning('Invalid S3 expiration header: %s', expiration)
+    last_modified = headers.get('last-modified')
+    if not cache_ttl or not last_modified:
+        return False
+    try:
+        modified = parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        logger.warning('Invalid S3 Last-Modified header: %s', last_modified)
+        return False
+    return (now - modified).total_seconds() > cache_ttl
+
+
 def set_cache_control(headers, restriction):
     cache_ttl = restriction.get('cache_ttl')
     if cache_ttl:
@@ -77,13 +128,15 @@ def resolution_factor_at_latitude(latitude):
 
 # Zoom is defined at the Equator for WebMercator, layer defined at the
 # latitude of Switzerland have to be corrected.
+@functools.lru_cache(maxsize=4096)
 def get_closest_zoom(resolution, epsg, latitude=0.0):
     if int(epsg) == 3857:
         resolution /= resolution_factor_at_latitude(latitude)
-    tilegrid = getTileGrid(int(epsg))()
-    return tilegrid.getClosestZoom(float(resolution))
+    return get_tile_grid(int(epsg)).getClosestZoom(float(resolution))
 
 
+# NOTE: the returned tile matrix set is shared and must not be modified
+@functools.lru_cache(maxsize=16)
 def get_default_tile_matrix_set(epsg):
     tilematrix_set = {}
 
@@ -0,0 +1,223 @@
+import io
+import logging
+
+from PIL import Image
+from PIL import features
+
+from flask import abort
+from flask import request
+
+from app import settings
+from app.app import app
+from app.helpers.etag_index import etag_matches
+from app.helpers.image_pool import run_in_image_pool
+from app.helpers.s3 import get_s3_file
+from app.helpers.s3_write_queue import queue_s3_file
+from app.helpers.single_flight import coalesce
+from app.helpers.tile_cache import cache_tile
+from app.helpers.tile_cache import get_cached_tile
+from app.helpers.utils import digest
+from app.helpers.utils import get_header
+from app.helpers.utils import set_cache_control
+from app.helpers.wmts import get_coalescing_key
+from app.helpers.wmts import prepare_wmts_cached_response
+from app.helpers.wmts import prepare_wmts_memory_cached_response
+from app.helpers.wmts import prepare_wmts_response
+from app.helpers.wmts import validate_restriction
+from app.helpers.wmts import validate_wmts_request
+from app.helpers.wmts_config import get_wmts_config_by_layer
+
+logger = logging.getLogger(__name__)
+
+# Formats of the tile variants transcoded from the PNG/JPEG tiles (masters)
+VARIANT_MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+MASTER_FORMATS = ('png', 'jpeg')
+
+
+def get_variant_formats():
+    '''Return the enabled variant formats supported by PIL, by preference'''
+    return tuple(
+        extension for extension in settings.TILE_VARIANT_FORMATS
+        if extension in VARIANT_MIME_TYPES and features.check(extension)
+    )
+
+
+def negotiate_variant():
+    '''Return the preferred variant format accepted by the client or None
+
+    Only the formats explicitly listed in the Accept header are considered,
+    a */* or image/* doesn't mean that the client can decode them.
+    '''
+    accepted = {
+        mimetype for mimetype, quality in request.accept_mimetypes
+        if quality > 0
+    }
+    for extension in get_variant_formats():
+        if VARIANT_MIME_TYPES[extension] in accepted:
+            return extension
+    return None
+
+
+def get_tile_variant():
+    '''Return the variant format to serve for the requested tile or None
+
+    A variant is served when explicitly requested (e.g. .webp) or, with
+    TILE_FORMAT_NEGOTIATION, for a PNG/JPEG tile when accepted by the client.
+    '''
+    extension = request.view_args['extension']
+    if extension in get_variant_formats():
+        return extension
+    if settings.TILE_FORMAT_NEGOTIATION and extension in MASTER_FORMATS:
+        return negotiate_variant()
+    return None
+
+
+def is_negotiated_format():
+    '''Return True if the response format depends on the Accept header'''
+    return settings.TILE_FORMAT_NEGOTIATION and \
+        request.view_args['extension'] in MASTER_FORMATS
+
+
+def get_master_extension(restriction):
+    '''Return the format of the tile the variants are transcoded from'''
+    for extension in MASTER_FORMATS:
+        if extension in restriction['formats']:
+            return extension
+    return None
+
+
+def replace_extension(wmts_path, extension):
+    return f'{wmts_path.rsplit(".", 1)[0]}.{extension}'
+
+
+def transcode_tile(content, extension):
+    '''Transcode a PNG/JPEG tile into a variant format
+
+    PNG tiles are transcoded losslessly in WebP, the lossless WebP of a PNG
+    tile is smaller than the lossy one for the sparse tiles with alpha.
+    '''
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(content)) as img:
+        lossless = img.format == 'PNG'
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        if extension == 'webp':
+            if lossless:
+                img.save(out, format='WEBP', lossless=True)
+            else:
+                img.save(out, format='WEBP', quality=settings.TILE_WEBP_QUALITY)
+        else:
+            img.save(out, format='AVIF', quality=settings.TILE_AVIF_QUALITY)
+    return out.getvalue()
+
+
+def get_master_tile(master_path, mode):
+    '''Return the master tile from the caches, S3 or the WMS
+
+    The master tile is looked up and rendered as if it was requested, a
+    rendered master tile is cached and written to S3 like any tile.
+
+    Returns:
+        (status_code, content, headers, write_s3) write_s3 is True if the
+        tiles of this tile matrix are cached on S3
+    '''
+    with app.test_request_context(
+        f'/{master_path}', query_string=request.query_string
+    ):
+        gagrid, _ = validate_wmts_request()
+        restriction, _, write_s3 = validate_restriction(gagrid)
+        write_s3 = bool(write_s3) and mode != 'preview'
+        if mode != 'preview':
+            cached = get_cached_tile(master_path)
+            if cached is not None:
+                status_code, content, headers = \
+                    prepare_wmts_memory_cached_response(cached, None)
+                return status_code, content, headers, write_s3
+            s3_resp, content = get_s3_file(master_path)
+            if s3_resp and s3_resp.status == 200:
+                status_code, content, headers = prepare_wmts_cached_response(
+                    s3_resp, content
+                )
+                cache_tile(master_path, content, headers, restriction)
+                return status_code, content, headers, write_s3
+        status_code, content, headers, on_close = prepare_wmts_response(
+            mode, None
+        )
+        if on_close:
+            on_close()
+            cache_tile(master_path, content, headers, restriction)
+        return status_code, content, headers, write_s3
+
+
+def render_variant_tile(mode, variant, variant_path, restriction):
+    '''Transcode the master tile into a variant and queue it for S3
+
+    Returns:
+        (status_code, content, headers)
+    '''
+    master_extension = get_master_extension(restriction)
+    if master_extension is None:
+        abort(400, f'No PNG/JPEG tiles to transcode to {variant}')
+    status_code, content, headers, write_s3 = get_master_tile(
+        replace_extension(variant_path, master_extension), mode
+    )
+    if status_code != 200 or not content:
+        return status_code, content, headers
+    content = run_in_image_pool(transcode_tile, content, variant)
+    headers = {
+        'Content-Type': VARIANT_MIME_TYPES[variant],
+        'Etag': f'"{digest(content)}"',
+        'X-Tiles-S3-Cache': 'miss',
+        'X-Tiles-Variant': f'transcoded from {master_extension}',
+    }
+    set_cache_control(headers, restriction)
+    if write_s3:
+        headers['X-Tiles-S3-Cache-Write'] = 'write tile to S3 cache'
+        queue_s3_file(content, variant_path, headers)
+        cache_tile(variant_path, content, headers, restriction)
+    return status_code, content, headers
+
+
+def prepare_wmts_variant_response(mode, etag, variant):
+    '''Return the variant of the requested tile
+
+    The variant has its own key in the caches and on S3, on a miss it is
+    transcoded once (concurrent requests are coalesced) from the master tile.
+
+    Returns:
+        (status_code, content, headers)
+    '''
+    layer_id = request.view_args['layer_id']
+    variant_path = replace_extension(request.path.lstrip('/'), variant)
+    if mode != 'preview':
+        cached = get_cached_tile(variant_path)
+        if cached is not None:
+            return prepare_wmts_memory_cached_response(cached, etag)
+        s3_resp, content = get_s3_file(variant_path, etag)
+        if s3_resp:
+            status_code, content, headers = prepare_wmts_cached_response(
+                s3_resp, content, etag
+            )
+            if status_code == 200:
+                cache_tile(
+                    variant_path,
+                    content,
+                    headers,
+                    get_wmts_config_by_layer(layer_id)
+                )
+            return status_code, content, headers
+
+    restriction = get_wmts_config_by_layer(layer_id)
+    if restriction is None:
+        abort(400, f'Unsupported Layer {layer_id}')
+    (status_code, content, headers), coalesced = coalesce(
+        f'variant:{get_coalescing_key(mode, variant_path)}',
+        lambda: render_variant_tile(mode, variant, variant_path, restriction)
+    )
+    if coalesced:
+        headers = dict(headers)
+        headers.pop('X-Tiles-S3-Cache-Write', None)
+        headers['X-Tiles-Coalesced'] = 'hit'
+    if etag_matches(etag, get_header(headers, 'ETag')):
+        return 304, None, headers
+    return status_code, content, headers
@@ -1,29 +1,187 @@
+import json
 import logging
+import random
+import time
+from fnmatch import fnmatchcase
 
 import requests
 import requests.exceptions
 
 from flask import abort
+from flask import g
 from flask import request
 
 from app import settings
+from app.helpers.render_scheduler import scheduled_render
+from app.helpers.wms_guard import backend_guards
+from app.helpers.wms_guard import cache_wms_error
+from app.helpers.wms_guard import get_backend_guard
+from app.helpers.wms_guard import get_cached_wms_error
 
 logger = logging.getLogger(__name__)
 
-req_session = requests.Session()
-req_session.mount(
-    'http://',
-    requests.adapters.HTTPAdapter(
-        pool_connections=settings.WMS_BACKEND_POOL_CONNECTION,
-        pool_maxsize=settings.WMS_BACKEND_POOL_MAXSIZE,
-        pool_block=settings.WMS_BACKEND_POOL_BLOCK,
-        max_retries=settings.WMS_BACKEND_CONNECTION_MAX_RETRY
+# Smoothing factor of the backend response time moving average
+LATENCY_SMOOTHING = 0.2
+
+
+def create_backend_session():
+    session = requests.Session()
+    session.mount(
+        'http://',
+        requests.adapters.HTTPAdapter(
+            pool_connections=settings.WMS_BACKEND_POOL_CONNECTION,
+            pool_maxsize=settings.WMS_BACKEND_POOL_MAXSIZE,
+            pool_block=settings.WMS_BACKEND_POOL_BLOCK,
+            max_retries=settings.WMS_BACKEND_CONNECTION_MAX_RETRY
+        )
     )
-)
+    return session
+
+
+req_session = create_backend_session()
+
+
+def get_backend(url, session=None, **kwargs):
+    return (session or req_session).get(url, **kwargs)
+
+
+class WmsBackend:  # pylint: disable=too-many-instance-attributes
+    '''WMS backend with its own connection pool and passive health check
+
+    After WMS_BACKEND_EJECT_FAILURES consecutive failures (timeouts,
+    connection errors, 5xx) the backend is ejected, i.e. not selected, during
+    WMS_BACKEND_EJECT_TIME seconds.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.session = create_backend_session()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.latency = 0.0
+
+    def is_ejected(self, now):
+        return now < self.ejected_until
+
+    def start(self):
+        self.outstanding += 1
+        self.requests += 1
+
+    def done(self, latency, success):
+        self.outstanding -= 1
+        self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if success:
+            self.consecutive_failures = 0
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= settings.WMS_BACKEND_EJECT_FAILURES:
+            if not self.is_ejected(time.monotonic()):
+                logger.error(
+                    'WMS backend %s ejected after %d failures',
+                    self.url,
+                    self.consecutive_failures
+                )
+                self.ejections += 1
+            self.ejected_until = time.monotonic(
+            ) + settings.WMS_BACKEND_EJECT_TIME
+
+    def stats(self):
+        return {
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejected': self.is_ejected(time.monotonic()),
+            'ejections': self.ejections,
+            'latency': round(self.latency, 3),
+        }
+
+
+def parse_backend_affinity(value):
+    '''Parse the WMS backend affinity rules
+
+    Args:
+        value: str
+            JSON object of layer id patterns (fnmatch) to lists of WMS backend
+            URLs, e.g. {"ch.swisstopo.swissimage*": ["http://wms-2/mapserv"]}
+
+    Returns:
+        The list of (pattern, urls), the first matching pattern is used
+
+    Raises:
+        ValueError if the rules are invalid
+    '''
+    if not value:
+        return []
+    rules = json.loads(value)
+    if not isinstance(rules, dict) or not all(
+        isinstance(urls, list) and urls and
+        all(isinstance(url, str) for url in urls) for urls in rules.values()
+    ):
+        raise ValueError(f'Invalid WMS backend affinity: {value}')
+    return list(rules.items())
+
 
+class WmsBackendPool:
+    '''Pool of WMS backends balancing the renders
 
-def get_backend(url, **kwargs):
-    return req_session.get(url, **kwargs)
+    A render is sent to the backends of the first affinity rule matching its
+    layer, or else to the default backends. Among the backends not ejected,
+    two are picked at random and the one with the least outstanding requests
+    is used (power of two choices). When all the backends are ejected, they
+    are all used anyway.
+    '''
+
+    def __init__(self, urls, affinity):
+        self.backends = {}
+        self.default = [self._get_backend(url) for url in urls]
+        self.affinity = [
+            (pattern, [self._get_backend(url)
+                       for url in affinity_urls])
+            for pattern, affinity_urls in affinity
+        ]
+
+    def _get_backend(self, url):
+        if url not in self.backends:
+            self.backends[url] = WmsBackend(url)
+        return self.backends[url]
+
+    def get_candidates(self, layer_id):
+        for pattern, backends in self.affinity:
+            if fnmatchcase(layer_id, pattern):
+                return backends
+        return self.default
+
+    def select(self, layer_id):
+        candidates = self.get_candidates(layer_id)
+        now = time.monotonic()
+        healthy = [
+            backend for backend in candidates if not backend.is_ejected(now)
+        ] or candidates
+        if len(healthy) == 1:
+            return healthy[0]
+        first, second = random.sample(healthy, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+    def stats(self):
+        return {
+            url: {
+                **backend.stats(),
+                'guard':
+                    backend_guards[url].stats()
+                    if url in backend_guards else None
+            } for url, backend in self.backends.items()
+        }
+
+
+wms_backend_pool = WmsBackendPool(
+    settings.WMS_BACKENDS,
+    parse_backend_affinity(settings.WMS_BACKEND_AFFINITY)
+)
 
 
 def get_wms_params(bbox, gutter, width=256, height=256):
@@ -44,40 +202,83 @@ def get_wms_params(bbox, gutter, width=256, height=256):
     }
 
 
-def get_wms_resource(bbox, gutter, width=256, height=256):
+def get_wms_resource(bbox, gutter, width=256, height=256, backend=None):
+    if backend is None:
+        backend = wms_backend_pool.select(request.view_args['layer_id'])
     params = get_wms_params(bbox, gutter, width, height)
     logger.debug(
         'Fetching wms image: %s?%s',
-        settings.WMS_BACKEND,
+        backend.url,
         '&'.join([f'{k}={v}' for k, v in params.items()])
     )
-    return get_wms_image(settings.WMS_BACKEND, params)
+    return get_wms_image(backend.url, params, backend.session)
 
 
-def get_wms_image(wms_url, params):
-    return get_backend(wms_url, params=params)
+def get_wms_image(wms_url, params, session=None):
+    return get_backend(
+        wms_url,
+        session=session,
+        params=params,
+        timeout=settings.WMS_BACKEND_TIMEOUT
+    )
 
 
-def get_wms_backend_readiness():
+def get_wms_backend_ready_urls():
+    '''Return the readiness URLs of the WMS backends of the pool, the
+    backends not ejected first
+
+    The WMS_HOST/WMS_PORT backend is checked on its readiness probe, the other
+    mapserv URLs are requested without query string.
+    '''
+    now = time.monotonic()
+    backends = sorted(
+        wms_backend_pool.backends.values(),
+        key=lambda backend: backend.is_ejected(now)
+    )
+    return [
+        settings.WMS_BACKEND_READY
+        if backend.url == settings.WMS_BACKEND else backend.url
+        for backend in backends
+    ]
+
+
+def get_wms_backend_readiness(url):
+    '''Return the content of the WMS backend readiness answer or None if the
+    backend cannot be reached
+    '''
     try:
-        response = get_backend(settings.WMS_BACKEND_READY)
+        response = get_backend(url)
     except (
         requests.exceptions.Timeout,
         requests.exceptions.SSLError,
         requests.exceptions.ConnectionError
     ) as error:
-        logger.error(
-            'Cannot connect to backend WMS %s: %s',
-            settings.WMS_BACKEND_READY,
-            error
-        )
-        abort(502, 'Cannot connect to backend WMS')
+        logger.error('Cannot connect to backend WMS %s: %s', url, error)
+        return None
     return response.content
 
 
-def get_wms_tile(bbox, gutter):
+def request_wms_tile(bbox, gutter, width=256, height=256):
+    '''Request a tile to a WMS backend of the pool, through its guard if
+    enabled
+
+    Returns:
+        (response, content_type)
+    '''
+    backend = wms_backend_pool.select(request.view_args['layer_id'])
+    guard = get_backend_guard(backend.url)
+    if guard is not None and not guard.acquire():
+        logger.warning(
+            'WMS backend %s overloaded: %s', backend.url, guard.stats()
+        )
+        g.wms_backend_overloaded = True
+        abort(503, 'WMS backend overloaded, please retry later')
+    backend.start()
+    started = time.monotonic()
+    success = False
     try:
-        response = get_wms_resource(bbox, gutter)
+        response = get_wms_resource(bbox, gutter, width, height, backend)
+        success = response.status_code < 500
         content_type = response.headers.get('Content-Type', 'text/xml')
         logger.debug(
             'WMS response %s; content-type: %s, content: %s',
@@ -94,6 +295,23 @@ def get_wms_tile(bbox, gutter):
     except requests.exceptions.ConnectionError as error:
         logger.error(error, exc_info=True)
         abort(502, 'Bad Gateway')
+    finally:
+        latency = time.monotonic() - started
+        backend.done(latency, success)
+        if guard is not None:
+            guard.release(latency, success)
+    return response, content_type
+
+
+def get_wms_tile(bbox, gutter, width=256, height=256):
+    params = get_wms_params(bbox, gutter, width, height)
+    cached_error = get_cached_wms_error(params)
+    if cached_error is not None:
+        logger.debug('WMS error found in the WMS error cache')
+        abort(501, cached_error)
+
+    with scheduled_render():
+        response, content_type = request_wms_tile(bbox, gutter, width, height)
 
     # Detect/Create transparent images
     if 'text/xml' in content_type:
@@ -103,6 +321,8 @@ def get_wms_tile(bbox, gutter):
             content_type,
             extra={"wms_response": response.text}
         )
-        abort(501, f'Unable to process the request: {response.content}')
+        description = f'Unable to process the request: {response.content}'
+        cache_wms_error(params, description)
+        abort(501, description)
 
     return response
@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+
+from app import settings
+from app.helpers.tile_cache import TileCache
+
+logger = logging.getLogger(__name__)
+
+# Multiplicative decrease of the concurrency limit when the backend is slow
+# or fails
+LIMIT_SLOW_BACKOFF = 0.9
+LIMIT_FAILURE_BACKOFF = 0.5
+
+# Byte budget of the WMS error cache
+WMS_ERROR_CACHE_MAX_BYTES = 1048576
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class AdaptiveLimiter:
+    '''AIMD concurrency limit of the requests to a backend
+
+    The limit grows by about one per limit requests answered within the
+    latency target and shrinks multiplicatively when a request is slower
+    than the target or fails. Requests over the limit are rejected instead of
+    piling up on a backend which is already slowing down.
+    '''
+
+    def __init__(self, initial, minimum, maximum, latency):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if self.in_flight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency, success):
+        self.in_flight -= 1
+        if not success:
+            self.limit = max(self.minimum, self.limit * LIMIT_FAILURE_BACKOFF)
+        elif latency > self.latency:
+            self.limit = max(self.minimum, self.limit * LIMIT_SLOW_BACKOFF)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+        }
+
+
+class CircuitBreaker:  # pylint: disable=too-many-instance-attributes
+    '''Circuit breaker of the requests to a backend
+
+    After `failures` consecutive failures the circuit opens and all requests
+    are rejected during `reset_timeout` seconds. Then it is half-open, a
+    single probe request is let through; its success closes the circuit, its
+    failure opens it again.
+    '''
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probing:
+                self.rejected += 1
+                return False
+            self.probing = True
+        return True
+
+    def release(self, success):
+        probe, self.probing = self.probing, False
+        if success:
+            self.consecutive_failures = 0
+            if probe:
+                logger.info('Circuit breaker closed')
+                self.state = CLOSED
+            return
+        self.consecutive_failures += 1
+        if probe or self.consecutive_failures >= self.failures:
+            if self.state != OPEN:
+                logger.error(
+                    'Circuit breaker opened after %d failures',
+                    self.consecutive_failures
+                )
+                self.opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+class BackendGuard:
+    '''Concurrency limit and circuit breaker of a backend (per worker)'''
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self.limiter = AdaptiveLimiter(
+            settings.WMS_LIMIT_INITIAL,
+            settings.WMS_LIMIT_MIN,
+            settings.WMS_LIMIT_MAX,
+            settings.WMS_LIMIT_LATENCY
+        )
+        self.breaker = CircuitBreaker(
+            settings.WMS_BREAKER_FAILURES, settings.WMS_BREAKER_RESET_TIMEOUT
+        )
+
+    def acquire(self):
+        '''Return True if a request can be sent to the backend
+
+        The caller must then call release() once the request is done.
+        '''
+        with self._lock:
+            if not self.breaker.acquire():
+                return False
+            if not self.limiter.acquire():
+                # the probe (if any) is not sent
+                self.breaker.probing = False
+                return False
+            return True
+
+    def release(self, latency, success):
+        with self._lock:
+            self.limiter.release(latency, success)
+            self.breaker.release(success)
+
+    def stats(self):
+        with self._lock:
+            return {**self.limiter.stats(), 'breaker': self.breaker.stats()}
+
+
+backend_guards = {}
+wms_error_cache = TileCache(
+    WMS_ERROR_CACHE_MAX_BYTES, WMS_ERROR_CACHE_MAX_BYTES
+)
+
+
+def get_backend_guard(url):
+    '''Return the guard of a backend or None if WMS_BACKEND_GUARD is disabled
+    '''
+    if not settings.WMS_BACKEND_GUARD:
+        return None
+    guard = backend_guards.get(url)
+    if guard is None:
+        guard = backend_guards.setdefault(url, BackendGuard(url))
+    return guard
+
+
+def get_wms_error_key(params):
+    return '&'.join(f'{key}={value}' for key, value in sorted(params.items()))
+
+
+def get_cached_wms_error(params):
+    '''Return the cached description of a WMS error for these params or None
+    '''
+    if settings.WMS_ERROR_CACHE_TTL <= 0:
+        return None
+    cached = wms_error_cache.get(get_wms_error_key(params))
+    return None if cached is None else cached[0]
+
+
+def cache_wms_error(params, description):
+    if settings.WMS_ERROR_CACHE_TTL > 0:
+        wms_error_cache.set(
+            get_wms_error_key(params),
+            description, {},
+            settings.WMS_ERROR_CACHE_TTL
+        )
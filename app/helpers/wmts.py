@@ -1,24 +1,47 @@
 import io
 import logging
+import threading
+import time
 from time import perf_counter
 
-from gatilegrid import getTileGrid
 from PIL import Image
 
 from flask import abort
+from flask import g
 from flask import request
 
 from app import settings
-from app.helpers.s3 import put_s3_file
+from app.helpers.blank_tile import BLANK_TILE_S3_HEADER
+from app.helpers.blank_tile import find_blank_tile
+from app.helpers.blank_tile import get_blank_tile
+from app.helpers.blank_tile import get_blank_tile_name
+from app.helpers.blank_tile import lookup_blank_tile
+from app.helpers.etag_index import etag_matches
+from app.helpers.grids import TILE_GRIDS
+from app.helpers.grids import get_tile_grid
+from app.helpers.image_pool import hash_in_image_pool
+from app.helpers.image_pool import run_in_image_pool
+from app.helpers.png_profile import encode_png
+from app.helpers.render_lease import acquire_render_lease
+from app.helpers.render_lease import is_render_lease_held
+from app.helpers.render_lease import release_render_lease
+from app.helpers.s3 import get_s3_file
+from app.helpers.s3_write_queue import queue_s3_file
+from app.helpers.single_flight import coalesce
+from app.helpers.tile_cache import get_cached_tile
 from app.helpers.utils import crop_image
 from app.helpers.utils import digest
 from app.helpers.utils import extend_bbox
+from app.helpers.utils import get_header
 from app.helpers.utils import set_cache_control
 from app.helpers.wms import get_wms_tile
 from app.helpers.wmts_config import get_wmts_config_by_layer
 
 logger = logging.getLogger(__name__)
 
+SUPPORTED_EPSG = list(TILE_GRIDS)
+SUPPORTED_LANGS = ['de', 'fr', 'it', 'rm', 'en']
+
 
 def validate_version():
     if request.view_args['version'] != '1.0.0':
@@ -29,26 +52,48 @@ def validate_version():
 
 
 def validate_epsg(epsg):
-    supported_epsg = [21781, 2056, 3857, 4326]
-    try:
-        getTileGrid(epsg)()
-    except AssertionError as error:
-        logger.error('Unsupported epsg %s: %s', epsg, error)
-        abort(400, f'Unsupported epsg {epsg}, must be on of {supported_epsg}')
+    if epsg not in TILE_GRIDS:
+        logger.error('Unsupported epsg %s', epsg)
+        abort(400, f'Unsupported epsg {epsg}, must be on of {SUPPORTED_EPSG}')
 
 
 def validate_lang(lang):
-    languages = ['de', 'fr', 'it', 'rm', 'en']
-    if lang not in languages:
+    if lang not in SUPPORTED_LANGS:
         logger.error('Unsupported lang %s', lang)
-        abort(400, f'Unsupported lang {lang}, must be on of {languages}')
+        abort(400, f'Unsupported lang {lang}, must be on of {SUPPORTED_LANGS}')
 
 
-def prepare_wmts_cached_response(s3_resp):
-    headers = dict(s3_resp.getheaders())
+def prepare_wmts_cached_response(s3_resp, content, etag=None):
+    headers = {}
+    blank = None
+    for name, value in s3_resp.getheaders():
+        if name.lower() == BLANK_TILE_S3_HEADER:
+            blank = value
+        headers[name] = value
     headers['X-Tiles-S3-Cache'] = 'hit'
 
-    return s3_resp.status, headers
+    if blank and s3_resp.status == 200:
+        # S3 marker object of a blank tile, the tile is served from memory
+        content = get_blank_tile(blank)
+        for name in list(headers):
+            if name.lower() in ('etag', 'content-length'):
+                del headers[name]
+        headers['ETag'] = f'"{digest(content)}"'
+        headers['Content-Length'] = str(len(content))
+        headers['X-Tiles-Blank'] = blank
+        if etag_matches(etag, headers['ETag']):
+            return 304, None, headers
+    return s3_resp.status, content, headers
+
+
+def prepare_wmts_memory_cached_response(cached, etag):
+    content, headers = cached
+    headers['X-Tiles-S3-Cache'] = 'hit'
+    headers['X-Tiles-Memory-Cache'] = 'hit'
+    g.setdefault('from_memory_cache', True)
+    if etag_matches(etag, get_header(headers, 'ETag')):
+        return 304, None, headers
+    return 200, content, headers
 
 
 def validate_wmts_mode():
@@ -63,6 +108,43 @@ def validate_wmts_mode():
     return mode
 
 
+def get_tile_address():
+    '''Return the requested tile address (col, row) in the tile grid order
+
+    NOTE: for EPSG:21781 the col and row are swapped in the request path.
+    '''
+    col = request.view_args['col']
+    row = request.view_args['row']
+    if request.view_args['srid'] == 21781:
+        row, col = col, row
+    return col, row
+
+
+def get_tile_path(col, row, view_args=None):
+    '''Return the wmts path (S3 key) of a tile of the requested tile matrix
+
+    Args:
+        col: int
+            Tile column in the tile grid order
+        row: int
+            Tile row in the tile grid order
+        view_args: dict
+            Tile matrix (version, layer_id, style_name, time, srid, zoom and
+            extension), default to the request one
+
+    Returns:
+        The wmts path without leading '/'
+    '''
+    view_args = view_args or request.view_args
+    if view_args['srid'] == 21781:
+        col, row = row, col
+    return (
+        f'{view_args["version"]}/{view_args["layer_id"]}/'
+        f'{view_args["style_name"]}/{view_args["time"]}/{view_args["srid"]}/'
+        f'{view_args["zoom"]}/{col}/{row}.{view_args["extension"]}'
+    )
+
+
 def validate_wmts_request():
     validate_version()
 
@@ -95,25 +177,18 @@ def validate_wmts_request():
         )
 
     srid = request.view_args['srid']
-    col = request.view_args['col']
-    row = request.view_args['row']
-    if srid == 21781:
-        row, col = col, row
+    col, row = get_tile_address()
 
-    try:
-        gagrid = getTileGrid(srid)()
-    except AssertionError as error:
-        logger.error('Unsupported srid %s: %s', srid, error)
+    gagrid = get_tile_grid(srid)
+    if gagrid is None:
+        logger.error('Unsupported srid %s', srid)
         abort(400, f'Unsupported srid {srid}')
 
-    try:
-        bbox = gagrid.tileBounds(request.view_args['zoom'], col, row)
-    except AssertionError as error:
+    if not gagrid.is_valid_zoom(request.view_args['zoom']):
         zoom = request.view_args['zoom']
-        logger.error(
-            'Unsupported zoom level %s for srid %s: %s', zoom, srid, error
-        )
+        logger.error('Unsupported zoom level %s for srid %s', zoom, srid)
         abort(400, f'Unsupported zoom level {zoom} for srid {srid}')
+    bbox = gagrid.tileBounds(request.view_args['zoom'], col, row)
 
     if not gagrid.intersectsExtent(bbox):
         zoom = request.view_args['zoom']
@@ -184,46 +259,208 @@ def validate_restriction(gagrid):
     return restriction, gutter, write_s3
 
 
-def optimize_image(content, gutter):
+def optimize_image(content, gutter, png_profile=None):
+    '''Crop the gutter of a PNG tile and encode it with the layer PNG profile
+    '''
     logger.debug('Cropping tile to gutter %d', gutter)
     with Image.open(io.BytesIO(content)) as img:
-        img = crop_image(img, gutter)
-        out = io.BytesIO()
-        img.save(out, format='PNG')
-        content = out.getvalue()
+        if gutter > 0:
+            img = crop_image(img, gutter)
+        content = encode_png(img, png_profile)
     return content
 
 
-def get_optimized_tile(bbox, gutter):
+def split_metatile(content, address, gutter, tile_size, png_profile=None):
+    '''Split a metatile image into its tiles
+
+    Args:
+        content: bytes
+            Metatile image rendered with a gutter
+        address: list
+            Metatile tile range [min_col, min_row, max_col, max_row]
+        gutter: int
+            Gutter in pixel around the metatile
+        tile_size: int
+            Tile size in pixel
+        png_profile: dict
+            Layer PNG encoding profile (see app.helpers.png_profile)
+
+    Returns:
+        dict of (col, row) => tile image content
+    '''
+    min_col, min_row, max_col, max_row = address
+    extension = request.view_args['extension']
+    tiles = {}
+    with Image.open(io.BytesIO(content)) as img:
+        img.load()
+        for col in range(min_col, max_col + 1):
+            for row in range(min_row, max_row + 1):
+                left = gutter + (col - min_col) * tile_size
+                upper = gutter + (row - min_row) * tile_size
+                tile = img.crop(
+                    (left, upper, left + tile_size, upper + tile_size)
+                )
+                blank = settings.BLANK_TILE_DEDUP and get_blank_tile_name(
+                    tile, extension
+                )
+                if blank:
+                    tiles[(col, row)] = get_blank_tile(blank)
+                    continue
+                if extension == 'jpeg':
+                    out = io.BytesIO()
+                    tile.save(
+                        out,
+                        format='JPEG',
+                        quality=settings.WMS_METATILE_JPEG_QUALITY
+                    )
+                    tiles[(col, row)] = out.getvalue()
+                else:
+                    tiles[(col, row)] = encode_png(tile, png_profile)
+    return tiles
+
+
+def get_wms_bbox(gagrid, bbox, gutter):
+    shift = gagrid.RESOLUTIONS[request.view_args['zoom']] * gutter
+    bbox = extend_bbox(bbox, shift)
+    if request.view_args['srid'] == 4326:
+        bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+    return bbox
+
+
+def get_optimized_tile(bbox, gutter, png_profile=None):
     start = perf_counter()
     response = get_wms_tile(bbox, gutter)
 
     # Optimize images if needed
     content = response.content
+    headers = response.headers
     content_type = response.headers['Content-Type']
-    if (
-        response.ok and response.content and content_type == 'image/png' and
-        request.view_args['extension'] == 'png' and gutter > 0
+    extension = request.view_args['extension']
+    is_image = response.ok and response.content and \
+        content_type == f'image/{extension}'
+    blank = None
+    if is_image and settings.BLANK_TILE_DEDUP and (
+        extension == 'png' or gutter == 0
     ):
-        content = optimize_image(content, gutter)
+        blank = run_in_image_pool(find_blank_tile, content, extension, gutter)
+    if blank:
+        content = get_blank_tile(blank)
+        # The WMS Etag, if any, is the one of the rendered image
+        headers = {'Content-Type': content_type}
+    elif is_image and extension == 'png' and (gutter > 0 or png_profile):
+        content = run_in_image_pool(
+            optimize_image, content, gutter, png_profile
+        )
     tile_generation_time = perf_counter() - start
     return (
         response.status_code,
         content,
-        response.headers,
+        headers,
         response.elapsed.total_seconds(),
         tile_generation_time
     )
 
 
+def get_metatile_size(restriction, write_s3, mode):
+    metatile = min(
+        restriction.get('wms_metatile') or 1, settings.WMS_METATILE_MAX_SIZE
+    )
+    if metatile > 1 and (not write_s3 or mode == 'preview'):
+        # The sibling tiles would not be cached, so rendering them is useless
+        return 1
+    return metatile
+
+
+def get_metatile_address(gagrid, metatile):
+    '''Return the tile range of the metatile containing the requested tile
+
+    The metatiles are aligned on the tile grid and clipped to the grid extent.
+
+    Returns:
+        Tile range [min_col, min_row, max_col, max_row]
+    '''
+    zoom = request.view_args['zoom']
+    col, row = get_tile_address()
+    min_row, min_col, max_row, max_col = gagrid.getExtentAddress(zoom)
+    meta_col = col - col % metatile
+    meta_row = row - row % metatile
+    return [
+        min(max(meta_col, min_col), col),
+        min(max(meta_row, min_row), row),
+        max(min(meta_col + metatile - 1, max_col), col),
+        max(min(meta_row + metatile - 1, max_row), row),
+    ]
+
+
+def get_optimized_metatile(  # pylint: disable=too-many-locals
+    gagrid, gutter, metatile, png_profile=None
+):
+    '''Render the metatile containing the requested tile with one GetMap
+
+    Returns:
+        status_code, content, headers, wms_time, tile_generation_time, siblings
+        where content is the requested tile and siblings a dict of
+        (col, row) => content with the other tiles of the metatile. When the
+        WMS response cannot be split, content is the raw WMS response and
+        siblings is empty.
+    '''
+    start = perf_counter()
+    zoom = request.view_args['zoom']
+    address = get_metatile_address(gagrid, metatile)
+    min_col, min_row, max_col, max_row = address
+    top_left = gagrid.tileBounds(zoom, min_col, min_row)
+    bottom_right = gagrid.tileBounds(zoom, max_col, max_row)
+    bbox = get_wms_bbox(
+        gagrid, [top_left[0], bottom_right[1], bottom_right[2], top_left[3]],
+        gutter
+    )
+    tile_size = int(gagrid.tileSizePx)
+    logger.debug('Rendering metatile %s with gutter %d', address, gutter)
+    response = get_wms_tile(
+        bbox,
+        gutter,
+        tile_size * (max_col - min_col + 1),
+        tile_size * (max_row - min_row + 1)
+    )
+
+    content = response.content
+    headers = response.headers
+    siblings = {}
+    content_type = response.headers['Content-Type']
+    if (
+        response.ok and response.content and
+        content_type == f'image/{request.view_args["extension"]}'
+    ):
+        siblings = run_in_image_pool(
+            split_metatile, content, address, gutter, tile_size, png_profile
+        )
+        content = siblings.pop(get_tile_address())
+        # The WMS Etag, if any, is the one of the metatile
+        headers = {'Content-Type': content_type}
+    tile_generation_time = perf_counter() - start
+    return (
+        response.status_code,
+        content,
+        headers,
+        response.elapsed.total_seconds(),
+        tile_generation_time,
+        siblings
+    )
+
+
 def prepare_wmts_headers(
     content, headers, wms_time, tile_generation_time, restriction
 ):
     _headers = {'X-Tiles-S3-Cache': 'miss'}
     _headers['Content-Type'] = headers['Content-Type']
     etag = headers.get('Etag', None)
+    blank = lookup_blank_tile(content)
+    if blank:
+        # Stable ETag shared by all the blank tiles of the same kind
+        _headers['X-Tiles-Blank'] = blank
+        etag = None
     if etag is None:
-        etag = digest(content)
+        etag = hash_in_image_pool(digest, content)
     _headers['Etag'] = f'"{etag}"'
     _headers['X-WMS-Time'] = wms_time
     _headers['X-Tile-Generation-Time'] = f'{tile_generation_time:.6f}'
@@ -231,7 +468,49 @@ def prepare_wmts_headers(
     return _headers
 
 
-def handle_2nd_level_cache(write_s3, mode, headers, content):
+def prepare_metatile_siblings(
+    siblings, headers, wms_time, tile_generation_time, restriction
+):
+    '''Return the list of (wmts_path, content, headers) of the metatile siblings
+    '''
+    sibling_tiles = []
+    for (col, row), content in siblings.items():
+        sibling_headers = prepare_wmts_headers(
+            content, {'Content-Type': headers['Content-Type']},
+            wms_time,
+            tile_generation_time,
+            restriction
+        )
+        sibling_tiles.append(
+            (get_tile_path(col, row), content, sibling_headers)
+        )
+    return sibling_tiles
+
+
+def call_after(count, func):
+    '''Return a function calling func once it has been called count times'''
+    remaining = [count]
+    lock = threading.Lock()
+
+    def countdown():
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        func()
+
+    return countdown
+
+
+def handle_2nd_level_cache(
+    write_s3, mode, headers, content, siblings=None, on_written=None
+):
+    '''Return the on_close handler queueing the tile (and its siblings) to be
+    written on S3 or None if it is not written on S3
+
+    on_written (if any) is called once all the tiles have been written (or
+    dropped from the S3 write queue).
+    '''
     on_close = None
     ctype_ok = headers.get('Content-Type') in ('image/png', 'image/jpeg')
     if write_s3 and mode != "preview" and ctype_ok:
@@ -243,7 +522,13 @@ def handle_2nd_level_cache(write_s3, mode, headers, content):
         wmts_path = request.path.lstrip('/')
 
         def on_close_handler():
-            put_s3_file(content, wmts_path, headers)
+            # siblings tiles from a metatile rendering
+            tiles = [(wmts_path, content, headers), *(siblings or [])]
+            callback = None
+            if on_written is not None:
+                callback = call_after(len(tiles), on_written)
+            for tile_path, tile_content, tile_headers in tiles:
+                queue_s3_file(tile_content, tile_path, tile_headers, callback)
 
         on_close = on_close_handler
     else:
@@ -252,24 +537,146 @@ def handle_2nd_level_cache(write_s3, mode, headers, content):
     return on_close
 
 
-def prepare_wmts_response(mode, etag):
+def get_render_lease_key(metatile):
+    '''Return the render lease key of the requested tile
+
+    Tiles of a same metatile share the lease of the metatile.
+    '''
+    wmts_path = request.path.lstrip('/')
+    if metatile <= 1:
+        return wmts_path
+    col, row = get_tile_address()
+    return (
+        f'{wmts_path.rsplit("/", 2)[0]}/metatile/'
+        f'{col - col % metatile}/{row - row % metatile}'
+    )
+
+
+def wait_for_rendered_tile(lease_key):
+    '''Wait for the tile rendered by the owner of the render lease
+
+    The memory caches and S3 are polled until the tile is found, the lease
+    is released or RENDER_LEASE_WAIT is elapsed.
+
+    Returns:
+        (status_code, content, headers, on_close) or None if the tile has not
+        been found
+    '''
+    wmts_path = request.path.lstrip('/')
+    deadline = time.monotonic() + settings.RENDER_LEASE_WAIT
+    while True:
+        time.sleep(settings.RENDER_LEASE_POLL_INTERVAL)
+        cached = get_cached_tile(wmts_path)
+        if cached is not None:
+            status_code, content, headers = prepare_wmts_memory_cached_response(
+                cached, None
+            )
+            return status_code, content, headers, None
+        s3_resp, content = get_s3_file(wmts_path, None)
+        if s3_resp and s3_resp.status == 200:
+            status_code, content, headers = prepare_wmts_cached_response(
+                s3_resp, content
+            )
+            return status_code, content, headers, None
+        if time.monotonic() > deadline or not is_render_lease_held(lease_key):
+            logger.warning(
+                'Tile %s not rendered by the render lease %s owner',
+                wmts_path,
+                lease_key
+            )
+            return None
+
+
+def render_wmts_tile(mode):
     gagrid, bbox = validate_wmts_request()
     restriction, gutter, write_s3 = validate_restriction(gagrid)
 
-    shift = gagrid.RESOLUTIONS[request.view_args['zoom']] * gutter
-    bbox = extend_bbox(bbox, shift)
-    if request.view_args['srid'] == 4326:
-        bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+    metatile = get_metatile_size(restriction, write_s3, mode)
+
+    # Only one worker (cluster wide, depending on the lease backend) renders a
+    # tile written to S3, the others wait for it in the caches.
+    lease_key = None
+    lease = None
+    if write_s3 and mode != 'preview':
+        lease_key = get_render_lease_key(metatile)
+        lease = acquire_render_lease(lease_key)
+        if lease is None:
+            rendered = wait_for_rendered_tile(lease_key)
+            if rendered is not None:
+                return rendered
 
-    (status_code, content, headers, wms_time,
-     tile_generation_time) = get_optimized_tile(bbox, gutter)
+    try:
+        siblings = {}
+        if metatile > 1:
+            (
+                status_code,
+                content,
+                headers,
+                wms_time,
+                tile_generation_time,
+                siblings
+            ) = get_optimized_metatile(
+                gagrid, gutter, metatile, restriction.get('png_profile')
+            )
+        else:
+            bbox = get_wms_bbox(gagrid, bbox, gutter)
+            (status_code, content, headers, wms_time,
+             tile_generation_time) = get_optimized_tile(
+                 bbox, gutter, restriction.get('png_profile')
+             )
+    except Exception:
+        release_render_lease(lease_key, lease)
+        raise
     headers = prepare_wmts_headers(
         content, headers, wms_time, tile_generation_time, restriction
     )
+    if siblings:
+        headers['X-Tiles-Metatile'] = f'{len(siblings) + 1} tiles'
+
+    # The lease is held until the tiles are on S3, where the workers waiting
+    # for them look them up
+    def on_written():
+        release_render_lease(lease_key, lease)
+
+    on_close = handle_2nd_level_cache(
+        write_s3,
+        mode,
+        headers,
+        content,
+        siblings=prepare_metatile_siblings(
+            siblings, headers, wms_time, tile_generation_time, restriction
+        ),
+        on_written=on_written if lease_key is not None else None
+    )
+    if on_close is None:
+        release_render_lease(lease_key, lease)
+    return status_code, content, headers, on_close
 
-    on_close = handle_2nd_level_cache(write_s3, mode, headers, content)
 
-    if etag == headers.get('Etag'):
-        return 304, None, headers, None
+def get_coalescing_key(mode, path):
+    '''Return the key of the concurrent renders of a tile to coalesce
+
+    The query arguments changing the rendered tile (gutter) are part of it.
+    '''
+    return f'{mode}:{path}?gutter={request.args.get("gutter", "")}'
+
+
+def prepare_wmts_response(mode, etag):
+    # Concurrent requests of the same tile wait for the first one to render it
+    (status_code, content, headers, on_close), coalesced = coalesce(
+        get_coalescing_key(mode, request.path),
+        lambda: render_wmts_tile(mode)
+    )
+    if coalesced:
+        # The tile is written to S3 (and to the memory cache) by the request
+        # that rendered it
+        headers = dict(headers)
+        headers.pop('X-Tiles-S3-Cache-Write', None)
+        headers['X-Tiles-Coalesced'] = 'hit'
+        on_close = None
+
+    if etag_matches(etag, get_header(headers, 'ETag')):
+        # The rendered tile is still written to S3, releasing the render lease
+        return 304, None, headers, on_close
 
     return status_code, content, headers, on_close
@@ -1,14 +1,33 @@
+import hashlib
+import json
 import logging
+import os
+import threading
 import time
 
 import psycopg as psy
+from psycopg import sql
 
 from app import settings
+from app.helpers.png_profile import parse_png_profile
 
 logger = logging.getLogger(__name__)
 
 RESTRICTIONS = {}
 
+# Version and refresh counters of the RESTRICTIONS table (see /info.json)
+WMTS_CONFIG_INFO = {
+    'version': None,
+    'layers': 0,
+    'loaded_at': None,
+    'refreshes': 0,
+    'updates': 0,
+    'errors': 0,
+    'last_update': None,
+}
+
+_REFRESHER = {'pid': None, 'lock': threading.Lock()}
+
 
 def get_wmts_config_by_layer(layer_id):
     try:
@@ -61,9 +80,20 @@ def connect_to_db():
                 raise
 
 
-def get_wmts_config_from_db():
-    # Connect to database
-    connection = connect_to_db()
+def get_wmts_config_from_db(connection=None):
+    '''Return the restrictions table from the BOD
+
+    Args:
+        connection: psycopg.Connection
+            Connection to use, by default a new connection is opened and
+            closed
+    '''
+    if connection is None:
+        connection = connect_to_db()
+        try:
+            return get_wmts_config_from_db(connection)
+        finally:
+            connection.close()
 
     # Open cursor for DB-Operations
     cursor = connection.cursor()  # pylint: disable=no-member
@@ -84,25 +114,168 @@ def get_wmts_config_from_db():
         "Found %s tileset records for wmts config in DB", total_records
     )
 
-    # iterate through table
+    # iterate through table, the columns are mapped by name so that optional
+    # columns (e.g. wms_metatile) can be missing from older views
+    columns = [column.name for column in cursor.description]
     restrictions = {}
-    for i, record in enumerate(cursor):
-        # logger.debug('WMS config record %d: %s', i, record)
-        restrictions[record[0]] = {
-            'timestamps': record[1],
-            'formats': record[2],
-            'resolution_min': record[3],
-            'resolution_max': record[4],
-            's3_resolution_max': record[5],
-            'cache_ttl': record[6],
-            'wms_gutter': record[7]
+    for record in cursor:
+        row = dict(zip(columns, record))
+        try:
+            png_profile = parse_png_profile(row.get('png_profile'))
+        except ValueError as error:
+            logger.error(
+                'Invalid PNG profile of layer %s, ignored: %s',
+                row['fk_dataset_id'],
+                error
+            )
+            png_profile = None
+        restrictions[row['fk_dataset_id']] = {
+            'timestamps': row['timestamps'],
+            'formats': row['formats'],
+            'resolution_min': row['resolution_min'],
+            'resolution_max': row['resolution_max'],
+            's3_resolution_max': row['s3_resolution_max'],
+            'cache_ttl': row['cache_ttl'],
+            'wms_gutter': row['wms_gutter'],
+            'wms_metatile': row.get('wms_metatile') or 1,
+            'png_profile': png_profile
         }
 
     return restrictions
 
 
-def init_wmts_config():
+def get_wmts_config_version(restrictions):
+    '''Return a digest of the restrictions table'''
+    content = json.dumps(restrictions, sort_keys=True, default=str)
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def diff_wmts_config(old, new):
+    '''Return the added, removed and changed layers between two tables'''
+    return {
+        'added': sorted(new.keys() - old.keys()),
+        'removed': sorted(old.keys() - new.keys()),
+        'changed':
+            sorted(
+                layer_id for layer_id in new.keys() & old.keys()
+                if new[layer_id] != old[layer_id]
+            ),
+    }
+
+
+def set_wmts_config(restrictions):
+    '''Replace the restrictions table
+
+    The table is swapped at once, a request sees either the previous or the
+    new table, never a partially updated one.
+
+    Returns:
+        The difference with the previous table (see diff_wmts_config())
+    '''
     global RESTRICTIONS  # pylint: disable=global-statement
+    diff = diff_wmts_config(RESTRICTIONS, restrictions)
+    RESTRICTIONS = restrictions
+    WMTS_CONFIG_INFO.update(
+        version=get_wmts_config_version(restrictions),
+        layers=len(restrictions),
+        loaded_at=time.time()
+    )
+    return diff
+
+
+def init_wmts_config():
     started = time.time()
-    RESTRICTIONS = get_wmts_config_from_db()
+    set_wmts_config(get_wmts_config_from_db())
     logger.debug('WMTS config initialized in %.3fs', time.time() - started)
+
+
+def refresh_wmts_config(connection=None):
+    '''Reload the restrictions table and swap it when it has changed
+
+    Returns:
+        The difference with the previous table or None if unchanged
+    '''
+    restrictions = get_wmts_config_from_db(connection)
+    WMTS_CONFIG_INFO['refreshes'] += 1
+    if get_wmts_config_version(restrictions) == WMTS_CONFIG_INFO['version']:
+        return None
+    diff = set_wmts_config(restrictions)
+    WMTS_CONFIG_INFO['updates'] += 1
+    WMTS_CONFIG_INFO['last_update'] = {
+        name: len(layers) for name, layers in diff.items()
+    }
+    logger.info(
+        'WMTS config updated to version %s: added %s, removed %s, changed %s',
+        WMTS_CONFIG_INFO['version'],
+        diff['added'],
+        diff['removed'],
+        diff['changed']
+    )
+    return diff
+
+
+def start_wmts_config_refresher():
+    '''Start the background refresh of the restrictions table
+
+    This must be called in each worker process (e.g. in gunicorn post_fork
+    hook). The table is reloaded every WMTS_CONFIG_REFRESH_INTERVAL seconds
+    or, with WMTS_CONFIG_NOTIFY_CHANNEL, when a notification is received on
+    this Postgres channel (with the interval as fallback).
+
+    The refresher is a thread, a greenlet with gevent; psycopg waits for the
+    DB in a gevent cooperative way so the requests are not blocked.
+    '''
+    if settings.WMTS_CONFIG_REFRESH_INTERVAL <= 0 or \
+            _REFRESHER['pid'] == os.getpid():
+        return
+    with _REFRESHER['lock']:
+        if _REFRESHER['pid'] == os.getpid():
+            return
+        _REFRESHER['pid'] = os.getpid()
+    threading.Thread(
+        target=_refresh_loop, name='wmts-config-refresher', daemon=True
+    ).start()
+
+
+def _refresh_loop():
+    while True:
+        try:
+            if settings.WMTS_CONFIG_NOTIFY_CHANNEL:
+                _listen_and_refresh()
+            else:
+                time.sleep(settings.WMTS_CONFIG_REFRESH_INTERVAL)
+                refresh_wmts_config()
+        except Exception as error:  # pylint: disable=broad-except
+            WMTS_CONFIG_INFO['errors'] += 1
+            logger.exception('Failed to refresh the WMTS config: %s', error)
+            time.sleep(settings.WMTS_CONFIG_REFRESH_INTERVAL)
+
+
+def _listen_and_refresh():
+    connection = connect_to_db()
+    try:
+        connection.autocommit = True
+        connection.execute(
+            sql.SQL('LISTEN {}').format(
+                sql.Identifier(settings.WMTS_CONFIG_NOTIFY_CHANNEL)
+            )
+        )
+        logger.info(
+            'Listening to WMTS config notifications on channel %s',
+            settings.WMTS_CONFIG_NOTIFY_CHANNEL
+        )
+        # the changes done while not listening have not been notified
+        refresh_wmts_config(connection)
+        while True:
+            notified = False
+            for _ in connection.notifies(
+                timeout=settings.WMTS_CONFIG_REFRESH_INTERVAL, stop_after=1
+            ):
+                notified = True
+            if notified:
+                # coalesce the notifications of a BOD update
+                for _ in connection.notifies(timeout=1):
+                    pass
+            refresh_wmts_config(connection)
+    finally:
+        connection.close()
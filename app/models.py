@@ -16,6 +16,7 @@ class TileSetConcatenated(db.Model):
     resolution_max = db.Column('resolution_max', db.Float)
     s3_resolution_max = db.Column('s3_resolution_max', db.Float)
     wms_gutter = db.Column('wms_gutter', db.Integer)
+    wms_metatile = db.Column('wms_metatile', db.Integer)
     cache_ttl = db.Column('cache_ttl', db.Integer)
 
 
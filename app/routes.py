@@ -1,3 +1,4 @@
+import hmac
 import logging
 import platform
 import time as _time
@@ -11,11 +12,46 @@ from flask import request
 
 from app import settings
 from app.app import app
+from app.helpers.capabilities_cache import capabilities_cache
+from app.helpers.coverage import load_geojson_polygons
+from app.helpers.etag_index import etag_index
+from app.helpers.etag_index import index_tile_etag
+from app.helpers.etag_index import prepare_etag_index_response
+from app.helpers.image_pool import image_pool
+from app.helpers.purge import prepare_purge
+from app.helpers.purge import purge_jobs
+from app.helpers.render_scheduler import render_scheduler
+from app.helpers.revalidate import revalidator
+from app.helpers.revalidate import schedule_revalidation
+from app.helpers.s3 import S3FileStream
 from app.helpers.s3 import get_s3_file
+from app.helpers.s3 import s3_connection_pool
+from app.helpers.s3_hedge import HEDGE
+from app.helpers.s3_hedge import RENDER
+from app.helpers.s3_hedge import get_hedged_s3_file
+from app.helpers.s3_hedge import get_speculative_render
+from app.helpers.s3_hedge import s3_hedger
+from app.helpers.s3_write_queue import s3_write_queue
+from app.helpers.shared_tile_cache import get_shared_tile_cache
+from app.helpers.single_flight import single_flight
+from app.helpers.tile_cache import cache_tile
+from app.helpers.tile_cache import get_cached_tile
+from app.helpers.tile_cache import get_tile_cache_ttl
+from app.helpers.tile_cache import tile_cache
+from app.helpers.utils import is_stale_tile
+from app.helpers.variants import get_tile_variant
+from app.helpers.variants import is_negotiated_format
+from app.helpers.variants import prepare_wmts_variant_response
+from app.helpers.variants import replace_extension
 from app.helpers.wms import get_wms_backend_readiness
+from app.helpers.wms import get_wms_backend_ready_urls
+from app.helpers.wms import wms_backend_pool
 from app.helpers.wmts import prepare_wmts_cached_response
+from app.helpers.wmts import prepare_wmts_memory_cached_response
 from app.helpers.wmts import prepare_wmts_response
 from app.helpers.wmts import validate_wmts_mode
+from app.helpers.wmts_config import WMTS_CONFIG_INFO
+from app.helpers.wmts_config import get_wmts_config_by_layer
 from app.version import APP_VERSION
 from app.views import GetCapabilities
 
@@ -43,6 +79,7 @@ def log_response(response):
                 "headers": dict(response.headers.items())
             },
             "from_s3_cache": g.get('from_s3_cache', False),
+            "from_memory_cache": g.get('from_memory_cache', False),
             "duration": _time.time() - g.get('started', _time.time())
         }
     )
@@ -51,14 +88,81 @@ def log_response(response):
 
 @app.route('/info.json')
 def info_json():
+    shared_tile_cache = get_shared_tile_cache()
     return make_response(
         jsonify({
             'python_version': platform.python_version(),
-            'app_version': APP_VERSION
+            'app_version': APP_VERSION,
+            's3_connection_pool': s3_connection_pool.stats(),
+            's3_write_queue': s3_write_queue.stats(),
+            's3_hedge': s3_hedger.stats(),
+            'single_flight': single_flight.stats(),
+            'capabilities_cache': capabilities_cache.stats(),
+            'image_pool': image_pool.stats(),
+            'wmts_config': WMTS_CONFIG_INFO,
+            'revalidator': revalidator.stats(),
+            'render_scheduler': render_scheduler.stats(),
+            'wms_backends': wms_backend_pool.stats(),
+            'tile_cache': tile_cache.stats(),
+            'etag_index': etag_index.stats(),
+            'shared_tile_cache':
+                shared_tile_cache.stats() if shared_tile_cache else None
         })
     )
 
 
+def validate_purge_token():
+    if not settings.PURGE_API_TOKEN:
+        abort(404, 'Purge API disabled')
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(
+        authorization.encode('utf-8'),
+        f'Bearer {settings.PURGE_API_TOKEN}'.encode('utf-8')
+    ):
+        abort(401, 'Invalid purge token')
+
+
+@app.route('/admin/purge', methods=['POST'])
+def admin_purge():
+    validate_purge_token()
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict) or 'layer' not in params:
+        abort(400, 'JSON body with at least the "layer" is required')
+    try:
+        keys = prepare_purge(
+            params['layer'],
+            times=params.get('times'),
+            srids=params.get('srids'),
+            extensions=params.get('formats'),
+            zooms=(params.get('min_zoom', 0), params.get('max_zoom', 30)),
+            bbox=params.get('bbox'),
+            polygons=load_geojson_polygons(params['geometry'])
+            if params.get('geometry') else None,
+            geometry_srid=params.get('geometry_srid', 2056),
+            whole_layer=params.get('whole_layer', False),
+            max_keys=settings.PURGE_MAX_KEYS
+        )
+    except (ValueError, TypeError, KeyError) as error:
+        logger.error('Invalid purge request %s: %s', params, error)
+        abort(400, f'Invalid purge request: {error}')
+    job_id = purge_jobs.start(
+        params['layer'], keys, dry_run=params.get('dry_run', False)
+    )
+    if job_id is None:
+        abort(429, 'Too many purges running, retry later')
+    return make_response(jsonify({'success': True, 'job': job_id}), 202)
+
+
+@app.route('/admin/purge/<string:job_id>', methods=['GET'])
+def admin_purge_job(job_id):
+    validate_purge_token()
+    job = purge_jobs.get(job_id)
+    if job is None:
+        # the jobs are only known by the worker running them
+        abort(404, f'Unknown purge job {job_id} on this worker')
+    return make_response(jsonify({'success': True, **job}))
+
+
 @app.route('/checker', methods=['GET'])
 def liveness():
     response = make_response(
@@ -75,18 +179,114 @@ def readiness():
         'No query information to decode. QUERY_STRING is set, but empty.'
     )
 
-    content = get_wms_backend_readiness()
-
-    content_str = content.decode('ascii', errors='replace')
-    if wms_ok_marker not in content_str:
+    # Ready as soon as one WMS backend of the pool is
+    reachable = False
+    for url in get_wms_backend_ready_urls():
+        content = get_wms_backend_readiness(url)
+        if content is None:
+            continue
+        reachable = True
+        content_str = content.decode('ascii', errors='replace')
+        if wms_ok_marker in content_str:
+            return make_response(jsonify({'success': True, 'message': 'OK'}))
         logger.error(
             'Incomprehensible WMS backend %s answer: %s. '
             'WMS is probably not ready yet.',
-            settings.WMS_BACKEND_READY,
+            url,
             content_str
         )
-        abort(503, 'Incomprehensible answer. WMS is probably not ready yet.')
-    return make_response(jsonify({'success': True, 'message': 'OK'}))
+    if not reachable:
+        abort(502, 'Cannot connect to backend WMS')
+    abort(503, 'Incomprehensible answer. WMS is probably not ready yet.')
+
+
+def prepare_s3_tile_response(wmts_path, layer_id, s3_resp, content, etag):
+    status_code, content, headers = prepare_wmts_cached_response(
+        s3_resp, content, etag
+    )
+    restriction = get_wmts_config_by_layer(layer_id)
+    if settings.STALE_WHILE_REVALIDATE and restriction and is_stale_tile(
+        headers, restriction.get('cache_ttl')
+    ):
+        # Served as is, the fresh tile is cached once re-rendered
+        headers['X-Tiles-S3-Cache'] = 'stale'
+        schedule_revalidation(wmts_path)
+    elif isinstance(content, S3FileStream):
+        index_tile_etag(wmts_path, headers, get_tile_cache_ttl(restriction))
+        if content.length <= settings.TILE_CACHE_MAX_ITEM_BYTES:
+            # The tile is cached once completely streamed to the client
+            content.add_done_callback(
+                lambda body: cache_tile(wmts_path, body, headers, restriction)
+            )
+    elif status_code == 200:
+        cache_tile(wmts_path, content, headers, restriction)
+    return status_code, content, headers
+
+
+def prepare_cached_tile_response(mode, etag, variant):
+    '''Return the response of the requested tile if found in the caches
+
+    The memory caches, the ETag index and S3 are looked up in this order. Only
+    the ETag index is looked up for a variant, its caches are looked up by
+    prepare_wmts_variant_response.
+
+    Returns:
+        (status_code, content, headers) or None if the tile is not cached
+    '''
+    if mode == 'preview':
+        return None
+    wmts_path = request.path.lstrip('/')
+    if variant:
+        headers = prepare_etag_index_response(
+            replace_extension(wmts_path, variant), etag
+        )
+        return None if headers is None else (304, None, headers)
+
+    cached = get_cached_tile(wmts_path)
+    if cached is not None:
+        logger.debug('Preparing image response from memory cache...')
+        return prepare_wmts_memory_cached_response(cached, etag)
+    headers = prepare_etag_index_response(wmts_path, etag)
+    if headers is not None:
+        logger.debug('Tile ETag found in the ETag index')
+        return 304, None, headers
+    return prepare_s3_cached_tile_response(wmts_path, etag)
+
+
+def prepare_s3_cached_tile_response(wmts_path, etag):
+    '''Return the response of the requested tile if found on S3
+
+    With S3_HEDGE, the slow S3 GETs are hedged and a speculative render may
+    be returned instead (see app.helpers.s3_hedge).
+
+    Returns:
+        (status_code, content, headers) or None if the tile is not on S3
+    '''
+    layer_id = request.view_args['layer_id']
+    hedge = None
+    if settings.S3_HEDGE:
+        hedge, result = get_hedged_s3_file(
+            wmts_path,
+            etag,
+            stream=True,
+            render=get_speculative_render(layer_id, etag)
+        )
+        if hedge == RENDER:
+            logger.debug('Preparing image response from speculative render')
+            result[2]['X-Tiles-S3-Hedge'] = hedge
+            return result
+        s3_resp, content = result
+    else:
+        s3_resp, content = get_s3_file(wmts_path, etag, stream=True)
+    if not s3_resp:
+        return None
+    logger.debug('Preparing image response from S3...')
+    response = prepare_s3_tile_response(
+        wmts_path, layer_id, s3_resp, content, etag
+    )
+    if hedge == HEDGE:
+        response[2]['X-Tiles-S3-Hedge'] = hedge
+    return response
 
 
 @app.route(
@@ -99,25 +299,37 @@ def get_tile(
 ):
     mode = validate_wmts_mode()
     etag = request.headers.get('If-None-Match', None)
+    wmts_path = request.path.lstrip('/')
 
-    s3_resp = None
-    content = None
-    if mode != 'preview':
-        s3_resp, content = get_s3_file(request.path.lstrip('/'), etag)
-
+    variant = get_tile_variant()
     on_close = None
-    if s3_resp:
-        logger.debug('Preparing image response from S3...')
-        status_code, headers = prepare_wmts_cached_response(s3_resp)
+    cached = prepare_cached_tile_response(mode, etag, variant)
+    if cached:
+        status_code, content, headers = cached
+    elif variant:
+        logger.debug('Preparing %s variant response...', variant)
+        status_code, content, headers = prepare_wmts_variant_response(
+            mode, etag, variant
+        )
     else:
         logger.debug('Returning image from the WMS server')
         status_code, content, headers, on_close = prepare_wmts_response(
             mode,
             etag
         )
+        if status_code == 200 and 'X-Tiles-S3-Cache-Write' in headers:
+            cache_tile(
+                wmts_path, content, headers, get_wmts_config_by_layer(layer_id)
+            )
+
+    if is_negotiated_format():
+        # The format served depends on the Accept header
+        headers['Vary'] = 'Accept'
 
     # Determine if the image is returned in the response
     if request.args.get('nodata', None) == 'true':
+        if isinstance(content, S3FileStream):
+            content.close()
         response = Response(
             'OK', status=200, headers=headers, mimetype='text/plain'
         )
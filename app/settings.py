@@ -77,6 +77,19 @@ GET_TILE_CACHE_TEMPLATE = os.getenv(
 GET_CAP_DEFAULT_CACHE = os.getenv(
     'GET_CAP_DEFAULT_CACHE', 'public, max-age=3600, s-maxage=5184000'
 )
+# In memory cache of the rendered GetCapabilities documents
+GET_CAP_CACHE_ENABLED = strtobool(os.getenv('GET_CAP_CACHE_ENABLED', 'True'))
+GET_CAP_CACHE_PRERENDER = strtobool(
+    os.getenv('GET_CAP_CACHE_PRERENDER', 'True')
+)
+# Interval in seconds between two checks of the BOD for changes, 0 disables
+# the refresh
+GET_CAP_CACHE_REFRESH_INTERVAL = float(
+    os.getenv('GET_CAP_CACHE_REFRESH_INTERVAL', '60')
+)
+# Compression of the GetCapabilities documents (brotli only if installed)
+GET_CAP_GZIP_LEVEL = int(os.getenv('GET_CAP_GZIP_LEVEL', '9'))
+GET_CAP_BROTLI_QUALITY = int(os.getenv('GET_CAP_BROTLI_QUALITY', '9'))
 CHECKER_DEFAULT_CACHE = os.getenv(
     'CHECKER_DEFAULT_CACHE', 'public, max-age=120'
 )
@@ -95,6 +108,60 @@ if AWS_S3_ENDPOINT_URL is not None:
 
 # HTTP Client Timeout to access S3 bucket [seconds]
 HTTP_CLIENT_TIMEOUT = int(os.getenv('HTTP_CLIENT_TIMEOUT', '1'))
+# Keep-alive connection pool (per worker) used to read tiles from S3
+S3_POOL_MAXSIZE = int(os.getenv('S3_POOL_MAXSIZE', '20'))
+S3_POOL_IDLE_TIMEOUT = float(os.getenv('S3_POOL_IDLE_TIMEOUT', '10'))
+# S3 hits of at least S3_STREAM_MIN_BYTES are streamed to the client instead of
+# being read in memory first, 0 disable the streaming
+S3_STREAM_MIN_BYTES = int(os.getenv('S3_STREAM_MIN_BYTES', '0'))
+S3_STREAM_CHUNK_BYTES = int(os.getenv('S3_STREAM_CHUNK_BYTES', '16384'))
+# Hedged S3 reads: a second S3 GET is sent when the first one takes longer than
+# the S3_HEDGE_PERCENTILE of the recent S3 GET latencies (at least
+# S3_HEDGE_MIN_DELAY [seconds]), for at most S3_HEDGE_MAX_RATIO of the GETs
+S3_HEDGE = strtobool(os.getenv('S3_HEDGE', 'False'))
+S3_HEDGE_PERCENTILE = float(os.getenv('S3_HEDGE_PERCENTILE', '95'))
+S3_HEDGE_WINDOW = int(os.getenv('S3_HEDGE_WINDOW', '200'))
+S3_HEDGE_MIN_DELAY = float(os.getenv('S3_HEDGE_MIN_DELAY', '0.02'))
+S3_HEDGE_MAX_RATIO = float(os.getenv('S3_HEDGE_MAX_RATIO', '0.1'))
+# Comma separated layer id patterns (cheap to render) for which a speculative
+# preview render is started along with the hedged S3 GET
+S3_HEDGE_RENDER_LAYERS = tuple(
+    pattern.strip()
+    for pattern in os.getenv('S3_HEDGE_RENDER_LAYERS', '').split(',')
+    if pattern.strip()
+)
+
+# In memory (per worker) tile cache in front of S3, 0 disable the cache
+TILE_CACHE_MAX_BYTES = int(os.getenv('TILE_CACHE_MAX_BYTES', '33554432'))
+TILE_CACHE_MAX_ITEM_BYTES = int(
+    os.getenv('TILE_CACHE_MAX_ITEM_BYTES', '524288')
+)
+TILE_CACHE_MAX_TTL = int(os.getenv('TILE_CACHE_MAX_TTL', '3600'))
+
+# In memory (per worker) index of the tile ETags answering the conditional
+# requests without S3 round trip, 0 disable the index
+ETAG_INDEX_MAX_ENTRIES = int(os.getenv('ETAG_INDEX_MAX_ENTRIES', '65536'))
+
+# Tile cache shared by all workers of a node, 0 slots disable the cache
+SHARED_TILE_CACHE_SLOTS = int(os.getenv('SHARED_TILE_CACHE_SLOTS', '0'))
+SHARED_TILE_CACHE_SLOT_SIZE = int(
+    os.getenv('SHARED_TILE_CACHE_SLOT_SIZE', '65536')
+)
+
+# Write-behind queue (per worker) of the S3 tile uploads, 0 workers write the
+# tiles synchronously when the response is closed
+S3_WRITE_QUEUE_WORKERS = int(os.getenv('S3_WRITE_QUEUE_WORKERS', '4'))
+S3_WRITE_QUEUE_MAX_BYTES = int(
+    os.getenv('S3_WRITE_QUEUE_MAX_BYTES', '67108864')
+)
+# Policy when the queue is full: drop-oldest or backpressure
+S3_WRITE_QUEUE_POLICY = os.getenv('S3_WRITE_QUEUE_POLICY', 'drop-oldest')
+S3_WRITE_QUEUE_BACKPRESSURE_TIMEOUT = float(
+    os.getenv('S3_WRITE_QUEUE_BACKPRESSURE_TIMEOUT', '1')
+)
+S3_WRITE_QUEUE_FLUSH_TIMEOUT = float(
+    os.getenv('S3_WRITE_QUEUE_FLUSH_TIMEOUT', '10')
+)
 
 # SQL Alchemy
 # "+psycopg" is required to make SQLAlchemy use psycopg3
@@ -136,6 +203,126 @@ WMS_BACKEND_CONNECTION_MAX_RETRY = int(
     os.getenv("WMS_BACKEND_CONNECTION_MAX_RETRY", "0")
 )
 
+# Comma separated WMS backends (mapserv URLs) the renders are balanced on
+WMS_BACKENDS = tuple(
+    url.strip()
+    for url in os.getenv("WMS_BACKENDS", WMS_BACKEND).split(",")
+    if url.strip()
+)
+# JSON object of layer id patterns to their list of WMS backends (mapserv URLs)
+WMS_BACKEND_AFFINITY = os.getenv("WMS_BACKEND_AFFINITY", "")
+# A WMS backend is ejected during WMS_BACKEND_EJECT_TIME [seconds] after
+# WMS_BACKEND_EJECT_FAILURES consecutive failures
+WMS_BACKEND_EJECT_FAILURES = int(os.getenv("WMS_BACKEND_EJECT_FAILURES", "3"))
+WMS_BACKEND_EJECT_TIME = float(os.getenv("WMS_BACKEND_EJECT_TIME", "30"))
+
+# Adaptive concurrency limit and circuit breaker (per worker) of the WMS
+# backend, the requests over the limit are answered with a 503
+WMS_BACKEND_GUARD = strtobool(os.getenv("WMS_BACKEND_GUARD", "False"))
+WMS_LIMIT_INITIAL = int(os.getenv("WMS_LIMIT_INITIAL", "10"))
+WMS_LIMIT_MIN = int(os.getenv("WMS_LIMIT_MIN", "1"))
+WMS_LIMIT_MAX = int(os.getenv("WMS_LIMIT_MAX", "100"))
+# WMS response time [seconds] above which the limit is decreased
+WMS_LIMIT_LATENCY = float(os.getenv("WMS_LIMIT_LATENCY", "2"))
+WMS_BREAKER_FAILURES = int(os.getenv("WMS_BREAKER_FAILURES", "5"))
+WMS_BREAKER_RESET_TIMEOUT = float(os.getenv("WMS_BREAKER_RESET_TIMEOUT", "10"))
+# Timeout [seconds] of the WMS GetMap requests, 0 means no timeout. Default to
+# 30 seconds with the backend guard (a hung request holds a slot of the limit),
+# without timeout otherwise
+WMS_BACKEND_TIMEOUT = float(
+    os.getenv("WMS_BACKEND_TIMEOUT", "30" if WMS_BACKEND_GUARD else "0")
+) or None
+# Time to live [seconds] of the cached WMS errors (501) per tile, 0 disable
+# the cache
+WMS_ERROR_CACHE_TTL = int(os.getenv("WMS_ERROR_CACHE_TTL", "0"))
+
+# Metatile settings, the metatile size itself is configured per layer in BOD
+# (wms_metatile), this is only an upper bound to protect the WMS backend
+WMS_METATILE_MAX_SIZE = int(os.getenv("WMS_METATILE_MAX_SIZE", "8"))
+WMS_METATILE_JPEG_QUALITY = int(os.getenv("WMS_METATILE_JPEG_QUALITY", "90"))
+
+# Weighted fair scheduling (per worker) of the WMS renders by class:
+# interactive low zoom, interactive high zoom, preview and background; 0 slots
+# disable the scheduler
+RENDER_SCHEDULER_SLOTS = int(os.getenv("RENDER_SCHEDULER_SLOTS", "0"))
+RENDER_SCHEDULER_LOW_ZOOM_MAX = int(
+    os.getenv("RENDER_SCHEDULER_LOW_ZOOM_MAX", "20")
+)
+RENDER_SCHEDULER_WEIGHTS = tuple(
+    float(weight)
+    for weight in os.getenv("RENDER_SCHEDULER_WEIGHTS", "8,4,2,1").split(",")
+)
+RENDER_SCHEDULER_MAX_QUEUES = tuple(
+    int(max_queue) for max_queue in
+    os.getenv("RENDER_SCHEDULER_MAX_QUEUES", "64,64,16,16").split(",")
+)
+# Maximum wait [seconds] of a queued render per class
+RENDER_SCHEDULER_MAX_WAITS = tuple(
+    float(max_wait) for max_wait in
+    os.getenv("RENDER_SCHEDULER_MAX_WAITS", "5,5,5,30").split(",")
+)
+
+# Replace the uniform (e.g. fully transparent) tiles by a shared canonical
+# tile and write them on S3 as empty marker objects
+BLANK_TILE_DEDUP = strtobool(os.getenv("BLANK_TILE_DEDUP", "False"))
+
+# Tile variants transcoded from the PNG/JPEG tiles, by order of preference
+# for the format negotiation (Accept header) that is opt-in
+TILE_VARIANT_FORMATS = tuple(
+    extension.strip()
+    for extension in os.getenv("TILE_VARIANT_FORMATS", "webp").split(",")
+    if extension.strip()
+)
+TILE_FORMAT_NEGOTIATION = strtobool(
+    os.getenv("TILE_FORMAT_NEGOTIATION", "False")
+)
+TILE_WEBP_QUALITY = int(os.getenv("TILE_WEBP_QUALITY", "80"))
+TILE_AVIF_QUALITY = int(os.getenv("TILE_AVIF_QUALITY", "60"))
+
+# Native threads per worker for the CPU bound image work (decoding, cropping,
+# encoding, hashing) so it doesn't block the gevent event loop, 0 runs it
+# inline. At most max queue tasks wait for a thread, the others wait to queue.
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "2"))
+IMAGE_POOL_MAX_QUEUE = int(os.getenv("IMAGE_POOL_MAX_QUEUE", "64"))
+
+# Maximum time a request waits for the identical tile rendering in flight in
+# the same worker before rendering the tile itself, 0 disables the coalescing
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "20"))
+
+# Render lease shared by the workers to render a tile written to S3 only once:
+# '' (disabled), 'local', 'file' or dotted path of a lease backend class
+RENDER_LEASE_BACKEND = os.getenv("RENDER_LEASE_BACKEND", "")
+RENDER_LEASE_DIRECTORY = os.getenv(
+    "RENDER_LEASE_DIRECTORY", "/dev/shm/service-wmts-render-leases"
+)
+RENDER_LEASE_TTL = float(os.getenv("RENDER_LEASE_TTL", "30"))
+RENDER_LEASE_WAIT = float(os.getenv("RENDER_LEASE_WAIT", "10"))
+RENDER_LEASE_POLL_INTERVAL = float(
+    os.getenv("RENDER_LEASE_POLL_INTERVAL", "0.2")
+)
+
+# Reload of the BOD tileset restrictions in the workers every interval
+# seconds (0 disables it) or on a Postgres NOTIFY on the channel if set
+WMTS_CONFIG_REFRESH_INTERVAL = float(
+    os.getenv("WMTS_CONFIG_REFRESH_INTERVAL", "60")
+)
+WMTS_CONFIG_NOTIFY_CHANNEL = os.getenv("WMTS_CONFIG_NOTIFY_CHANNEL", "")
+
+# Cache purge, the /admin/purge endpoint is disabled without token
+PURGE_API_TOKEN = os.getenv("PURGE_API_TOKEN", "")
+PURGE_CONCURRENCY = int(os.getenv("PURGE_CONCURRENCY", "8"))
+# Maximum number of /admin/purge jobs running at once per worker
+PURGE_MAX_RUNNING_JOBS = int(os.getenv("PURGE_MAX_RUNNING_JOBS", "1"))
+# Maximum number of S3 keys of a /admin/purge request (0 means unbounded)
+PURGE_MAX_KEYS = int(os.getenv("PURGE_MAX_KEYS", "10000000"))
+
+# Serve the S3 tiles older than their tileset cache_ttl and re-render them in
+# the background, at most max pending re-renderings per worker
+STALE_WHILE_REVALIDATE = strtobool(os.getenv("STALE_WHILE_REVALIDATE", "False"))
+STALE_WHILE_REVALIDATE_MAX_PENDING = int(
+    os.getenv("STALE_WHILE_REVALIDATE_MAX_PENDING", "32")
+)
+
 GUNICORN_WORKER_TMP_DIR = os.getenv("GUNICORN_WORKER_TMP_DIR", None)
 
 GUNICORN_KEEPALIVE = int(os.getenv('GUNICORN_KEEPALIVE', '2'))
@@ -1,14 +1,26 @@
 import logging
 import time
 
+from sqlalchemy import text
+
 from flask import abort
 from flask import render_template
 from flask import request
 from flask.views import View
 
+from app import settings
 from app.app import app
+from app.app import db
+from app.helpers.capabilities_cache import IDENTITY
+from app.helpers.capabilities_cache import URL_BASE_PLACEHOLDER
+from app.helpers.capabilities_cache import CapabilitiesDocument
+from app.helpers.capabilities_cache import capabilities_cache
+from app.helpers.capabilities_cache import get_content_encoding
+from app.helpers.single_flight import coalesce
 from app.helpers.utils import get_closest_zoom
 from app.helpers.utils import get_default_tile_matrix_set
+from app.helpers.wmts import SUPPORTED_EPSG
+from app.helpers.wmts import SUPPORTED_LANGS
 from app.helpers.wmts import validate_epsg
 from app.helpers.wmts import validate_lang
 from app.helpers.wmts import validate_version
@@ -19,6 +31,8 @@ from app.models import localized_models
 logger = logging.getLogger(__name__)
 
 STANDARD_LATITUDE_FOR_SWITZERLAND = 47.0
+DEFAULT_EPSG = 21781
+DEFAULT_LANG = 'de'
 
 
 class GetCapabilities(View):
@@ -31,18 +45,139 @@ class GetCapabilities(View):
         is_default_lang = (lang is None and request.args.get('lang') is None)
         epsg, lang = self.get_and_validate_args(epsg, lang)
 
-        context = self.get_context(
-            self.get_models(lang), epsg, lang, is_default_lang, is_default_epsg
+        document = self.get_document((
+            epsg,
+            lang,
+            app.config['APP_STAGING'],
+            is_default_lang,
+            is_default_epsg
+        ))
+        encoding = get_content_encoding()
+        headers = {
+            'Content-Type': 'text/xml; charset=UTF-8',
+            'Vary': 'Accept-Encoding',
+        }
+        if encoding != IDENTITY:
+            headers['Content-Encoding'] = encoding
+        return document.render(request.url_root, encoding), headers
+
+    @classmethod
+    def get_document(cls, key):
+        '''Return the document of the cache key, rendering it if needed
+
+        Args:
+            key: tuple
+                (epsg, lang, staging, is_default_lang, is_default_epsg)
+        '''
+        if not settings.GET_CAP_CACHE_ENABLED:
+            return cls.render_documents([key])[key]
+        capabilities_cache.start_refresher(cls.refresh_cache)
+        document = capabilities_cache.get(key)
+        if document is None:
+            documents, _ = coalesce(
+                f'capabilities:{key}', lambda: cls.render_documents([key])
+            )
+            document = documents[key]
+            capabilities_cache.set(key, document)
+        return document
+
+    @classmethod
+    def get_cache_keys(cls):
+        '''Return the cache keys of all possible documents'''
+        keys = []
+        for epsg in SUPPORTED_EPSG:
+            for lang in SUPPORTED_LANGS:
+                for is_default_lang in ((True,
+                                         False) if lang == DEFAULT_LANG else
+                                        (False,)):
+                    for is_default_epsg in ((True,
+                                             False) if epsg == DEFAULT_EPSG else
+                                            (False,)):
+                        keys.append((
+                            epsg,
+                            lang,
+                            app.config['APP_STAGING'],
+                            is_default_lang,
+                            is_default_epsg
+                        ))
+        return keys
+
+    @classmethod
+    def render_documents(cls, keys):
+        '''Render the documents of the cache keys
+
+        The documents are rendered with a url base placeholder, the BOD is
+        queried only once per language.
+
+        Returns:
+            dict of key => CapabilitiesDocument
+        '''
+        documents = {}
+        data = {}
+        for key in sorted(keys, key=lambda key: key[1]):
+            epsg, lang, _, is_default_lang, is_default_epsg = key
+            if lang not in data:
+                data[lang] = cls.get_data(cls.get_models(lang))
+            context = cls.get_context(
+                data[lang],
+                epsg,
+                lang,
+                is_default_lang,
+                is_default_epsg,
+                URL_BASE_PLACEHOLDER
+            )
+            documents[key] = CapabilitiesDocument(
+                render_template('WmtsCapabilities.xml.jinja', **context)
+            )
+        return documents
+
+    @classmethod
+    def prerender_cache(cls):
+        '''Render all documents in the cache (must run in an app context)'''
+        start = time.time()
+        fingerprint = cls.get_fingerprint()
+        keys = cls.get_cache_keys()
+        capabilities_cache.replace(cls.render_documents(keys), fingerprint)
+        logger.info(
+            '%d capabilities documents pre-rendered in %fs',
+            len(keys),
+            time.time() - start
         )
-        return (
-            render_template(
-                'WmtsCapabilities.xml.jinja',
-                **context,
-            ),
-            {
-                'Content-Type': 'text/xml; charset=UTF-8'
-            },
+
+    @classmethod
+    def refresh_cache(cls):
+        '''Re-render the cached documents if the BOD has changed'''
+        with app.app_context():
+            fingerprint = cls.get_fingerprint()
+            if fingerprint == capabilities_cache.fingerprint:
+                return
+            start = time.time()
+            keys = capabilities_cache.keys()
+            capabilities_cache.replace(cls.render_documents(keys), fingerprint)
+            logger.info(
+                'BOD changed, %d capabilities documents re-rendered in %fs',
+                len(keys),
+                time.time() - start
+            )
+
+    @classmethod
+    def get_fingerprint(cls):
+        '''Return a digest of the content of the BOD views used'''
+        digests = []
+        for models in localized_models.values():
+            for model in models.values():
+                table = model.__table__
+                digests.append(
+                    f'SELECT {len(digests)} AS i, '
+                    "md5(coalesce(string_agg(md5(t::text), '' "
+                    "ORDER BY md5(t::text)), '')) AS digest "
+                    f'FROM "{table.schema}"."{table.name}" AS t'
+                )
+        query = (
+            "SELECT md5(string_agg(digest, '' ORDER BY i)) "
+            f"FROM ({' UNION ALL '.join(digests)}) AS digests"
         )
+        return db.session.execute(text(query)).scalar()
 
     @classmethod
     def get_and_validate_args(cls, epsg, lang):
@@ -50,13 +185,13 @@ class GetCapabilities(View):
         # from the query arguments.
         if epsg is None:
             try:
-                epsg = request.args.get('epsg', '21781')
+                epsg = request.args.get('epsg', str(DEFAULT_EPSG))
                 epsg = int(epsg)
             except ValueError as error:
                 logger.error('Invalid epsg=%s, must be an int: %s', epsg, error)
                 abort(400, f'Invalid epsg "{epsg}", must be an integer')
         if lang is None:
-            lang = request.args.get('lang', 'de')
+            lang = request.args.get('lang', DEFAULT_LANG)
 
         validate_epsg(epsg)
         validate_lang(lang)
@@ -91,26 +226,35 @@ class GetCapabilities(View):
         ).first()
 
     @classmethod
-    def get_context(cls, models, epsg, lang, is_default_lang, is_default_epsg):
+    def get_data(cls, models):
+        '''Query the layers, themes and metadata of a language'''
         start = time.time()
-        layers_capabilities = cls.get_layers_capabilities(models['GetCap'])
+        layers_capabilities = list(
+            cls.get_layers_capabilities(models['GetCap'])
+        )
         logger.debug('GetCap query done in %fs', time.time() - start)
         start_int = time.time()
-        zoom_levels = cls.get_layers_zoom_level_set(epsg, layers_capabilities)
-        logger.debug('get layers zoom done in %fs', time.time() - start_int)
-        start_int = time.time()
         themes = cls.get_themes(models['GetCapThemes'])
         logger.debug('get cap themes in %fs', time.time() - start_int)
         start_int = time.time()
         metadata = cls.get_metadata(models['ServiceMetadata'])
         logger.debug('get metadata done in %fs', time.time() - start_int)
+        return layers_capabilities, themes, metadata
+
+    @classmethod
+    def get_context(
+        cls, data, epsg, lang, is_default_lang, is_default_epsg, url_base
+    ):
+        start = time.time()
+        layers_capabilities, themes, metadata = data
+        zoom_levels = cls.get_layers_zoom_level_set(epsg, layers_capabilities)
         logger.debug('Zoom levels: %s', zoom_levels)
         context = {
             'layers': layers_capabilities,
             'zoom_levels': zoom_levels,
             'themes': themes,
             'metadata': metadata,
-            'url_base': request.url_root,
+            'url_base': url_base,
             'epsg': epsg,
             'default_tile_matrix_set': get_default_tile_matrix_set(epsg),
             'legend_base_url': app.config["LEGENDS_BASE_URL"],
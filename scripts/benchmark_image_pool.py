@@ -0,0 +1,100 @@
+'''Benchmark of the S3 hits tail latency under a concurrent miss load
+
+The misses wait for a simulated WMS response then crop and encode a gutter
+tile (optimize_image) and hash it, either inline on the gevent event loop
+(--pool-sizes 0) or in the image pool. The hits only wait for a simulated S3
+response, their latency above that delay is the time they were blocked behind
+the image work.
+
+Usage:
+    PYTHONPATH=. python scripts/benchmark_image_pool.py --pool-sizes 0 2 4
+'''
+# pylint: disable=wrong-import-position,wrong-import-order,ungrouped-imports
+import gevent.monkey
+
+gevent.monkey.patch_all()
+
+import argparse
+import statistics
+import time
+
+import gevent
+
+from app.helpers.image_pool import ImagePool
+from app.helpers.utils import digest
+from app.helpers.wmts import optimize_image
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(pool_size, args, content):
+    pool = ImagePool(pool_size, args.max_queue)
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    misses = []
+
+    def miss():
+        while time.monotonic() < deadline:
+            gevent.sleep(args.wms_delay / 1000)
+            tile = pool.run(optimize_image, content, args.gutter)
+            pool.run(digest, tile)
+            misses.append(1)
+
+    def hit():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            gevent.sleep(args.s3_delay / 1000)
+            latencies.append((time.monotonic() - started) * 1000)
+
+    greenlets = [gevent.spawn(miss) for _ in range(args.misses)]
+    greenlets += [gevent.spawn(hit) for _ in range(args.hits)]
+    gevent.joinall(greenlets)
+    return {
+        'pool_size': pool_size,
+        'hits': len(latencies),
+        'misses_per_s': len(misses) / args.duration,
+        'p50': statistics.median(latencies),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--misses', type=int, default=8)
+    parser.add_argument('--hits', type=int, default=50)
+    parser.add_argument(
+        '--s3-delay', type=float, default=5, help='S3 hit delay in ms'
+    )
+    parser.add_argument(
+        '--wms-delay', type=float, default=20, help='WMS miss delay in ms'
+    )
+    parser.add_argument('--gutter', type=int, default=30)
+    parser.add_argument('--image', default='tests/sample/gutter_image.png')
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as fd:
+        content = fd.read()
+    print(
+        f'{"pool size":>9} {"hits":>7} {"misses/s":>9} {"p50 ms":>8} '
+        f'{"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}'
+    )
+    for pool_size in args.pool_sizes:
+        result = run(pool_size, args, content)
+        print(
+            f'{result["pool_size"]:>9} {result["hits"]:>7} '
+            f'{result["misses_per_s"]:>9.1f} {result["p50"]:>8.2f} '
+            f'{result["p95"]:>8.2f} {result["p99"]:>8.2f} '
+            f'{result["max"]:>8.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ CREATE TABLE public.tileset
     format character varying COLLATE pg_catalog."default",
     bgdi_id SERIAL NOT NULL,
     wms_gutter integer NOT NULL DEFAULT 0,
+    wms_metatile integer NOT NULL DEFAULT 1,
     cache_ttl integer DEFAULT 31556952,
     resolution_min numeric DEFAULT 4000.0,
     resolution_max numeric DEFAULT 1,
@@ -47,7 +48,8 @@ CREATE VIEW "service-wmts".view_tileset_concatenated
     min(resolution_max::double precision) AS resolution_max,
     COALESCE(min(s3_resolution_max::float), min(resolution_max::float)) AS s3_resolution_max,
     cache_ttl,
-	  max(wms_gutter) AS wms_gutter
+	  max(wms_gutter) AS wms_gutter,
+	  max(wms_metatile) AS wms_metatile
   FROM tileset tileset
     LEFT JOIN tileset_timestamps time ON tileset.fk_dataset_id::text = time.fk_dataset_id::text
   GROUP BY tileset.fk_dataset_id, tileset.cache_ttl
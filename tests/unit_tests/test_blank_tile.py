@@ -0,0 +1,165 @@
+import io
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app
+from app import settings
+from app.helpers.blank_tile import find_blank_tile
+from app.helpers.blank_tile import get_blank_tile
+from app.helpers.blank_tile import get_blank_tile_name
+from app.helpers.blank_tile import lookup_blank_tile
+from app.helpers.s3 import put_s3_file
+from app.helpers.utils import digest
+from app.helpers.wmts import prepare_wmts_cached_response
+from app.helpers.wmts import split_metatile
+
+TILE_PATH = '1.0.0/inline_points/default/current/2056/17/2/4.png'
+
+
+def to_png(img):
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+class BlankTileTests(unittest.TestCase):
+
+    def test_transparent_tile(self):
+        img = Image.new('RGBA', (256, 256), (0, 0, 0, 0))
+        # the color of the transparent pixels doesn't matter
+        img.paste((255, 0, 0, 0), (0, 0, 10, 10))
+        self.assertEqual(
+            get_blank_tile_name(img, 'png'), 'png-256x256-00000000'
+        )
+
+    def test_uniform_tile(self):
+        img = Image.new('RGB', (256, 256), (255, 255, 255))
+        self.assertEqual(
+            get_blank_tile_name(img, 'png'), 'png-256x256-ffffffff'
+        )
+        self.assertEqual(
+            get_blank_tile_name(img, 'jpeg'), 'jpeg-256x256-ffffffff'
+        )
+
+    def test_palette_tile(self):
+        img = Image.new('P', (256, 256), 3)
+        img.putpalette([0] * 9 + [10, 20, 30])
+        self.assertEqual(
+            get_blank_tile_name(img, 'png'), 'png-256x256-0a141eff'
+        )
+        img.info['transparency'] = 3
+        self.assertEqual(
+            get_blank_tile_name(img, 'png'), 'png-256x256-00000000'
+        )
+
+    def test_not_blank_tile(self):
+        img = Image.new('RGBA', (256, 256), (0, 0, 0, 0))
+        img.paste((255, 0, 0, 255), (0, 0, 1, 1))
+        self.assertIsNone(get_blank_tile_name(img, 'png'))
+        self.assertIsNone(find_blank_tile(to_png(img), 'png'))
+
+    def test_find_blank_tile_with_gutter(self):
+        img = Image.new('RGBA', (276, 276), (0, 0, 0, 0))
+        # data in the gutter only
+        img.paste((255, 0, 0, 255), (0, 0, 5, 5))
+        self.assertEqual(
+            find_blank_tile(to_png(img), 'png', 10), 'png-256x256-00000000'
+        )
+        self.assertIsNone(find_blank_tile(to_png(img), 'png'))
+
+    def test_find_blank_tile_skips_big_images(self):
+        img = Image.effect_noise((256, 256), 100)
+        self.assertIsNone(find_blank_tile(to_png(img), 'png'))
+
+    def test_canonical_blank_tile(self):
+        content = get_blank_tile('png-256x256-00000000')
+        self.assertIs(get_blank_tile('png-256x256-00000000'), content)
+        self.assertEqual(lookup_blank_tile(content), 'png-256x256-00000000')
+        # a copy of the content is found as well
+        self.assertEqual(
+            lookup_blank_tile(bytes(bytearray(content))),
+            'png-256x256-00000000'
+        )
+        with Image.open(io.BytesIO(content)) as img:
+            self.assertEqual(img.size, (256, 256))
+            self.assertEqual(img.getextrema()[3], (0, 0))
+        jpeg = get_blank_tile('jpeg-256x256-ffffffff')
+        with Image.open(io.BytesIO(jpeg)) as img:
+            self.assertEqual(img.format, 'JPEG')
+        self.assertIsNone(lookup_blank_tile(to_png(Image.new('L', (1, 1)))))
+        self.assertIsNone(lookup_blank_tile(None))
+
+    def test_invalid_blank_tile_name(self):
+        for name in ('gif-256x256-00000000', 'png-256x256-00', 'png', 'a-b-c'):
+            with self.assertRaises(ValueError):
+                get_blank_tile(name)
+
+    def test_split_metatile_blank_tiles(self):
+        img = Image.new('RGBA', (512, 256), (0, 0, 0, 0))
+        img.paste((255, 0, 0, 255), (0, 0, 256, 10))
+        with app.test_request_context(f'/{TILE_PATH}'):
+            with patch.object(settings, 'BLANK_TILE_DEDUP', True):
+                tiles = split_metatile(to_png(img), [2, 4, 3, 4], 0, 256)
+        self.assertIsNone(lookup_blank_tile(tiles[(2, 4)]))
+        self.assertIs(tiles[(3, 4)], get_blank_tile('png-256x256-00000000'))
+
+
+class BlankTileS3Tests(unittest.TestCase):
+
+    @patch('app.helpers.s3.s3_client')
+    def test_put_blank_tile_marker(self, mock_s3_client):
+        content = get_blank_tile('png-256x256-00000000')
+        put_s3_file(content, TILE_PATH, {'Content-Type': 'image/png'})
+        kwargs = mock_s3_client.put_object.call_args.kwargs
+        self.assertEqual(kwargs['Body'], b'')
+        self.assertEqual(kwargs['ContentLength'], 0)
+        self.assertEqual(
+            kwargs['Metadata'], {'blank-tile': 'png-256x256-00000000'}
+        )
+
+        put_s3_file(b'tile', TILE_PATH, {'Content-Type': 'image/png'})
+        kwargs = mock_s3_client.put_object.call_args.kwargs
+        self.assertEqual(kwargs['Body'], b'tile')
+        self.assertNotIn('Metadata', kwargs)
+
+    def test_get_blank_tile_marker(self):
+        content = get_blank_tile('png-256x256-00000000')
+        s3_resp = MagicMock(status=200)
+        s3_resp.getheaders.return_value = [
+            ('Content-Type', 'image/png'),
+            ('Content-Length', '0'),
+            ('ETag', '"d41d8cd98f00b204e9800998ecf8427e"'),
+            ('x-amz-meta-blank-tile', 'png-256x256-00000000'),
+        ]
+        status_code, body, headers = prepare_wmts_cached_response(s3_resp, b'')
+        self.assertEqual(status_code, 200)
+        self.assertIs(body, content)
+        self.assertEqual(headers['ETag'], f'"{digest(content)}"')
+        self.assertEqual(headers['Content-Length'], str(len(content)))
+        self.assertEqual(headers['X-Tiles-Blank'], 'png-256x256-00000000')
+
+        status_code, body, headers = prepare_wmts_cached_response(
+            s3_resp, b'', f'"{digest(content)}"'
+        )
+        self.assertEqual(status_code, 304)
+        self.assertIsNone(body)
+
+        status_code, body, headers = prepare_wmts_cached_response(
+            s3_resp, b'', f'"1234", W/"{digest(content)}"'
+        )
+        self.assertEqual(status_code, 304)
+
+    def test_get_tile_from_s3(self):
+        s3_resp = MagicMock(status=200)
+        s3_resp.getheaders.return_value = [('Content-Type', 'image/png'),
+                                           ('ETag', '"1"')]
+        status_code, body, headers = prepare_wmts_cached_response(
+            s3_resp, b'tile', '"1"'
+        )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body, b'tile')
+        self.assertEqual(headers['ETag'], '"1"')
+        self.assertNotIn('X-Tiles-Blank', headers)
@@ -1,11 +1,15 @@
 import unittest
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
 import requests
 
 from app import app
+from app.helpers.wms import WmsBackendPool
 from app.version import APP_VERSION
 
+READY = b'No query information to decode. QUERY_STRING is set, but empty.'
+
 
 class CheckerTests(unittest.TestCase):
 
@@ -56,3 +60,40 @@ class CheckerTests(unittest.TestCase):
         )
         resp = self.app.get('/checker/ready')
         self.assertEqual(resp.status_code, 503)
+
+    @patch('app.helpers.wms.get_backend')
+    def test_backend_pool_checker(self, mock_get_backend):
+        pool = WmsBackendPool(['http://wms-1/mapserv', 'http://wms-2/mapserv'],
+                              [])
+        responses = {
+            'http://wms-1/mapserv': requests.exceptions.ConnectionError(),
+            'http://wms-2/mapserv': MagicMock(content=READY),
+        }
+
+        def get_backend(url):
+            if isinstance(responses[url], Exception):
+                raise responses[url]
+            return responses[url]
+
+        mock_get_backend.side_effect = get_backend
+        with patch('app.helpers.wms.wms_backend_pool', pool):
+            # ready as long as one backend is
+            resp = self.app.get('/checker/ready')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(mock_get_backend.call_count, 2)
+
+            # the backends not ejected are checked first
+            pool.backends['http://wms-1/mapserv'].ejected_until = 1e12
+            mock_get_backend.reset_mock()
+            resp = self.app.get('/checker/ready')
+            self.assertEqual(resp.status_code, 200)
+            mock_get_backend.assert_called_once_with('http://wms-2/mapserv')
+
+            responses['http://wms-2/mapserv'] = MagicMock(content=b'Not ready')
+            resp = self.app.get('/checker/ready')
+            self.assertEqual(resp.status_code, 503)
+
+            responses['http://wms-2/mapserv'] = \
+                requests.exceptions.Timeout()
+            resp = self.app.get('/checker/ready')
+            self.assertEqual(resp.status_code, 502)
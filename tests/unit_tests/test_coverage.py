@@ -0,0 +1,190 @@
+import unittest
+
+import numpy as np
+
+from app.helpers.coverage import count_tiles
+from app.helpers.coverage import get_tile_array
+from app.helpers.coverage import get_tile_range
+from app.helpers.coverage import get_tile_ranges
+from app.helpers.coverage import get_tiles
+from app.helpers.coverage import iter_tile_blocks
+from app.helpers.coverage import load_geojson_polygons
+from app.helpers.coverage import to_path_order
+from app.helpers.grids import TILE_GRIDS
+from app.helpers.grids import get_tile_grid
+
+
+def intersects(bounds, polygon):
+    # Reference intersection test of a tile and of a convex polygon with the
+    # separating axis theorem (touching shapes intersect)
+    corners = [(bounds[0], bounds[1]), (bounds[2], bounds[1]),
+               (bounds[2], bounds[3]), (bounds[0], bounds[3])]
+    axes = [(1, 0), (0, 1)]
+    for start, end in zip(polygon, polygon[1:]):
+        axes.append((start[1] - end[1], end[0] - start[0]))
+    for axis in axes:
+        tile = [axis[0] * x + axis[1] * y for x, y in corners]
+        shape = [axis[0] * x + axis[1] * y for x, y in polygon]
+        if max(tile) < min(shape) or max(shape) < min(tile):
+            return False
+    return True
+
+
+class CoverageTests(unittest.TestCase):
+
+    def test_bbox_tiles(self):
+        grid = get_tile_grid(2056)
+        tiles = get_tiles(grid, 18, [2600000, 1200000, 2612800, 1212800])
+        # 50m resolution => 12.8km tiles
+        self.assertEqual(len(tiles), 4)
+        for col, row in tiles:
+            bounds = grid.tileBounds(18, col, row)
+            self.assertTrue(bounds[0] <= 2612800 and bounds[2] >= 2600000)
+            self.assertTrue(bounds[1] <= 1212800 and bounds[3] >= 1200000)
+        # tiles only touching the bbox are not part of it
+        bounds = grid.tileBounds(18, *tiles[0])
+        self.assertEqual(get_tiles(grid, 18, bounds), [tiles[0]])
+
+    def test_out_of_extent(self):
+        self.assertEqual(get_tiles(get_tile_grid(2056), 18, [0, 0, 10, 10]), [])
+        self.assertIsNone(get_tile_range(get_tile_grid(2056), 18, [0, 0, 1, 1]))
+
+    def test_tile_ranges(self):
+        for srid, grid in TILE_GRIDS.items():
+            with self.subTest(srid=srid):
+                zooms = list(range(len(grid.RESOLUTIONS)))
+                # the whole grid
+                ranges = get_tile_ranges(grid, zooms)
+                for zoom, tile_range in zip(zooms, ranges.tolist()):
+                    min_row, min_col, max_row, max_col = \
+                        grid.extent_addresses[zoom]
+                    self.assertEqual(
+                        tile_range, [min_col, min_row, max_col, max_row]
+                    )
+                # a bbox in the middle of the grid
+                extent = grid.extent
+                bbox = [
+                    extent[0] + (extent[2] - extent[0]) * 0.3137,
+                    extent[1] + (extent[3] - extent[1]) * 0.4711,
+                    extent[0] + (extent[2] - extent[0]) * 0.5309,
+                    extent[1] + (extent[3] - extent[1]) * 0.6907,
+                ]
+                ranges = get_tile_ranges(grid, zooms, bbox)
+                for zoom, tile_range in zip(zooms, ranges.tolist()):
+                    min_row, min_col, max_row, max_col = \
+                        grid.getExtentAddress(zoom, extent=bbox)
+                    self.assertEqual(
+                        tile_range, [min_col, min_row, max_col, max_row]
+                    )
+                counts = count_tiles(grid, zooms, bbox)
+                self.assertEqual(
+                    counts[zooms[10]],
+                    len(get_tile_array(grid, zooms[10], bbox))
+                )
+
+    def test_polygon_tiles(self):
+        for srid, grid in TILE_GRIDS.items():
+            with self.subTest(srid=srid):
+                extent = grid.extent
+                zoom = len(grid.RESOLUTIONS) - 8
+                size = grid.tile_sizes[zoom]
+                x = (extent[0] + extent[2]) / 2
+                y = (extent[1] + extent[3]) / 2
+                triangle = [(x, y), (x + 9.3 * size, y + 3.1 * size),
+                            (x + 2.2 * size, y + 7.7 * size), (x, y)]
+                tiles = get_tiles(grid, zoom, polygons=[[triangle]])
+                bbox_tiles = get_tiles(
+                    grid, zoom, [x, y, x + 9.3 * size, y + 7.7 * size]
+                )
+                expected = [
+                    tile for tile in bbox_tiles
+                    if intersects(grid.tileBounds(zoom, *tile), triangle)
+                ]
+                self.assertEqual(tiles, expected)
+                self.assertLess(len(tiles), len(bbox_tiles))
+
+    def test_polygon_with_hole(self):
+        grid = get_tile_grid(2056)
+        bbox_tiles = get_tiles(grid, 18, [2600001, 1200001, 2700000, 1299999])
+        polygons = load_geojson_polygons({
+            'type': 'MultiPolygon',
+            'coordinates': [[
+                [[2600001, 1200001], [2700000, 1200001], [2700000, 1299999],
+                 [2600001, 1299999], [2600001, 1200001]],
+                [[2620000, 1220000], [2680000, 1220000], [2680000, 1280000],
+                 [2620000, 1280000], [2620000, 1220000]],
+            ]]
+        })
+        tiles = get_tiles(grid, 18, polygons=polygons)
+        self.assertLess(len(tiles), len(bbox_tiles))
+        self.assertTrue(set(tiles) < set(bbox_tiles))
+        center = get_tile_range(grid, 18, [2650000, 1250000, 2650001, 1250001])
+        self.assertNotIn(tuple(center[:2]), tiles)
+        self.assertEqual(
+            count_tiles(grid, [18], polygons=polygons), {18: len(tiles)}
+        )
+
+    def test_overlapping_polygons(self):
+        grid = get_tile_grid(2056)
+
+        def square(x, y):
+            return {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[[x, y], [x + 10000,
+                                              y], [x + 10000, y + 10000],
+                                     [x, y + 10000], [x, y]]]
+                }
+            }
+
+        features = [square(2600000, 1200000), square(2605000, 1205000)]
+        polygons = load_geojson_polygons({
+            'type': 'FeatureCollection', 'features': features
+        })
+        for zoom in (22, 24, 26):
+            with self.subTest(zoom=zoom):
+                union = set()
+                for feature in features:
+                    union.update(
+                        get_tiles(
+                            grid, zoom, polygons=load_geojson_polygons(feature)
+                        )
+                    )
+                tiles = get_tiles(grid, zoom, polygons=polygons)
+                self.assertEqual(set(tiles), union)
+                self.assertEqual(
+                    count_tiles(grid, [zoom], polygons=polygons),
+                    {zoom: len(union)}
+                )
+
+    def test_tile_blocks(self):
+        grid = get_tile_grid(2056)
+        zoom = 24
+        size = grid.tile_sizes[zoom]
+        x, y = 2600000, 1200000
+        triangle = [(x, y), (x + 93.3 * size, y + 31.1 * size),
+                    (x + 22.2 * size, y + 77.7 * size), (x, y)]
+        bbox = [x, y, x + 93.3 * size, y + 77.7 * size]
+        for area in ({'bbox': bbox}, {'polygons': [[triangle]]}):
+            for block_size in (37, 100, 1000, 100000):
+                with self.subTest(area=list(area), block_size=block_size):
+                    blocks = list(
+                        iter_tile_blocks(grid, zoom, block_size, **area)
+                    )
+                    self.assertTrue(
+                        all(0 < len(block) <= block_size for block in blocks)
+                    )
+                    tiles = np.concatenate(blocks).tolist()
+                    self.assertEqual(
+                        sorted(tiles),
+                        sorted(get_tile_array(grid, zoom, **area).tolist())
+                    )
+        self.assertEqual(
+            list(iter_tile_blocks(grid, zoom, 10, bbox=[0, 0, 1, 1])), []
+        )
+
+    def test_path_order(self):
+        tiles = np.array([[1, 2], [3, 4]])
+        self.assertEqual(to_path_order(2056, tiles).tolist(), [[1, 2], [3, 4]])
+        self.assertEqual(to_path_order(21781, tiles).tolist(), [[2, 1], [4, 3]])
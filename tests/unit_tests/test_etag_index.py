@@ -0,0 +1,129 @@
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app.helpers.etag_index import EtagIndex
+from app.helpers.etag_index import etag_index
+from app.helpers.etag_index import etag_matches
+from app.helpers.tile_cache import cache_tile
+from app.helpers.tile_cache import evict_cached_tile
+from app.helpers.tile_cache import tile_cache
+
+TILE_PATH = '1.0.0/inline_points/default/current/2056/17/4/7.png'
+
+
+class EtagIndexTests(unittest.TestCase):
+
+    def test_lru(self):
+        index = EtagIndex(2)
+        self.assertTrue(index.set('a', '"a"', 'max-age=60', 10))
+        self.assertTrue(index.set('b', '"b"', None, 10))
+        self.assertEqual(index.get('a'), ('"a"', 'max-age=60'))
+        index.set('c', '"c"', None, 10)
+        self.assertIsNone(index.get('b'))
+        self.assertEqual(index.get('c'), ('"c"', None))
+        self.assertEqual(
+            index.stats(),
+            {
+                'entries': 2,
+                'max_entries': 2,
+                'hits': 2,
+                'misses': 1,
+                'evictions': 1,
+                'expirations': 0,
+                'purged': 0,
+            }
+        )
+
+    def test_ttl(self):
+        index = EtagIndex(2)
+        self.assertFalse(index.set('a', '"a"', None, 0))
+        self.assertFalse(index.set('a', None, None, 10))
+        index.set('a', '"a"', None, 10)
+        with patch('time.monotonic', return_value=float('inf')):
+            self.assertIsNone(index.get('a'))
+        self.assertEqual(index.stats()['expirations'], 1)
+
+    def test_disabled(self):
+        index = EtagIndex(0)
+        self.assertFalse(index.set('a', '"a"', None, 10))
+        self.assertIsNone(index.get('a'))
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"a"', '"a"'))
+        self.assertTrue(etag_matches('"b", W/"a"', '"a"'))
+        self.assertTrue(etag_matches('*', '"a"'))
+        self.assertFalse(etag_matches('"b"', '"a"'))
+        self.assertFalse(etag_matches(None, '"a"'))
+
+
+class EtagIndexResponseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        etag_index.clear()
+        self.addCleanup(etag_index.clear)
+        # Tiles evicted from the memory cache are still indexed
+        patcher = patch.object(tile_cache, 'max_bytes', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        s3_resp = MagicMock(status=200)
+        s3_resp.getheaders.return_value = [
+            ('Content-Type', 'image/png'),
+            ('Cache-Control', 'public, max-age=1800'),
+            ('ETag', '"1234"'),
+        ]
+        patcher = patch(
+            'app.routes.get_s3_file', return_value=(s3_resp, b'tile')
+        )
+        self.mock_get_s3_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_conditional_request_without_s3(self):
+        resp = self.app.get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.mock_get_s3_file.call_count, 1)
+
+        resp = self.app.get(
+            f'/{TILE_PATH}', headers={'If-None-Match': '"1234"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], '"1234"')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=1800')
+        self.assertEqual(resp.headers['X-Tiles-ETag-Index'], 'hit')
+        self.assertEqual(self.mock_get_s3_file.call_count, 1)
+
+        # ETag mismatch
+        resp = self.app.get(f'/{TILE_PATH}', headers={'If-None-Match': '"1"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.mock_get_s3_file.call_count, 2)
+
+    def test_rendered_tile_indexed(self):
+        cache_tile(TILE_PATH, b'tile', {'Etag': '"5678"'}, {'cache_ttl': 1800})
+        resp = self.app.get(
+            f'/{TILE_PATH}', headers={'If-None-Match': '"5678"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.mock_get_s3_file.assert_not_called()
+
+        # purged tiles are evicted
+        self.assertTrue(evict_cached_tile(TILE_PATH))
+        resp = self.app.get(
+            f'/{TILE_PATH}', headers={'If-None-Match': '"5678"'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.mock_get_s3_file.assert_called_once()
+
+    def test_variant(self):
+        cache_tile(
+            TILE_PATH.replace('.png', '.webp'),
+            b'tile', {'ETag': '"webp"'},
+            None
+        )
+        resp = self.app.get(
+            f'/{TILE_PATH.replace(".png", ".webp")}',
+            headers={'If-None-Match': '"webp"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['X-Tiles-ETag-Index'], 'hit')
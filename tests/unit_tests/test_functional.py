@@ -1,6 +1,8 @@
+import io
 import unittest
 from datetime import datetime
 
+from gatilegrid import getTileGrid
 from PIL import Image
 from werkzeug import exceptions
 
@@ -8,6 +10,10 @@ from app import app
 from app.helpers.utils import crop_image
 from app.helpers.utils import extend_bbox
 from app.helpers.utils import is_still_valid_tile
+from app.helpers.wmts import get_metatile_address
+from app.helpers.wmts import get_tile_address
+from app.helpers.wmts import get_tile_path
+from app.helpers.wmts import split_metatile
 from app.views import GetCapabilities
 
 
@@ -62,6 +68,61 @@ class FunctionalGetTileTests(unittest.TestCase):
         self.assertEqual(is_still_valid_tile(headers, datetime.now()), False)
 
 
+class FunctionalMetatileTests(unittest.TestCase):
+
+    def test_tile_address_and_path(self):
+        path = '/1.0.0/inline_points/default/current/21781/20/76/44.png'
+        with app.test_request_context(path):
+            self.assertEqual(get_tile_address(), (44, 76))
+            self.assertEqual(get_tile_path(44, 76), path.lstrip('/'))
+
+        path = '/1.0.0/inline_points/default/current/2056/17/4/7.png'
+        with app.test_request_context(path):
+            self.assertEqual(get_tile_address(), (4, 7))
+            self.assertEqual(get_tile_path(4, 7), path.lstrip('/'))
+
+    def test_metatile_address(self):
+        gagrid = getTileGrid(2056)()
+        with app.test_request_context(
+            '/1.0.0/inline_points/default/current/2056/20/45/27.png'
+        ):
+            self.assertEqual(get_metatile_address(gagrid, 4), [44, 24, 47, 27])
+        # metatile is clipped to the grid extent
+        with app.test_request_context(
+            '/1.0.0/inline_points/default/current/2056/17/4/7.png'
+        ):
+            self.assertEqual(get_metatile_address(gagrid, 8), [0, 0, 7, 7])
+
+    def test_split_metatile(self):
+        gutter = 10
+        colors = {
+            (2, 4): (255, 0, 0, 255),
+            (3, 4): (0, 255, 0, 255),
+            (2, 5): (0, 0, 255, 255),
+            (3, 5): (0, 0, 0, 0),
+        }
+        img = Image.new('RGBA', (512 + gutter * 2, 512 + gutter * 2))
+        for (col, row), color in colors.items():
+            left = gutter + (col - 2) * 256
+            upper = gutter + (row - 4) * 256
+            img.paste(color, (left, upper, left + 256, upper + 256))
+        out = io.BytesIO()
+        img.save(out, format='PNG')
+
+        with app.test_request_context(
+            '/1.0.0/inline_points/default/current/2056/17/2/4.png'
+        ):
+            tiles = split_metatile(out.getvalue(), [2, 4, 3, 5], gutter, 256)
+        self.assertEqual(set(tiles.keys()), set(colors.keys()))
+        for address, content in tiles.items():
+            with Image.open(io.BytesIO(content)) as tile:
+                self.assertEqual(tile.size, (256, 256))
+                self.assertEqual(
+                    tile.getextrema(),
+                    tuple((channel, channel) for channel in colors[address])
+                )
+
+
 class FunctionalGetCapTests(unittest.TestCase):
 
     def test_invalid_query(self):
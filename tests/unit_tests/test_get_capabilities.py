@@ -1,4 +1,5 @@
 # pylint: disable=c-extension-no-member
+import gzip
 import unittest
 from unittest.mock import patch
 from uuid import uuid4
@@ -9,9 +10,12 @@ from flask import url_for
 
 from app import app
 from app import settings
+from app.helpers.capabilities_cache import brotli
+from app.helpers.capabilities_cache import capabilities_cache
 from app.models import GetCapDe
 from app.models import GetCapThemesDe
 from app.models import ServiceMetadataDe
+from app.views import GetCapabilities
 
 
 def mock_request(
@@ -74,6 +78,7 @@ class GetCapabilitiesTest(unittest.TestCase):
         self.client.testing = True
         self.ctx = app.test_request_context()
         self.ctx.push()
+        capabilities_cache.clear()
 
     def tearDown(self):
         self.ctx.pop()
@@ -190,3 +195,126 @@ class GetCapabilitiesTest(unittest.TestCase):
             msg='Missing cache-control max-age directive '
             'in GetCapabilities response.'
         )
+
+    @patch('app.views.GetCapabilities.get_layers_capabilities')
+    @patch('app.views.GetCapabilities.get_themes')
+    @patch('app.views.GetCapabilities.get_metadata')
+    def test_get_capabilities_cache(
+        self, get_metadata_mock, get_themes_mock, get_layers_capabilities_mock
+    ):
+        mock_request(
+            get_layers_capabilities_mock, get_themes_mock, get_metadata_mock
+        )
+        url = url_for(
+            'get_capabilities_1', version='1.0.0', epsg=2056, lang='de'
+        )
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http://localhost/1.0.0/test-layer-1/', response.data)
+        self.assertEqual(get_layers_capabilities_mock.call_count, 1)
+
+        # served from the cache with the url base of the request
+        response = self.client.get(url, base_url='https://wmts.example.org')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'https://wmts.example.org/1.0.0/test-layer-1/', response.data
+        )
+        self.assertNotIn(b'http://localhost/', response.data)
+        self.assertEqual(get_layers_capabilities_mock.call_count, 1)
+
+        # the other documents are rendered on demand
+        response = self.client.get(
+            url_for('get_capabilities_4', version='1.0.0')
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_layers_capabilities_mock.call_count, 2)
+
+    @patch('app.views.GetCapabilities.get_fingerprint')
+    @patch('app.views.GetCapabilities.get_layers_capabilities')
+    @patch('app.views.GetCapabilities.get_themes')
+    @patch('app.views.GetCapabilities.get_metadata')
+    def test_get_capabilities_cache_refresh(
+        self,
+        get_metadata_mock,
+        get_themes_mock,
+        get_layers_capabilities_mock,
+        get_fingerprint_mock
+    ):
+        mock_request(
+            get_layers_capabilities_mock, get_themes_mock, get_metadata_mock
+        )
+        get_fingerprint_mock.return_value = 'digest-1'
+        GetCapabilities.prerender_cache()
+        # the BOD is queried once per language
+        self.assertEqual(get_layers_capabilities_mock.call_count, 5)
+        self.assertEqual(
+            len(capabilities_cache.keys()),
+            len(GetCapabilities.get_cache_keys())
+        )
+        response = self.client.get(
+            url_for('get_capabilities_2', version='1.0.0', epsg=4326)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_layers_capabilities_mock.call_count, 5)
+
+        # unchanged BOD
+        GetCapabilities.refresh_cache()
+        self.assertEqual(get_layers_capabilities_mock.call_count, 5)
+
+        get_fingerprint_mock.return_value = 'digest-2'
+        get_layers_capabilities_mock.return_value[0].id = 'changed-layer'
+        GetCapabilities.refresh_cache()
+        self.assertEqual(get_layers_capabilities_mock.call_count, 10)
+        self.assertEqual(capabilities_cache.fingerprint, 'digest-2')
+        response = self.client.get(
+            url_for('get_capabilities_2', version='1.0.0', epsg=4326)
+        )
+        self.assertIn(b'changed-layer', response.data)
+
+    @patch('app.views.GetCapabilities.get_layers_capabilities')
+    @patch('app.views.GetCapabilities.get_themes')
+    @patch('app.views.GetCapabilities.get_metadata')
+    def test_get_capabilities_compression(
+        self, get_metadata_mock, get_themes_mock, get_layers_capabilities_mock
+    ):
+        mock_request(
+            get_layers_capabilities_mock, get_themes_mock, get_metadata_mock
+        )
+        url = url_for('get_capabilities_4', version='1.0.0')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        document = response.data
+
+        response = self.client.get(
+            url, headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.data), document)
+
+        response = self.client.get(
+            url, headers={'Accept-Encoding': 'gzip;q=0, identity'}
+        )
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, document)
+
+    @unittest.skipIf(brotli is None, reason="Brotli is not installed")
+    @patch('app.views.GetCapabilities.get_layers_capabilities')
+    @patch('app.views.GetCapabilities.get_themes')
+    @patch('app.views.GetCapabilities.get_metadata')
+    def test_get_capabilities_brotli(
+        self, get_metadata_mock, get_themes_mock, get_layers_capabilities_mock
+    ):
+        mock_request(
+            get_layers_capabilities_mock, get_themes_mock, get_metadata_mock
+        )
+        url = url_for('get_capabilities_4', version='1.0.0')
+        document = self.client.get(url).data
+        response = self.client.get(
+            url, headers={'Accept-Encoding': 'gzip, deflate, br'}
+        )
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.data), document)
@@ -10,6 +10,9 @@ from PIL import Image
 
 from app import app
 from app import settings
+from app.helpers.etag_index import etag_index
+from app.helpers.s3 import s3_connection_pool
+from app.helpers.tile_cache import tile_cache
 from app.helpers.wmts import handle_2nd_level_cache
 from app.helpers.wmts_config import init_wmts_config
 
@@ -49,6 +52,7 @@ class HttpResponseMock:
     def __init__(self, status, headers, data):
         self.status = status
         self.reason = "reason"
+        self.will_close = False
         self.headers = headers
         self.data = data
 
@@ -70,6 +74,9 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.app.testing = True
+        tile_cache.clear()
+        etag_index.clear()
+        s3_connection_pool.clear()
 
         self.data = get_image_data()
         self.mock_get_s3_file_response_ok = HttpResponseMock(
@@ -492,6 +499,44 @@ class GetTileRequestsS3Tests(BaseTest):
         )
         self.assert2ndCacheHeader(resp, False)
 
+    def test_wmts_metatile(self, mock_wms, mock_get_s3_file):
+        mock_get_s3_file.return_value = self.mock_get_s3_file_conn_nok
+        gutter = 30
+        img = Image.new('RGBA', (512 + gutter * 2, 512 + gutter * 2))
+        out = io.BytesIO()
+        img.save(out, format='PNG')
+        mock_wms.get(
+            settings.WMS_BACKEND,
+            content=out.getvalue(),
+            headers={'Content-Type': 'image/png'}
+        )
+
+        with patch(
+            'app.helpers.wmts.get_metatile_size', return_value=2
+        ) as mock_get_metatile_size, patch(
+            'app.helpers.wmts.queue_s3_file'
+        ) as mock_queue_s3_file:
+            resp = self.app.get(
+                '/1.0.0/inline_points/default/current/2056/20/45/27.png'
+            )
+            resp.close()
+        mock_get_metatile_size.assert_called_once()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Tiles-Metatile'], '4 tiles')
+        self.assertEqual(mock_wms.last_request.qs['width'], ['572'])
+        self.assertEqual(mock_wms.last_request.qs['height'], ['572'])
+        with Image.open(io.BytesIO(resp.data)) as tile:
+            self.assertEqual(tile.size, (256, 256))
+        self.assertEqual(
+            sorted(call.args[1] for call in mock_queue_s3_file.call_args_list),
+            [
+                '1.0.0/inline_points/default/current/2056/20/44/26.png',
+                '1.0.0/inline_points/default/current/2056/20/44/27.png',
+                '1.0.0/inline_points/default/current/2056/20/45/26.png',
+                '1.0.0/inline_points/default/current/2056/20/45/27.png',
+            ]
+        )
+
 
 @patch('http.client.HTTPConnection')
 class GetTileRequestsFromS3Tests(BaseTest):
@@ -505,6 +550,40 @@ class GetTileRequestsFromS3Tests(BaseTest):
         self.assertEqual(resp.status_code, 200)
         self.assert2ndCacheHeader(resp, True)
 
+    def test_wmts_from_memory_cache(self, mock_get_s3_file):
+        mock_get_s3_file.return_value = self.mock_get_s3_file_conn_ok
+        self.mock_get_s3_file_response_ok.headers['ETag'] = '"1234"'
+
+        resp = self.app.get(
+            '1.0.0/inline_points/default/current/2056/17/4/7.png'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('X-Tiles-Memory-Cache', resp.headers)
+        mock_get_s3_file.assert_called_once()
+
+        resp = self.app.get(
+            '1.0.0/inline_points/default/current/2056/17/4/7.png'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.data)
+        self.assert2ndCacheHeader(resp, True)
+        self.assertEqual(resp.headers['X-Tiles-Memory-Cache'], 'hit')
+
+        resp = self.app.get(
+            '1.0.0/inline_points/default/current/2056/17/4/7.png',
+            headers={'If-None-Match': '"1234"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        mock_get_s3_file.assert_called_once()
+        self.assertEqual(tile_cache.stats()['hits'], 2)
+
+        resp = self.app.get(
+            '1.0.0/inline_points/default/current/2056/17/4/7.png',
+            headers={'If-None-Match': '"5678", W/"1234"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        mock_get_s3_file.assert_called_once()
+
     def test_wmts_cadastral_wms_proxy_from_s3_cache_preview(
         self, mock_get_s3_file
     ):
@@ -0,0 +1,69 @@
+import unittest
+
+from gatilegrid import getTileGrid
+
+from app.helpers.grids import SUPPORTED_SRIDS
+from app.helpers.grids import get_tile_grid
+
+
+class TileGridTests(unittest.TestCase):
+
+    def test_unsupported_srid(self):
+        self.assertIsNone(get_tile_grid(1234))
+
+    def test_same_as_gatilegrid(self):
+        for srid in SUPPORTED_SRIDS:
+            gagrid = getTileGrid(srid)()
+            grid = get_tile_grid(srid)
+            self.assertIs(grid, get_tile_grid(srid))
+            self.assertFalse(grid.is_valid_zoom(-1))
+            self.assertFalse(grid.is_valid_zoom(len(gagrid.RESOLUTIONS)))
+            self.assertEqual(grid.metersPerUnit, gagrid.metersPerUnit)
+            for zoom in range(len(gagrid.RESOLUTIONS)):
+                with self.subTest(srid=srid, zoom=zoom):
+                    self.assertTrue(grid.is_valid_zoom(zoom))
+                    self.assertEqual(
+                        grid.getResolution(zoom), gagrid.getResolution(zoom)
+                    )
+                    self.assertEqual(grid.getScale(zoom), gagrid.getScale(zoom))
+                    self.assertEqual(
+                        grid.getExtentAddress(zoom),
+                        gagrid.getExtentAddress(zoom)
+                    )
+                    self.assertEqual(
+                        grid.matrix_sizes[zoom],
+                        (
+                            gagrid.numberOfXTilesAtZoom(zoom),
+                            gagrid.numberOfYTilesAtZoom(zoom)
+                        )
+                    )
+                    min_row, min_col, max_row, max_col = \
+                        gagrid.getExtentAddress(zoom)
+                    for col, row in [(min_col, min_row), (max_col, max_row),
+                                     ((min_col + max_col) // 2,
+                                      (min_row + max_row) // 2),
+                                     (max_col + 10, max_row + 10)]:
+                        bounds = grid.tileBounds(zoom, col, row)
+                        self.assertEqual(
+                            bounds, gagrid.tileBounds(zoom, col, row)
+                        )
+                        self.assertEqual(
+                            grid.intersectsExtent(bounds),
+                            gagrid.intersectsExtent(bounds)
+                        )
+
+    def test_closest_zoom(self):
+        for srid in SUPPORTED_SRIDS:
+            gagrid = getTileGrid(srid)()
+            grid = get_tile_grid(srid)
+            for resolution in [5000, 4000, 100, 12.3, 0.5, 0.01]:
+                with self.subTest(srid=srid, resolution=resolution):
+                    self.assertEqual(
+                        grid.getClosestZoom(resolution),
+                        gagrid.getClosestZoom(resolution)
+                    )
+                    # memoized
+                    self.assertEqual(
+                        grid.getClosestZoom(resolution),
+                        gagrid.getClosestZoom(resolution)
+                    )
@@ -0,0 +1,83 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from flask import request
+
+from app import app
+from app.helpers.image_pool import HASH_OFFLOAD_MIN_BYTES
+from app.helpers.image_pool import ImagePool
+from app.helpers.image_pool import hash_in_image_pool
+
+
+def current_thread_name(*_):
+    return threading.current_thread().name
+
+
+class ImagePoolTests(unittest.TestCase):
+
+    def test_run_in_pool(self):
+        pool = ImagePool(2, 4)
+        self.assertTrue(pool.run(current_thread_name).startswith('image'))
+        self.assertEqual(pool.run(sum, [1, 2, 3]), 6)
+        stats = pool.stats()
+        self.assertEqual(stats['tasks'], 2)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_run_inline(self):
+        pool = ImagePool(0, 4)
+        self.assertEqual(pool.run(current_thread_name), current_thread_name())
+        self.assertEqual(pool.stats()['tasks'], 0)
+
+    def test_request_context(self):
+        pool = ImagePool(1, 1)
+        with app.test_request_context('/1.0.0/layer/default/current/a.png'):
+            self.assertEqual(
+                pool.run(lambda: request.path),
+                '/1.0.0/layer/default/current/a.png'
+            )
+
+    def test_exception(self):
+        pool = ImagePool(1, 1)
+        with self.assertRaises(ZeroDivisionError):
+            pool.run(lambda: 1 / 0)
+        self.assertEqual(pool.stats()['pending'], 0)
+
+    def test_bounded_queue(self):
+        pool = ImagePool(1, 0)
+        release = threading.Event()
+        started = threading.Event()
+
+        def task():
+            started.set()
+            return release.wait(5)
+
+        first = threading.Thread(target=pool.run, args=(task,))
+        first.start()
+        self.assertTrue(started.wait(5))
+        results = []
+        second = threading.Thread(
+            target=lambda: results.append(pool.run(current_thread_name))
+        )
+        second.start()
+        second.join(0.1)
+        # no free slot, the second task waits
+        self.assertTrue(second.is_alive())
+        self.assertEqual(pool.stats()['waited'], 1)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(pool.stats()['tasks'], 2)
+
+    def test_hash_in_image_pool(self):
+        with patch('app.helpers.image_pool.image_pool', ImagePool(1, 1)):
+            self.assertEqual(
+                hash_in_image_pool(current_thread_name, b'small'),
+                current_thread_name()
+            )
+            self.assertTrue(
+                hash_in_image_pool(
+                    current_thread_name, b'0' * HASH_OFFLOAD_MIN_BYTES
+                ).startswith('image')
+            )
@@ -0,0 +1,152 @@
+import io
+import random
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app
+from app.helpers.png_profile import encode_png
+from app.helpers.png_profile import get_png_save_options
+from app.helpers.png_profile import parse_png_profile
+from app.helpers.wmts import optimize_image
+from app.helpers.wmts import split_metatile
+from app.helpers.wmts_config import get_wmts_config_from_db
+
+PROFILE = {'colors': 64, 'compress_level': 9}
+
+
+def get_thematic_image(size=256, gutter=0, colors=40):
+    '''Return a RGBA image with few colors'''
+    rand = random.Random(42)
+    palette = [(
+        rand.randrange(256),
+        rand.randrange(256),
+        rand.randrange(256),
+        rand.choice([128, 255])
+    ) for _ in range(colors)]
+    img = Image.new('RGBA', (size + 2 * gutter, size + 2 * gutter))
+    for i in range(400):
+        left, upper = rand.randrange(size), rand.randrange(size)
+        img.paste(palette[i % colors], (left, upper, left + 16, upper + 16))
+    return img
+
+
+def to_png(img):
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+class PngProfileTests(unittest.TestCase):
+
+    def test_parse_profile(self):
+        self.assertIsNone(parse_png_profile(None))
+        self.assertIsNone(parse_png_profile(''))
+        self.assertEqual(
+            parse_png_profile('{"colors": 64, "strategy": "rle"}'),
+            {
+                'colors': 64,
+                'dither': False,
+                'compress_level': None,
+                'strategy': 'rle',
+                'optimize': False
+            }
+        )
+        self.assertEqual(
+            parse_png_profile({
+                'compress_level': 9, 'optimize': True
+            })['compress_level'],
+            9
+        )
+
+    def test_parse_invalid_profile(self):
+        for value in (
+            '[1]',
+            'not json',
+            '{"colors": 1}',
+            '{"colors": 512}',
+            '{"compress_level": 10}',
+            '{"strategy": "best"}',
+            '{"palette": 16}',
+        ):
+            with self.assertRaises(ValueError, msg=value):
+                parse_png_profile(value)
+
+    def test_save_options(self):
+        self.assertEqual(get_png_save_options(None), {'format': 'PNG'})
+        self.assertEqual(
+            get_png_save_options(
+                parse_png_profile({
+                    'compress_level': 3, 'strategy': 'filtered', 'optimize': 1
+                })
+            ),
+            {
+                'format': 'PNG',
+                'compress_level': 3,
+                'compress_type': 1,
+                'optimize': True
+            }
+        )
+
+    def test_palette_quantization(self):
+        img = get_thematic_image()
+        content = encode_png(img, parse_png_profile(PROFILE))
+        self.assertLess(len(content), len(to_png(img)) / 2)
+        with Image.open(io.BytesIO(content)) as tile:
+            self.assertEqual(tile.mode, 'P')
+            # lossless with less colors than the palette size
+            self.assertEqual(tile.convert('RGBA').tobytes(), img.tobytes())
+
+    def test_optimize_image(self):
+        img = get_thematic_image(gutter=10)
+        content = optimize_image(to_png(img), 10, parse_png_profile(PROFILE))
+        with Image.open(io.BytesIO(content)) as tile:
+            self.assertEqual(tile.size, (256, 256))
+            self.assertEqual(tile.mode, 'P')
+        # without gutter the tile is only re-encoded
+        content = optimize_image(to_png(img), 0, parse_png_profile(PROFILE))
+        with Image.open(io.BytesIO(content)) as tile:
+            self.assertEqual(tile.size, (276, 276))
+            self.assertEqual(tile.mode, 'P')
+
+    def test_split_metatile(self):
+        img = get_thematic_image(size=512)
+        with app.test_request_context(
+            '/1.0.0/inline_points/default/current/2056/17/2/4.png'
+        ):
+            tiles = split_metatile(
+                to_png(img), [2, 4, 3, 5], 0, 256, parse_png_profile(PROFILE)
+            )
+        for content in tiles.values():
+            with Image.open(io.BytesIO(content)) as tile:
+                self.assertEqual(tile.mode, 'P')
+
+    @patch('app.helpers.wmts_config.connect_to_db')
+    def test_profile_from_db(self, mock_connect):
+        columns = []
+        for name in (
+            'fk_dataset_id',
+            'timestamps',
+            'formats',
+            'resolution_min',
+            'resolution_max',
+            's3_resolution_max',
+            'cache_ttl',
+            'wms_gutter',
+            'png_profile'
+        ):
+            column = MagicMock()
+            column.name = name
+            columns.append(column)
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = columns
+        cursor.__iter__.return_value = iter([
+            ('layer.1', ['current'], ['png'], 4000, 1, 1, 1800, 0, PROFILE),
+            ('layer.2', ['current'], ['png'], 4000, 1, 1, 1800, 0, '{"a":1}'),
+        ])
+        restrictions = get_wmts_config_from_db()
+        self.assertEqual(restrictions['layer.1']['png_profile']['colors'], 64)
+        # an invalid profile is ignored
+        self.assertIsNone(restrictions['layer.2']['png_profile'])
@@ -0,0 +1,394 @@
+import multiprocessing
+import time
+import unittest
+from unittest.mock import patch
+
+from app import app
+from app import settings
+from app.helpers.coverage import count_tiles
+from app.helpers.etag_index import etag_index
+from app.helpers.etag_index import prepare_etag_index_response
+from app.helpers.grids import get_tile_grid
+from app.helpers.layer_purges import layer_purges
+from app.helpers.purge import get_purge_keys
+from app.helpers.purge import get_transformer
+from app.helpers.purge import purge
+from app.helpers.purge import purge_jobs
+from app.helpers.purge import transform_bbox
+from app.helpers.purge import transform_polygons
+from app.helpers.tile_cache import cache_tile
+from app.helpers.tile_cache import get_cached_tile
+from app.helpers.tile_cache import tile_cache
+
+RESTRICTION = {
+    'timestamps': ['current', '20200101'],
+    'formats': ['png'],
+    'resolution_min': 4000.0,
+    'resolution_max': 0.1,
+    's3_resolution_max': 0.1,
+    'cache_ttl': 1800,
+    'wms_gutter': 0,
+    'wms_metatile': 1,
+}
+
+BBOX = [2600000, 1200000, 2605000, 1205000]
+
+
+class PurgeKeysTests(unittest.TestCase):
+
+    def test_keys(self):
+        keys = list(
+            get_purge_keys(
+                'some.layer',
+                RESTRICTION, ['current', '20200101'], [2056], ['png'], (20, 22),
+                bbox=BBOX
+            )
+        )
+        counts = count_tiles(get_tile_grid(2056), [20, 21, 22], BBOX)
+        self.assertEqual(len(keys), 2 * sum(counts.values()))
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertTrue(
+            all(key.startswith('1.0.0/some.layer/default/') for key in keys)
+        )
+        self.assertIn('1.0.0/some.layer/default/20200101/2056/22/', keys[-1])
+
+    def test_keys_21781_path_order(self):
+        bbox = transform_bbox(BBOX, 2056, 21781)
+        self.assertAlmostEqual(bbox[0], 600000, delta=1)
+        self.assertAlmostEqual(bbox[1], 200000, delta=1)
+        keys = list(
+            get_purge_keys(
+                'some.layer',
+                RESTRICTION, ['current'], [21781], ['png'], (18, 18),
+                bbox=BBOX
+            )
+        )
+        # the keys are .../zoom/row/col in 21781, at zoom 18 (50m resolution)
+        # the row 11 (y 1'212'800 - 1'200'000) and cols 14 (x 2'600'000)
+        self.assertEqual(
+            keys, ['1.0.0/some.layer/default/current/21781/18/11/14.png']
+        )
+
+    def test_polygons(self):
+        polygons = [[[(2600000, 1200000), (2605000, 1200000),
+                      (2600000, 1205000), (2600000, 1200000)]]]
+        keys = list(
+            get_purge_keys(
+                'some.layer',
+                RESTRICTION, ['current'], [2056, 3857], ['png'], (16, 24),
+                polygons=polygons
+            )
+        )
+        bbox_keys = list(
+            get_purge_keys(
+                'some.layer',
+                RESTRICTION, ['current'], [2056, 3857], ['png'], (16, 24),
+                bbox=BBOX
+            )
+        )
+        self.assertTrue(any('/3857/' in key for key in keys))
+        self.assertTrue(set(keys) < set(bbox_keys))
+        self.assertLess(len(keys), len(bbox_keys) * 0.6)
+
+    def test_transform_polygons(self):
+        polygons = [[[(2480000, 1070000), (2840000, 1070000),
+                      (2840000, 1300000), (2480000, 1070000)]]]
+        ring = transform_polygons(polygons, 2056, 21781)[0][0]
+        self.assertGreater(len(ring), 4)
+        self.assertEqual(ring[0], ring[-1])
+        # the vertices of the edges are reprojected, not only their ends
+        middle = get_transformer(2056, 21781).transform(2660000, 1070000)
+        self.assertTrue(
+            any(
+                abs(x - middle[0]) < 1e-6 and abs(y - middle[1]) < 1e-6
+                for x, y in ring
+            )
+        )
+        self.assertIs(transform_polygons(polygons, 2056, 2056), polygons)
+
+
+@patch('app.helpers.purge.get_wmts_config_by_layer', return_value=RESTRICTION)
+class PurgeTests(unittest.TestCase):
+
+    def setUp(self):
+        tile_cache.clear()
+        etag_index.clear()
+        layer_purges.clear()
+        self.addCleanup(layer_purges.clear)
+
+    def test_purged_by_other_worker(self, mock_config):
+        path = '1.0.0/some.layer/default/current/2056/0/0/0.png'
+        other_path = '1.0.0/other.layer/default/current/2056/0/0/0.png'
+        for wmts_path in (path, other_path):
+            cache_tile(wmts_path, b'tile', {'ETag': '"a"'}, RESTRICTION)
+        time.sleep(0.001)
+        # another worker purges the layer
+        process = multiprocessing.get_context('fork').Process(
+            target=layer_purges.mark, args=('some.layer',)
+        )
+        process.start()
+        process.join()
+        self.assertGreater(layer_purges.get('some.layer'), 0)
+        self.assertIsNone(get_cached_tile(path))
+        self.assertIsNone(prepare_etag_index_response(path, '"a"'))
+        self.assertIsNotNone(get_cached_tile(other_path))
+        self.assertIsNotNone(prepare_etag_index_response(other_path, '"a"'))
+        self.assertEqual(tile_cache.stats()['purged'], 1)
+        # the tiles cached after the purge are served
+        time.sleep(0.001)
+        cache_tile(path, b'tile', {'ETag': '"a"'}, RESTRICTION)
+        self.assertIsNotNone(get_cached_tile(path))
+        self.assertIsNotNone(prepare_etag_index_response(path, '"a"'))
+
+    @patch('app.helpers.purge.delete_s3_files')
+    @patch('app.helpers.purge.s3_write_queue')
+    def test_purge(self, mock_queue, mock_delete, mock_config):
+        mock_delete.side_effect = lambda keys: keys[:1]
+        mock_queue.discard.return_value = False
+        keys = list(
+            get_purge_keys(
+                'some.layer',
+                RESTRICTION, ['current'], [2056], ['png'], (26, 26),
+                bbox=BBOX
+            )
+        )
+        tile_cache.set(keys[0], b'tile', {}, 60)
+        tile_cache.set(
+            '1.0.0/other.layer/default/current/2056/0/0/0.png', b'tile', {}, 60
+        )
+        stats = purge(
+            'some.layer',
+            times=['current'],
+            srids=[2056],
+            extensions=['png'],
+            zooms=(26, 26),
+            bbox=BBOX,
+            concurrency=2
+        )
+        batches = (len(keys) + 999) // 1000
+        self.assertGreater(batches, 1)
+        self.assertEqual(mock_delete.call_count, batches)
+        self.assertEqual(
+            stats,
+            {
+                'keys': len(keys),
+                'deleted': len(keys) - batches,
+                'errors': batches,
+                'evicted': 1,
+                'dequeued': 0,
+            }
+        )
+        self.assertTrue(
+            all(
+                len(call.args[0]) <= 1000 for call in mock_delete.call_args_list
+            )
+        )
+        self.assertIsNone(tile_cache.get(keys[0]))
+        self.assertIsNotNone(
+            tile_cache.get('1.0.0/other.layer/default/current/2056/0/0/0.png')
+        )
+        self.assertEqual(mock_queue.discard.call_count, len(keys))
+
+    @patch('app.helpers.purge.delete_s3_files')
+    def test_dry_run(self, mock_delete, mock_config):
+        stats = purge(
+            'some.layer', srids=[2056], zooms=(20, 20), bbox=BBOX, dry_run=True
+        )
+        mock_delete.assert_not_called()
+        # 2 timestamps, the png tiles and their webp variants
+        self.assertEqual(stats['keys'], 2 * 2 * 9)
+        self.assertEqual(stats['deleted'], 0)
+
+    def test_invalid(self, mock_config):
+        with self.assertRaises(ValueError):
+            purge('some.layer', srids=[1234], bbox=BBOX)
+        mock_config.return_value = None
+        with self.assertRaises(ValueError):
+            purge('unknown.layer')
+
+    @patch('app.helpers.purge.delete_s3_files')
+    def test_whole_layer(self, mock_delete, mock_config):
+        # the whole layer must be purged explicitly
+        with self.assertRaises(ValueError):
+            purge('some.layer', srids=[2056], zooms=(16, 16))
+        stats = purge(
+            'some.layer',
+            srids=[2056],
+            zooms=(16, 16),
+            whole_layer=True,
+            dry_run=True
+        )
+        counts = count_tiles(get_tile_grid(2056), [16])
+        self.assertEqual(stats['keys'], 2 * 2 * counts[16])
+        mock_delete.assert_not_called()
+
+    @patch('app.helpers.purge.delete_s3_files')
+    def test_max_keys(self, mock_delete, mock_config):
+        polygons = [[[(2600000, 1200000), (2605000, 1200000),
+                      (2600000, 1205000), (2600000, 1200000)]]]
+        # bounded by the polygons bbox keys
+        with self.assertRaises(ValueError):
+            purge(
+                'some.layer',
+                srids=[2056],
+                zooms=(20, 20),
+                polygons=polygons,
+                max_keys=2 * 2 * 9 - 1
+            )
+        stats = purge(
+            'some.layer',
+            srids=[2056],
+            zooms=(20, 20),
+            polygons=polygons,
+            max_keys=2 * 2 * 9,
+            dry_run=True
+        )
+        self.assertLessEqual(stats['keys'], 2 * 2 * 9)
+        mock_delete.assert_not_called()
+
+    @patch('app.helpers.purge.delete_s3_files', return_value=[])
+    def test_cli(self, mock_delete, mock_config):
+        runner = app.test_cli_runner()
+        result = runner.invoke(
+            args=[
+                'purge',
+                '--layer',
+                'some.layer',
+                '--time',
+                'current',
+                '--srid',
+                '2056',
+                '--min-zoom',
+                '20',
+                '--max-zoom',
+                '20',
+                '--bbox',
+                *map(str, BBOX)
+            ]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('keys: 18, deleted: 18, errors: 0', result.output)
+        mock_delete.assert_called_once()
+
+
+@patch('app.routes.prepare_purge')
+@patch('app.helpers.purge.purge_keys')
+class PurgeEndpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.headers = {'Authorization': 'Bearer secret'}
+        patcher = patch.object(settings, 'PURGE_API_TOKEN', 'secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_for_job(self, job_id):
+        for _ in range(100):
+            response = self.app.get(
+                f'/admin/purge/{job_id}', headers=self.headers
+            )
+            self.assertEqual(response.status_code, 200)
+            if response.json['status'] != 'running':
+                return response.json
+            time.sleep(0.01)
+        self.fail(f'Purge job {job_id} still running')
+
+    def test_disabled(self, mock_purge_keys, mock_prepare):
+        with patch.object(settings, 'PURGE_API_TOKEN', ''):
+            response = self.app.post('/admin/purge', json={'layer': 'layer'})
+        self.assertEqual(response.status_code, 404)
+        mock_prepare.assert_not_called()
+
+    def test_unauthorized(self, mock_purge_keys, mock_prepare):
+        response = self.app.post(
+            '/admin/purge',
+            json={'layer': 'layer'},
+            headers={'Authorization': 'Bearer wrong'}
+        )
+        self.assertEqual(response.status_code, 401)
+        response = self.app.get(
+            '/admin/purge/job', headers={'Authorization': 'Bearer wrong'}
+        )
+        self.assertEqual(response.status_code, 401)
+        mock_prepare.assert_not_called()
+
+    def test_purge(self, mock_purge_keys, mock_prepare):
+        mock_prepare.return_value = iter(['key'])
+        mock_purge_keys.return_value = {'keys': 10, 'deleted': 10}
+        geometry = {
+            'type': 'Polygon',
+            'coordinates': [[[0, 0], [1, 0], [0, 1], [0, 0]]],
+        }
+        response = self.app.post(
+            '/admin/purge',
+            json={
+                'layer': 'layer',
+                'times': ['current'],
+                'srids': [2056],
+                'max_zoom': 20,
+                'geometry': geometry,
+            },
+            headers=self.headers
+        )
+        self.assertEqual(response.status_code, 202, response.json)
+        job = self.wait_for_job(response.json['job'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['layer'], 'layer')
+        self.assertEqual(job['stats'], {'keys': 10, 'deleted': 10})
+        args, kwargs = mock_prepare.call_args
+        self.assertEqual(args, ('layer',))
+        self.assertEqual(kwargs['zooms'], (0, 20))
+        self.assertEqual(kwargs['max_keys'], settings.PURGE_MAX_KEYS)
+        self.assertEqual(
+            kwargs['polygons'], [[[(0, 0), (1, 0), (0, 1), (0, 0)]]]
+        )
+        mock_purge_keys.assert_called_once_with(
+            'layer', mock_prepare.return_value, dry_run=False
+        )
+
+        response = self.app.get('/admin/purge/unknown', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_failed_job(self, mock_purge_keys, mock_prepare):
+        mock_purge_keys.side_effect = RuntimeError('S3 down')
+        response = self.app.post(
+            '/admin/purge',
+            json={
+                'layer': 'layer', 'bbox': BBOX
+            },
+            headers=self.headers
+        )
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for_job(response.json['job'])
+        self.assertEqual(job['status'], 'failed')
+
+    def test_too_many_jobs(self, mock_purge_keys, mock_prepare):
+        with patch.object(purge_jobs, 'max_running', 0):
+            response = self.app.post(
+                '/admin/purge',
+                json={
+                    'layer': 'layer', 'bbox': BBOX
+                },
+                headers=self.headers
+            )
+        self.assertEqual(response.status_code, 429)
+        mock_purge_keys.assert_not_called()
+
+    def test_invalid(self, mock_purge_keys, mock_prepare):
+        response = self.app.post('/admin/purge', json=[], headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        for geometry in ('polygon', {'type': 'Feature', 'geometry': []}):
+            response = self.app.post(
+                '/admin/purge',
+                json={
+                    'layer': 'layer', 'geometry': geometry
+                },
+                headers=self.headers
+            )
+            self.assertEqual(response.status_code, 400)
+        mock_prepare.side_effect = ValueError('Unknown layer layer')
+        response = self.app.post(
+            '/admin/purge', json={'layer': 'layer'}, headers=self.headers
+        )
+        self.assertEqual(response.status_code, 400)
+        mock_purge_keys.assert_not_called()
@@ -0,0 +1,262 @@
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app.helpers.render_lease import FileLeaseBackend
+from app.helpers.render_lease import LocalLeaseBackend
+from app.helpers.render_lease import load_render_lease_backend
+from app.helpers.wmts import get_render_lease_key
+from app.helpers.wmts import handle_2nd_level_cache
+from app.helpers.wmts import prepare_wmts_response
+from app.helpers.wmts import wait_for_rendered_tile
+
+TILE_PATH = '1.0.0/inline_points/default/current/2056/20/30/40.png'
+
+
+class LeaseBackendTestsMixin:
+
+    def get_backend(self):
+        raise NotImplementedError()
+
+    def test_acquire_release(self):
+        backend = self.get_backend()
+        token = backend.acquire('tile', 10)
+        self.assertIsNotNone(token)
+        self.assertTrue(backend.held('tile'))
+        self.assertIsNone(backend.acquire('tile', 10))
+        # only the owner can release the lease
+        backend.release('tile', 'another token')
+        self.assertTrue(backend.held('tile'))
+        backend.release('tile', token)
+        self.assertFalse(backend.held('tile'))
+        self.assertIsNotNone(backend.acquire('tile', 10))
+
+    def test_expired_lease(self):
+        backend = self.get_backend()
+        token = backend.acquire('tile', 0.01)
+        time.sleep(0.02)
+        self.assertFalse(backend.held('tile'))
+        token_2 = backend.acquire('tile', 10)
+        self.assertIsNotNone(token_2)
+        # the previous owner cannot release the new lease
+        backend.release('tile', token)
+        self.assertTrue(backend.held('tile'))
+
+
+class LocalLeaseBackendTests(LeaseBackendTestsMixin, unittest.TestCase):
+
+    def get_backend(self):
+        return LocalLeaseBackend()
+
+
+class FileLeaseBackendTests(LeaseBackendTestsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+
+    def get_backend(self):
+        return FileLeaseBackend(self.directory.name)
+
+    def test_shared_between_backends(self):
+        backend_1 = self.get_backend()
+        backend_2 = self.get_backend()
+        token = backend_1.acquire('tile', 10)
+        self.assertIsNone(backend_2.acquire('tile', 10))
+        self.assertTrue(backend_2.held('tile'))
+        backend_1.release('tile', token)
+        self.assertIsNotNone(backend_2.acquire('tile', 10))
+
+    def test_lock_timeout(self):
+        backend = self.get_backend()
+        token = backend.acquire('tile', 10)
+        with backend._locked('tile') as locked:  # pylint: disable=protected-access
+            self.assertTrue(locked)
+            started = time.monotonic()
+            # the lock held by another worker is given up, the lease expires
+            self.get_backend().release('tile', token)
+            self.assertTrue(backend.held('tile'))
+            # 'tile 32' shares the lock file of 'tile'
+            self.assertIsNone(self.get_backend().acquire('tile 32', 10))
+            self.assertLess(time.monotonic() - started, 1)
+        self.assertIsNotNone(self.get_backend().acquire('tile 32', 10))
+
+    def test_race_on_expired_lease(self):
+        for _ in range(20):
+            self.get_backend().acquire('tile', -1)
+            backends = [self.get_backend() for _ in range(8)]
+            barrier = threading.Barrier(len(backends))
+            tokens = []
+
+            def acquire(backend, barrier, tokens):
+                barrier.wait(5)
+                tokens.append(backend.acquire('tile', 10))
+
+            threads = [
+                threading.Thread(
+                    target=acquire, args=(backend, barrier, tokens)
+                ) for backend in backends
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            owners = [token for token in tokens if token is not None]
+            self.assertEqual(len(owners), 1)
+            self.assertTrue(self.get_backend().held('tile'))
+            # the lease is taken over by a single backend and not deleted
+            self.get_backend().release('tile', 'previous owner')
+            self.assertTrue(self.get_backend().held('tile'))
+            self.get_backend().release('tile', owners[0])
+            self.assertFalse(self.get_backend().held('tile'))
+
+
+class RenderLeaseTests(unittest.TestCase):
+
+    def test_load_backend(self):
+        self.assertIsInstance(
+            load_render_lease_backend('local'), LocalLeaseBackend
+        )
+        self.assertIsInstance(
+            load_render_lease_backend(
+                'app.helpers.render_lease.LocalLeaseBackend'
+            ),
+            LocalLeaseBackend
+        )
+
+    def test_render_lease_key(self):
+        with app.test_request_context(f'/{TILE_PATH}'):
+            self.assertEqual(get_render_lease_key(1), TILE_PATH)
+            # tiles of a same metatile share the metatile lease
+            self.assertEqual(
+                get_render_lease_key(4),
+                '1.0.0/inline_points/default/current/2056/20/metatile/28/40'
+            )
+
+    @patch('app.helpers.wmts.queue_s3_file')
+    def test_lease_released_once_written(self, mock_queue_s3_file):
+        on_written = MagicMock()
+        sibling = '1.0.0/inline_points/default/current/2056/20/31/40.png'
+        with app.test_request_context(f'/{TILE_PATH}'):
+            on_close = handle_2nd_level_cache(
+                True,
+                'default', {'Content-Type': 'image/png'},
+                b'tile',
+                siblings=[(sibling, b'sibling', {})],
+                on_written=on_written
+            )
+        on_close()
+        # the tiles are only queued
+        self.assertEqual(mock_queue_s3_file.call_count, 2)
+        on_written.assert_not_called()
+        callbacks = [call.args[3] for call in mock_queue_s3_file.call_args_list]
+        callbacks[0]()
+        on_written.assert_not_called()
+        callbacks[1]()
+        on_written.assert_called_once()
+
+    @patch('app.helpers.wmts.is_render_lease_held', return_value=True)
+    @patch('app.helpers.wmts.get_cached_tile', return_value=None)
+    @patch('app.helpers.wmts.get_s3_file')
+    def test_wait_for_rendered_tile(
+        self, mock_get_s3_file, mock_get_cached_tile, mock_held
+    ):
+        s3_resp = MagicMock(status=200)
+        s3_resp.getheaders.return_value = [('Content-Type', 'image/png')]
+        mock_get_s3_file.side_effect = [(None, None), (s3_resp, b'tile')]
+        with patch('app.settings.RENDER_LEASE_POLL_INTERVAL', 0), \
+            app.test_request_context(f'/{TILE_PATH}'):
+            status_code, content, headers, on_close = wait_for_rendered_tile(
+                TILE_PATH
+            )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(content, b'tile')
+        self.assertEqual(headers['X-Tiles-S3-Cache'], 'hit')
+        self.assertIsNone(on_close)
+        self.assertEqual(mock_get_s3_file.call_count, 2)
+
+    @patch('app.helpers.wmts.release_render_lease')
+    @patch('app.helpers.wmts.queue_s3_file')
+    @patch('app.helpers.wmts.get_optimized_tile')
+    @patch('app.helpers.wmts.get_wms_bbox')
+    @patch('app.helpers.wmts.acquire_render_lease', return_value='token')
+    @patch('app.helpers.wmts.validate_restriction')
+    @patch('app.helpers.wmts.validate_wmts_request')
+    def test_leaseholder_not_modified(  # pylint: disable=too-many-arguments
+        self,
+        mock_validate_request,
+        mock_validate_restriction,
+        mock_acquire,
+        mock_get_wms_bbox,
+        mock_get_optimized_tile,
+        mock_queue_s3_file,
+        mock_release
+    ):
+        mock_validate_request.return_value = (None, None)
+        mock_validate_restriction.return_value = ({}, 0, True)
+        mock_get_optimized_tile.return_value = (
+            200,
+            b'tile', {
+                'Content-Type': 'image/png', 'Etag': 'abc'
+            },
+            0.1,
+            0.1
+        )
+        with app.test_request_context(f'/{TILE_PATH}'):
+            status_code, content, _, on_close = prepare_wmts_response(
+                'default', '"abc"'
+            )
+        self.assertEqual((status_code, content), (304, None))
+        # the tile is still written to S3, then the lease released
+        mock_release.assert_not_called()
+        on_close()
+        mock_queue_s3_file.assert_called_once()
+        mock_queue_s3_file.call_args.args[3]()
+        mock_release.assert_called_once_with(TILE_PATH, 'token')
+
+    @patch('app.helpers.wmts.is_render_lease_held', return_value=True)
+    @patch('app.helpers.wmts.get_cached_tile', return_value=None)
+    @patch('app.helpers.wmts.get_s3_file')
+    @patch('app.helpers.wmts.acquire_render_lease', return_value=None)
+    @patch('app.helpers.wmts.validate_restriction')
+    @patch('app.helpers.wmts.validate_wmts_request')
+    def test_rendered_tile_not_modified(
+        self,
+        mock_validate_request,
+        mock_validate_restriction,
+        mock_acquire,
+        mock_get_s3_file,
+        mock_get_cached_tile,
+        mock_held
+    ):
+        mock_validate_request.return_value = (None, None)
+        mock_validate_restriction.return_value = ({}, 0, True)
+        s3_resp = MagicMock(status=200)
+        # S3 spells the header ETag, the WMS tiles Etag
+        s3_resp.getheaders.return_value = [('ETag', '"abc"')]
+        mock_get_s3_file.return_value = (s3_resp, b'tile')
+        with patch('app.settings.RENDER_LEASE_POLL_INTERVAL', 0), \
+            app.test_request_context(f'/{TILE_PATH}'):
+            status_code, content, _, _ = prepare_wmts_response(
+                'default', '"abc"'
+            )
+            self.assertEqual((status_code, content), (304, None))
+            status_code, content, _, _ = prepare_wmts_response(
+                'default', '"other"'
+            )
+            self.assertEqual((status_code, content), (200, b'tile'))
+
+    @patch('app.helpers.wmts.is_render_lease_held', return_value=False)
+    @patch('app.helpers.wmts.get_cached_tile', return_value=None)
+    @patch('app.helpers.wmts.get_s3_file', return_value=(None, None))
+    def test_wait_for_released_lease(
+        self, mock_get_s3_file, mock_get_cached_tile, mock_held
+    ):
+        with patch('app.settings.RENDER_LEASE_POLL_INTERVAL', 0), \
+            app.test_request_context(f'/{TILE_PATH}'):
+            self.assertIsNone(wait_for_rendered_tile(TILE_PATH))
+        mock_get_s3_file.assert_called_once()
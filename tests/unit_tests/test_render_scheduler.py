@@ -0,0 +1,154 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from werkzeug.exceptions import HTTPException
+
+from flask import g
+
+from app import app
+from app.helpers.render_scheduler import BACKGROUND
+from app.helpers.render_scheduler import INTERACTIVE_HIGH_ZOOM
+from app.helpers.render_scheduler import INTERACTIVE_LOW_ZOOM
+from app.helpers.render_scheduler import PREVIEW
+from app.helpers.render_scheduler import RenderScheduler
+from app.helpers.render_scheduler import RenderSchedulerFull
+from app.helpers.render_scheduler import get_render_class
+from app.helpers.render_scheduler import scheduled_render
+
+TILE_PATH = '1.0.0/some.layer/default/current/2056/{zoom}/45/27.png'
+
+
+class RenderSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.order = []
+        self.threads = []
+
+    def tearDown(self):
+        self.join_renders()
+
+    def join_renders(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def queue_render(self, scheduler, render_class, queued):
+
+        def render():
+            scheduler.acquire(render_class)
+            self.order.append(render_class)
+            scheduler.release(0)
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        self.threads.append(thread)
+        deadline = time.monotonic() + 5
+        while scheduler.stats()['queued'][render_class] < queued:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_priority(self):
+        scheduler = RenderScheduler(1, (8, 4, 2, 1), (4,) * 4, (5,) * 4)
+        scheduler.acquire(PREVIEW)
+        self.queue_render(scheduler, BACKGROUND, 1)
+        self.queue_render(scheduler, INTERACTIVE_HIGH_ZOOM, 1)
+        scheduler.release(0)
+        self.join_renders()
+        self.assertEqual(self.order, [INTERACTIVE_HIGH_ZOOM, BACKGROUND])
+        self.assertEqual(scheduler.stats()['in_use'], 0)
+
+    def test_weighted_fair_share(self):
+        scheduler = RenderScheduler(1, (3, 1, 1, 1), (4,) * 4, (5,) * 4)
+        scheduler.acquire(INTERACTIVE_LOW_ZOOM)
+        for queued in range(1, 5):
+            self.queue_render(scheduler, BACKGROUND, queued)
+        for queued in range(1, 5):
+            self.queue_render(scheduler, INTERACTIVE_LOW_ZOOM, queued)
+        scheduler.release(0)
+        self.join_renders()
+        # 3 low zoom renders per background render, background work is not
+        # starved
+        self.assertEqual(
+            ''.join(
+                'L' if cls == INTERACTIVE_LOW_ZOOM else 'B'
+                for cls in self.order
+            ),
+            'LBLLLBBB'
+        )
+
+    def test_queue_full(self):
+        scheduler = RenderScheduler(1, (8, 4, 2, 1), (1,) * 4, (5,) * 4)
+        scheduler.acquire(BACKGROUND)
+        self.queue_render(scheduler, BACKGROUND, 1)
+        with self.assertRaises(RenderSchedulerFull):
+            scheduler.acquire(BACKGROUND)
+        self.assertEqual(scheduler.stats()['dropped'][BACKGROUND], 1)
+        scheduler.release(0)
+
+    def test_deadline(self):
+        scheduler = RenderScheduler(1, (8, 4, 2, 1), (4,) * 4, (0.01,) * 4)
+        scheduler.acquire(BACKGROUND)
+        with self.assertRaises(RenderSchedulerFull):
+            scheduler.acquire(PREVIEW)
+        self.assertEqual(scheduler.stats()['queued'][PREVIEW], 0)
+        scheduler.release(0)
+        scheduler.acquire(PREVIEW)
+        self.assertEqual(scheduler.stats()['dropped'][PREVIEW], 1)
+
+    def test_expected_wait(self):
+        scheduler = RenderScheduler(1, (8, 4, 2, 1), (4,) * 4, (5,) * 4)
+        scheduler.acquire(BACKGROUND)
+        scheduler.release(30)
+        scheduler.acquire(BACKGROUND)
+        # about 6 seconds of render time ahead
+        with self.assertRaises(RenderSchedulerFull) as context:
+            scheduler.acquire(INTERACTIVE_LOW_ZOOM)
+        self.assertIn('would wait', str(context.exception))
+
+
+class RenderClassTests(unittest.TestCase):
+
+    def get_render_class(self, path, **kwargs):
+        with app.test_request_context(path, **kwargs):
+            return get_render_class()
+
+    def test_render_class(self):
+        self.assertEqual(
+            self.get_render_class(f'/{TILE_PATH.format(zoom=18)}'),
+            INTERACTIVE_LOW_ZOOM
+        )
+        self.assertEqual(
+            self.get_render_class(f'/{TILE_PATH.format(zoom=26)}'),
+            INTERACTIVE_HIGH_ZOOM
+        )
+        self.assertEqual(
+            self.get_render_class(f'/{TILE_PATH.format(zoom=18)}?mode=preview'),
+            PREVIEW
+        )
+        self.assertEqual(
+            self.get_render_class(
+                f'/{TILE_PATH.format(zoom=18)}',
+                headers={'Sec-Purpose': 'prefetch'}
+            ),
+            BACKGROUND
+        )
+        with app.test_request_context(f'/{TILE_PATH.format(zoom=18)}'):
+            g.render_class = BACKGROUND
+            self.assertEqual(get_render_class(), BACKGROUND)
+
+    def test_dropped_render(self):
+        scheduler = RenderScheduler(1, (8, 4, 2, 1), (0,) * 4, (5,) * 4)
+        scheduler.acquire(BACKGROUND)
+        with patch('app.helpers.render_scheduler.render_scheduler', scheduler):
+            with app.test_request_context(f'/{TILE_PATH.format(zoom=18)}'):
+                with self.assertRaises(HTTPException) as context:
+                    with scheduled_render():
+                        pass
+                self.assertTrue(g.wms_backend_overloaded)
+            self.assertEqual(context.exception.code, 503)
+            scheduler.release(0)
+            with app.test_request_context(f'/{TILE_PATH.format(zoom=18)}'):
+                with scheduled_render():
+                    self.assertEqual(scheduler.stats()['in_use'], 1)
+            self.assertEqual(scheduler.stats()['in_use'], 0)
@@ -0,0 +1,184 @@
+import threading
+import unittest
+from datetime import datetime
+from datetime import timezone
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app import settings
+from app.helpers.revalidate import Revalidator
+from app.helpers.revalidate import revalidate_tile
+from app.helpers.tile_cache import tile_cache
+from app.helpers.utils import is_stale_tile
+
+NOW = datetime(2026, 3, 10, 12, 0, 0, tzinfo=timezone.utc)
+
+TILE_PATH = '1.0.0/inline_points/default/current/21781/20/76/44.png'
+
+
+class IsStaleTileTests(unittest.TestCase):
+
+    def test_fresh_tile(self):
+        headers = {'Last-Modified': 'Tue, 10 Mar 2026 11:45:00 GMT'}
+        self.assertFalse(is_stale_tile(headers, 1800, NOW))
+
+    def test_stale_tile(self):
+        headers = {'last-modified': 'Tue, 10 Mar 2026 11:00:00 GMT'}
+        self.assertTrue(is_stale_tile(headers, 1800, NOW))
+
+    def test_without_cache_ttl(self):
+        headers = {'Last-Modified': 'Tue, 10 Mar 2020 11:00:00 GMT'}
+        self.assertFalse(is_stale_tile(headers, None, NOW))
+        self.assertFalse(is_stale_tile(headers, 0, NOW))
+
+    def test_expired_tile(self):
+        headers = {
+            'Last-Modified': 'Tue, 10 Mar 2026 11:45:00 GMT',
+            'x-amz-expiration':
+                'expiry-date="Mon, 09 Mar 2026 00:00:00 GMT", rule-id="tiles"'
+        }
+        self.assertTrue(is_stale_tile(headers, 1800, NOW))
+        headers['x-amz-expiration'] = \
+            'expiry-date="Wed, 11 Mar 2026 00:00:00 GMT", rule-id="tiles"'
+        self.assertFalse(is_stale_tile(headers, 1800, NOW))
+
+    def test_invalid_headers(self):
+        headers = {
+            'Last-Modified': 'yesterday', 'x-amz-expiration': 'rule-id="tiles"'
+        }
+        self.assertFalse(is_stale_tile(headers, 1800, NOW))
+        self.assertFalse(is_stale_tile({}, 1800, NOW))
+
+
+class RevalidatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def revalidate(self, wmts_path):
+        self.calls.append(wmts_path)
+        self.started.set()
+        self.release.wait(5)
+        if wmts_path == 'error':
+            raise ValueError('render failed')
+        return wmts_path != 'not-cached'
+
+    def wait_done(self, revalidator):
+        for _ in range(500):
+            if revalidator.stats()['pending'] == 0:
+                return
+            threading.Event().wait(0.01)
+        self.fail('Revalidation not done')
+
+    def test_schedule_once(self):
+        revalidator = Revalidator(2)
+        self.assertTrue(revalidator.schedule('path/1', self.revalidate))
+        self.assertTrue(self.started.wait(5))
+        self.assertFalse(revalidator.schedule('path/1', self.revalidate))
+        self.release.set()
+        self.wait_done(revalidator)
+        self.assertEqual(self.calls, ['path/1'])
+        stats = revalidator.stats()
+        self.assertEqual(stats['scheduled'], 1)
+        self.assertEqual(stats['revalidated'], 1)
+        # the tile can be revalidated again once done
+        self.assertTrue(revalidator.schedule('path/1', self.revalidate))
+        self.wait_done(revalidator)
+
+    def test_max_pending(self):
+        revalidator = Revalidator(1)
+        self.assertTrue(revalidator.schedule('path/1', self.revalidate))
+        self.assertFalse(revalidator.schedule('path/2', self.revalidate))
+        self.release.set()
+        self.wait_done(revalidator)
+        stats = revalidator.stats()
+        self.assertEqual(stats['scheduled'], 1)
+        self.assertEqual(stats['skipped'], 1)
+
+    def test_failures(self):
+        self.release.set()
+        revalidator = Revalidator(2)
+        revalidator.schedule('error', self.revalidate)
+        revalidator.schedule('not-cached', self.revalidate)
+        self.wait_done(revalidator)
+        stats = revalidator.stats()
+        self.assertEqual(stats['failed'], 2)
+        self.assertEqual(stats['revalidated'], 0)
+
+
+class RevalidateTileTests(unittest.TestCase):
+
+    @patch('app.helpers.revalidate.get_wmts_config_by_layer')
+    @patch('app.helpers.revalidate.cache_tile')
+    @patch('app.helpers.revalidate.prepare_wmts_response')
+    def test_revalidate_tile(
+        self, mock_prepare, mock_cache_tile, mock_get_config
+    ):
+        on_close = MagicMock()
+        mock_prepare.return_value = (200, b'tile', {'Etag': '"1"'}, on_close)
+        self.assertTrue(revalidate_tile(TILE_PATH))
+        on_close.assert_called_once_with()
+        mock_get_config.assert_called_once_with('inline_points')
+        mock_cache_tile.assert_called_once_with(
+            TILE_PATH, b'tile', {'Etag': '"1"'}, mock_get_config.return_value
+        )
+
+    @patch('app.helpers.revalidate.cache_tile')
+    @patch('app.helpers.revalidate.prepare_wmts_response')
+    def test_not_revalidated(self, mock_prepare, mock_cache_tile):
+        mock_prepare.return_value = (502, b'error', {}, None)
+        self.assertFalse(revalidate_tile(TILE_PATH))
+        mock_prepare.return_value = (200, b'tile', {}, None)
+        self.assertFalse(revalidate_tile(TILE_PATH))
+        mock_cache_tile.assert_not_called()
+
+
+class StaleWhileRevalidateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        tile_cache.clear()
+        self.s3_resp = MagicMock(status=200)
+        self.s3_resp.getheaders.return_value = {
+            'Content-Type': 'image/png',
+            'Last-Modified': 'Tue, 10 Mar 2020 11:00:00 GMT',
+        }.items()
+        patchers = [
+            patch(
+                'app.routes.get_s3_file', return_value=(self.s3_resp, b'tile')
+            ),
+            patch(
+                'app.routes.get_wmts_config_by_layer',
+                return_value={'cache_ttl': 1800}
+            ),
+            patch('app.routes.get_cached_tile', return_value=None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('app.routes.cache_tile')
+    @patch('app.routes.schedule_revalidation')
+    def test_stale_tile_served_and_revalidated(
+        self, mock_schedule, mock_cache_tile
+    ):
+        with patch.object(settings, 'STALE_WHILE_REVALIDATE', True):
+            resp = self.app.get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'tile')
+        self.assertEqual(resp.headers['X-Tiles-S3-Cache'], 'stale')
+        mock_schedule.assert_called_once_with(TILE_PATH)
+        mock_cache_tile.assert_not_called()
+
+    @patch('app.routes.cache_tile')
+    @patch('app.routes.schedule_revalidation')
+    def test_disabled(self, mock_schedule, mock_cache_tile):
+        with patch.object(settings, 'STALE_WHILE_REVALIDATE', False):
+            resp = self.app.get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Tiles-S3-Cache'], 'hit')
+        mock_schedule.assert_not_called()
+        mock_cache_tile.assert_called_once()
@@ -0,0 +1,186 @@
+import io
+import unittest
+from http.client import IncompleteRead
+from http.client import RemoteDisconnected
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app import settings
+from app.helpers.s3 import S3ConnectionPool
+from app.helpers.s3 import S3FileStream
+from app.helpers.s3 import S3PoolTimeoutError
+from app.helpers.s3 import get_s3_file
+from app.helpers.tile_cache import get_cached_tile
+from app.helpers.tile_cache import tile_cache
+
+TILE_PATH = '1.0.0/ch.swisstopo.swissimage/default/current/2056/20/45/27.jpeg'
+
+
+def new_connection(*args, **kwargs):
+    return MagicMock()
+
+
+@patch('http.client.HTTPConnection', side_effect=new_connection)
+class S3ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = S3ConnectionPool('localhost', 0.01, 2, 10)
+
+    def test_connection_reuse(self, mock_connection):
+        connection, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.pool.release(connection)
+        connection_2, reused = self.pool.acquire()
+        self.assertTrue(reused)
+        self.assertIs(connection, connection_2)
+        self.pool.release(connection_2, reusable=False)
+        connection_2.close.assert_called_once()
+        self.assertEqual(mock_connection.call_count, 1)
+        self.assertEqual(
+            self.pool.stats(),
+            {
+                'maxsize': 2,
+                'in_use': 0,
+                'idle': 0,
+                'created': 1,
+                'reused': 1,
+                'reconnects': 0,
+                'saturated': 0,
+            }
+        )
+
+    def test_idle_timeout(self, mock_connection):
+        connection, _ = self.pool.acquire()
+        self.pool.release(connection)
+        self.pool.idle_timeout = 0
+        connection_2, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertIsNot(connection, connection_2)
+        connection.close.assert_called_once()
+
+    def test_saturation(self, mock_connection):
+        self.pool.acquire()
+        connection, _ = self.pool.acquire()
+        with self.assertRaises(S3PoolTimeoutError):
+            self.pool.acquire()
+        self.assertEqual(self.pool.stats()['saturated'], 1)
+        self.pool.release(connection)
+        self.pool.acquire()
+
+    def test_stale_connection_reconnect(self, mock_connection):
+        connection, _ = self.pool.acquire()
+        self.pool.release(connection)
+        connection.getresponse.side_effect = RemoteDisconnected('closed')
+
+        new_connection_, response = self.pool.request('GET', '/tile', {})
+        self.assertIsNot(new_connection_, connection)
+        self.assertIs(response, new_connection_.getresponse.return_value)
+        connection.close.assert_called_once()
+        self.assertEqual(self.pool.stats()['reconnects'], 1)
+        self.assertEqual(self.pool.stats()['in_use'], 1)
+        self.pool.release(new_connection_)
+
+    def test_new_connection_reset(self, mock_connection):
+        mock_connection.side_effect = None
+        mock_connection.return_value.getresponse.side_effect = \
+            ConnectionResetError
+        with self.assertRaises(ConnectionResetError):
+            self.pool.request('GET', '/tile', {})
+        self.assertEqual(self.pool.stats()['reconnects'], 0)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+
+@patch.object(settings, 'S3_STREAM_CHUNK_BYTES', 4)
+@patch.object(settings, 'S3_STREAM_MIN_BYTES', 8)
+class S3StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = S3ConnectionPool('localhost', 0.01, 2, 10)
+        patcher = patch('app.helpers.s3.s3_connection_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = MagicMock()
+        patcher = patch(
+            'http.client.HTTPConnection', return_value=self.connection
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_s3_response(self, body):
+        response = self.connection.getresponse.return_value
+        response.status = 200
+        response.will_close = False
+        response.read = io.BytesIO(body).read
+        response.getheader.return_value = str(len(body))
+        response.getheaders.return_value = [
+            ('Content-Type', 'image/jpeg'),
+            ('Content-Length', str(len(body))),
+            ('ETag', '"1"'),
+        ]
+        return response
+
+    def test_stream(self):
+        self.set_s3_response(b'0123456789')
+        with app.test_request_context():
+            _, content = get_s3_file(TILE_PATH, stream=True)
+        self.assertIsInstance(content, S3FileStream)
+        # the connection is held while streaming
+        self.assertEqual(self.pool.stats()['in_use'], 1)
+        self.assertEqual(list(content), [b'0123', b'4567', b'89'])
+        content.close()
+        content.close()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_client_abort(self):
+        self.set_s3_response(b'0123456789')
+        with app.test_request_context():
+            _, content = get_s3_file(TILE_PATH, stream=True)
+        self.assertEqual(next(iter(content)), b'0123')
+        content.close()
+        # the rest of the body is not read, the connection can't be reused
+        self.connection.close.assert_called_once()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_read_error(self):
+        response = self.set_s3_response(b'0123456789')
+        response.read = MagicMock(side_effect=[b'0123', IncompleteRead(b'')])
+        with app.test_request_context():
+            _, content = get_s3_file(TILE_PATH, stream=True)
+        with self.assertRaises(IncompleteRead):
+            list(content)
+        content.close()
+        self.connection.close.assert_called_once()
+
+    def test_small_file_not_streamed(self):
+        self.set_s3_response(b'0123')
+        with app.test_request_context():
+            _, content = get_s3_file(TILE_PATH, stream=True)
+            self.assertEqual(content, b'0123')
+            self.set_s3_response(b'0123456789')
+            _, content = get_s3_file(TILE_PATH)
+            self.assertEqual(content, b'0123456789')
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    @patch('app.routes.get_wmts_config_by_layer', return_value={})
+    @patch('app.routes.get_cached_tile', return_value=None)
+    def test_streamed_tile_response(self, _, __):
+        self.set_s3_response(b'0123456789')
+        tile_cache.clear()
+        self.addCleanup(tile_cache.clear)
+        resp = app.test_client().get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'0123456789')
+        self.assertEqual(resp.headers['Content-Length'], '10')
+        self.assertEqual(resp.headers['ETag'], '"1"')
+        # the WSGI server closes the response once sent
+        resp.close()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        # cached once streamed
+        self.assertEqual(get_cached_tile(TILE_PATH)[0], b'0123456789')
+
+        resp = app.test_client().get(f'/{TILE_PATH}?nodata=true')
+        self.assertEqual(resp.data, b'OK')
+        self.assertEqual(self.pool.stats()['in_use'], 0)
@@ -0,0 +1,224 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app import settings
+from app.helpers.s3 import S3FileStream
+from app.helpers.s3_hedge import HEDGE
+from app.helpers.s3_hedge import HEDGE_MIN_SAMPLES
+from app.helpers.s3_hedge import RENDER
+from app.helpers.s3_hedge import S3
+from app.helpers.s3_hedge import LatencyTracker
+from app.helpers.s3_hedge import get_hedged_s3_file
+from app.helpers.s3_hedge import get_speculative_render
+from app.helpers.s3_hedge import s3_hedger
+from app.helpers.tile_cache import tile_cache
+
+TILE_PATH = '1.0.0/inline_points/default/current/2056/17/4/7.png'
+
+
+class LatencyTrackerTests(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(100)
+        for latency in range(HEDGE_MIN_SAMPLES - 1):
+            tracker.record(latency)
+        self.assertIsNone(tracker.percentile(95))
+        for latency in range(HEDGE_MIN_SAMPLES - 1, 100):
+            tracker.record(latency)
+        self.assertEqual(tracker.percentile(95), 94)
+        self.assertEqual(tracker.percentile(100), 99)
+        # rolling window
+        for _ in range(100):
+            tracker.record(1)
+        self.assertEqual(tracker.percentile(95), 1)
+
+
+class HedgedS3FileTests(unittest.TestCase):
+
+    def setUp(self):
+        s3_hedger.reset()
+        self.addCleanup(s3_hedger.reset)
+        # Slow GETs wait for the release event
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.s3_resp = MagicMock(status=200)
+        self.slow = []
+
+    def warm_up(self, latency=0.001):
+        for _ in range(HEDGE_MIN_SAMPLES):
+            s3_hedger.latencies.record(latency)
+        s3_hedger.requests = 100
+
+    def fetch(self, wmts_path, etag=None, stream=False):
+        if self.slow and self.slow.pop(0):
+            self.release.wait(5)
+            return self.s3_resp, b'slow'
+        return self.s3_resp, b'fast'
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_not_hedged_without_latencies(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH)
+        self.assertEqual((kind, result), (S3, (self.s3_resp, b'fast')))
+        self.assertEqual(s3_hedger.stats()['hedged'], 0)
+        self.assertIsNone(s3_hedger.stats()['delay'])
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_fast_get_not_hedged(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        self.warm_up(latency=1)
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH)
+        self.assertEqual((kind, result[1]), (S3, b'fast'))
+        mock_fetch.assert_called_once()
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_hedge_wins(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        self.warm_up()
+        self.slow = [True, False]
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH)
+        self.assertEqual((kind, result[1]), (HEDGE, b'fast'))
+        stats = s3_hedger.stats()
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['wins'], {S3: 0, HEDGE: 1, RENDER: 0})
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_hedge_budget(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        self.warm_up()
+        s3_hedger.hedged = 20
+        self.slow = [True]
+        threading.Timer(0.05, self.release.set).start()
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH)
+        self.assertEqual((kind, result[1]), (S3, b'slow'))
+        mock_fetch.assert_called_once()
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_losing_stream_closed(self, mock_fetch):
+        s3_stream = MagicMock(spec=S3FileStream)
+        closed = threading.Event()
+        s3_stream.close.side_effect = closed.set
+
+        def fetch(wmts_path, etag=None, stream=False):
+            if mock_fetch.call_count == 1:
+                self.release.wait(5)
+                return self.s3_resp, s3_stream
+            return self.s3_resp, b'fast'
+
+        mock_fetch.side_effect = fetch
+        self.warm_up()
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, _ = get_hedged_s3_file(TILE_PATH, stream=True)
+        self.assertEqual(kind, HEDGE)
+        self.release.set()
+        self.assertTrue(closed.wait(5))
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_speculative_render_wins(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        self.warm_up()
+        s3_hedger.hedged = 20
+        self.slow = [True]
+        rendered = (200, b'rendered', {})
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(
+                TILE_PATH, render=lambda: rendered
+            )
+        self.assertEqual((kind, result), (RENDER, rendered))
+        self.assertEqual(s3_hedger.stats()['rendered'], 1)
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_failed_speculative_render(self, mock_fetch):
+        mock_fetch.side_effect = self.fetch
+        self.warm_up()
+        self.slow = [True, True]
+        threading.Timer(0.05, self.release.set).start()
+
+        def render():
+            raise RuntimeError('WMS failure')
+
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH, render=render)
+        self.assertIn(kind, (S3, HEDGE))
+        self.assertEqual(result[1], b'slow')
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file')
+    def test_failed_get_while_hedge_pending(self, mock_fetch):
+        failed = threading.Event()
+
+        def fetch(wmts_path, etag=None, stream=False):
+            if mock_fetch.call_count == 1:
+                # the first GET fails while the hedge is pending
+                failed.wait(5)
+                return None, None
+            failed.set()
+            self.release.wait(5)
+            return self.s3_resp, b'hedge'
+
+        mock_fetch.side_effect = fetch
+        self.warm_up()
+        threading.Timer(0.1, self.release.set).start()
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(TILE_PATH)
+        self.assertEqual((kind, result), (HEDGE, (self.s3_resp, b'hedge')))
+
+    @patch('app.helpers.s3_hedge.fetch_s3_file', return_value=(None, None))
+    def test_all_attempts_failed(self, mock_fetch):
+        self.warm_up(latency=0)
+        with app.test_request_context(f'/{TILE_PATH}'):
+            kind, result = get_hedged_s3_file(
+                TILE_PATH, render=lambda: (500, b'error', {})
+            )
+        self.assertIn(kind, (S3, HEDGE))
+        self.assertEqual(result, (None, None))
+
+    def test_speculative_render_layers(self):
+        with app.test_request_context(f'/{TILE_PATH}'):
+            self.assertIsNone(get_speculative_render('inline_points', None))
+            with patch.object(
+                settings, 'S3_HEDGE_RENDER_LAYERS', ('inline_*',)
+            ):
+                self.assertIsNotNone(
+                    get_speculative_render('inline_points', None)
+                )
+                self.assertIsNone(get_speculative_render('other', None))
+
+
+class HedgedS3ResponseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        s3_hedger.reset()
+        self.addCleanup(s3_hedger.reset)
+        patcher = patch.object(settings, 'S3_HEDGE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tile_cache.clear()
+        self.addCleanup(tile_cache.clear)
+
+    @patch('app.routes.get_hedged_s3_file')
+    def test_hedge_header(self, mock_hedged):
+        s3_resp = MagicMock(status=200)
+        s3_resp.getheaders.return_value = [('Content-Type', 'image/png')]
+        mock_hedged.return_value = (HEDGE, (s3_resp, b'tile'))
+        resp = self.app.get(f'/{TILE_PATH}', query_string={'nodata': 'true'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Tiles-S3-Hedge'], HEDGE)
+        tile_cache.clear()
+
+        mock_hedged.return_value = (
+            RENDER, (200, b'tile', {
+                'Content-Type': 'image/png'
+            })
+        )
+        resp = self.app.get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Tiles-S3-Hedge'], RENDER)
+        self.assertEqual(resp.data, b'tile')
@@ -0,0 +1,123 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from app.helpers.s3_write_queue import BACKPRESSURE
+from app.helpers.s3_write_queue import DROP_OLDEST
+from app.helpers.s3_write_queue import S3WriteQueue
+
+
+class S3WriteQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.uploads = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+        def put_s3_file(content, wmts_path, headers):
+            self.blocked.wait(5)
+            self.uploads.append((wmts_path, content))
+
+        patcher = patch(
+            'app.helpers.s3_write_queue.put_s3_file', side_effect=put_s3_file
+        )
+        self.mock_put_s3_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_write_behind(self):
+        queue = S3WriteQueue(100, 2, DROP_OLDEST, 0.01)
+        self.assertTrue(queue.put(b'tile1', 'path/1', {}))
+        self.assertTrue(queue.put(b'tile2', 'path/2', {}))
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(
+            sorted(self.uploads), [('path/1', b'tile1'), ('path/2', b'tile2')]
+        )
+        stats = queue.stats()
+        self.assertEqual(stats['written'], 2)
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_callbacks(self):
+        done = []
+        queue = S3WriteQueue(6, 1, DROP_OLDEST, 0.01)
+        self.blocked.clear()
+        queue.put(b'tile1', 'path/1', {}, lambda: done.append('tile1'))
+        # wait for the uploader to block on tile1
+        for _ in range(500):
+            if queue.stats()['in_flight']:
+                break
+            threading.Event().wait(0.01)
+        queue.put(b'tile2', 'path/2', {}, lambda: done.append('tile2'))
+        # coalesced, both callbacks are called once written
+        queue.put(b'tile2', 'path/2', {}, lambda: done.append('tile2bis'))
+        # drops the oldest queued tile (tile2)
+        queue.put(b'tile3', 'path/3', {}, lambda: done.append('tile3'))
+        self.assertEqual(done, ['tile2', 'tile2bis'])
+        self.assertTrue(queue.discard('path/3'))
+        self.assertEqual(done, ['tile2', 'tile2bis', 'tile3'])
+        self.blocked.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(done, ['tile2', 'tile2bis', 'tile3', 'tile1'])
+
+    def test_discard(self):
+        self.blocked.clear()
+        queue = S3WriteQueue(100, 1, DROP_OLDEST, 0.01)
+        # the first tile is taken by the single uploader that is blocked
+        queue.put(b'tile0', 'path/0', {})
+        self.assertFalse(queue.flush(0.05))
+        queue.put(b'tile1', 'path/1', {})
+        queue.put(b'tile2', 'path/2', {})
+        self.assertTrue(queue.discard('path/1'))
+        self.assertFalse(queue.discard('path/1'))
+        self.assertEqual(queue.stats()['size'], 5)
+        self.blocked.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(
+            self.uploads, [('path/0', b'tile0'), ('path/2', b'tile2')]
+        )
+
+    def test_synchronous_without_workers(self):
+        queue = S3WriteQueue(100, 0, DROP_OLDEST, 0.01)
+        self.assertTrue(queue.put(b'tile1', 'path/1', {}))
+        self.assertEqual(self.uploads, [('path/1', b'tile1')])
+
+    def test_coalesce_and_drop_oldest(self):
+        self.blocked.clear()
+        queue = S3WriteQueue(10, 1, DROP_OLDEST, 0.01)
+        # the first tile is taken by the single uploader that is blocked
+        queue.put(b'aaaa', 'path/0', {})
+        self.assertFalse(queue.flush(0.05))
+        queue.put(b'aaaa', 'path/1', {})
+        queue.put(b'bbbb', 'path/1', {})
+        queue.put(b'cccc', 'path/2', {})
+        self.assertEqual(queue.stats()['coalesced'], 1)
+        self.assertEqual(queue.stats()['size'], 8)
+        # no room for a third tile, the oldest one is dropped
+        self.assertTrue(queue.put(b'dddd', 'path/3', {}))
+        self.assertEqual(queue.stats()['dropped'], 1)
+        # too big tiles are never queued
+        self.assertFalse(queue.put(b'e' * 11, 'path/4', {}))
+        self.blocked.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(
+            self.uploads, [('path/0', b'aaaa'), ('path/2', b'cccc'),
+                           ('path/3', b'dddd')]
+        )
+
+    def test_backpressure(self):
+        self.blocked.clear()
+        queue = S3WriteQueue(8, 1, BACKPRESSURE, 0.01)
+        queue.put(b'aaaa', 'path/0', {})
+        self.assertFalse(queue.flush(0.05))
+        queue.put(b'bbbb', 'path/1', {})
+        queue.put(b'cccc', 'path/2', {})
+        # the queue is full and the uploader doesn't free any space
+        self.assertFalse(queue.put(b'dddd', 'path/3', {}))
+        self.assertEqual(queue.stats()['dropped'], 1)
+        self.blocked.set()
+        # with the uploader running the producer waits for free space
+        queue.backpressure_timeout = 5
+        self.assertTrue(queue.put(b'dddd', 'path/3', {}))
+        self.assertTrue(queue.flush(5))
+        self.assertEqual([path for path, _ in self.uploads],
+                         ['path/0', 'path/1', 'path/2', 'path/3'])
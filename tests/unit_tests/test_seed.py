@@ -0,0 +1,156 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from flask import g
+
+from app import app
+from app.helpers.grids import get_tile_grid
+from app.helpers.render_scheduler import BACKGROUND
+from app.helpers.seed import RENDERED
+from app.helpers.seed import Checkpoint
+from app.helpers.seed import RateLimiter
+from app.helpers.seed import get_seed_tiles
+from app.helpers.seed import get_seed_zooms
+from app.helpers.seed import hilbert_index
+from app.helpers.seed import init_seed_worker
+from app.helpers.seed import seed_tile
+from app.helpers.seed import sort_tiles
+
+RESTRICTION = {
+    'timestamps': ['current'],
+    'formats': ['png'],
+    'resolution_min': 4000.0,
+    'resolution_max': 10.0,
+    's3_resolution_max': 20.0,
+    'cache_ttl': 1800,
+    'wms_gutter': 0,
+    'wms_metatile': 1,
+}
+
+
+class SeedTests(unittest.TestCase):
+
+    def test_hilbert_order(self):
+        tiles = [(col, row) for col in range(10, 18) for row in range(5, 13)]
+        ordered = sort_tiles(list(reversed(tiles))).tolist()
+        self.assertEqual(sorted(map(tuple, ordered)), sorted(tiles))
+        # each tile is a neighbour of the previous one
+        for (col_1, row_1), (col_2, row_2) in zip(ordered, ordered[1:]):
+            self.assertEqual(abs(col_1 - col_2) + abs(row_1 - row_2), 1)
+        self.assertEqual([
+            hilbert_index(1, col, row)
+            for col, row in [(0, 0), (0, 1), (1, 1), (1, 0)]
+        ], [0, 1, 2, 3])
+
+    def test_seed_zooms(self):
+        grid = get_tile_grid(2056)
+        # 50m (18) to 10m (20) resolution, only 20m and above are on S3
+        self.assertEqual(
+            get_seed_zooms(grid, RESTRICTION, 17, 22), [17, 18, 19]
+        )
+
+    def test_metatile_seed_tiles(self):
+        grid = get_tile_grid(2056)
+        bbox = [2600000, 1200000, 2660000, 1260000]
+        tiles = get_seed_tiles(grid, 20, 1, bbox)
+        metatiles = get_seed_tiles(grid, 20, 4, bbox)
+        self.assertEqual(
+            len(metatiles), len({(col // 4, row // 4) for col, row in tiles})
+        )
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(100, burst=1)
+        with patch('app.helpers.seed.time.sleep') as mock_sleep:
+            limiter.acquire()
+            mock_sleep.assert_not_called()
+            limiter.acquire()
+            limiter.acquire()
+        waits = [call.args[0] for call in mock_sleep.call_args_list]
+        self.assertEqual(len(waits), 2)
+        self.assertAlmostEqual(waits[0], 0.01, delta=0.005)
+        self.assertAlmostEqual(waits[1], 0.02, delta=0.005)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.json')
+            checkpoint = Checkpoint(path, {'layer_id': 'layer'})
+            checkpoint.mark_done(18, 0, {'rendered': 2})
+            checkpoint = Checkpoint(path, {'layer_id': 'layer'})
+            self.assertTrue(checkpoint.is_done(18, 0))
+            self.assertFalse(checkpoint.is_done(18, 1))
+            self.assertEqual(checkpoint.stats['rendered'], 2)
+            # another job doesn't resume the checkpoint
+            checkpoint = Checkpoint(path, {'layer_id': 'other'})
+            self.assertFalse(checkpoint.is_done(18, 0))
+
+    @patch('app.helpers.seed.prepare_wmts_response')
+    def test_seed_tile_background(self, mock_prepare):
+        render_classes = []
+
+        def prepare(mode, etag):
+            render_classes.append(g.get('render_class'))
+            return 200, b'tile', {}, MagicMock()
+
+        mock_prepare.side_effect = prepare
+        init_seed_worker(1, 0, False)
+        self.assertEqual(
+            seed_tile('1.0.0/some.layer/default/current/2056/18/0/0.png'),
+            RENDERED
+        )
+        self.assertEqual(render_classes, [BACKGROUND])
+
+    @patch('app.helpers.seed.s3_file_exists')
+    @patch('app.helpers.seed.flush_s3_write_queue')
+    @patch('app.helpers.seed.prepare_wmts_response')
+    @patch(
+        'app.helpers.seed.get_wmts_config_by_layer', return_value=RESTRICTION
+    )
+    def test_seed_command(
+        self, mock_config, mock_prepare, mock_flush, mock_s3_file_exists
+    ):
+        on_close = MagicMock()
+        mock_prepare.return_value = (200, b'tile', {}, on_close)
+        # the first tile of each chunk is already on S3
+        mock_s3_file_exists.side_effect = lambda path: path.endswith('/0.png')
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_path = os.path.join(directory, 'checkpoint.json')
+            args = [
+                'seed',
+                '--layer',
+                'some.layer',
+                '--min-zoom',
+                '17',
+                '--max-zoom',
+                '18',
+                '--bbox',
+                '2600000',
+                '1200000',
+                '2625600',
+                '1225600',
+                '--concurrency',
+                '2',
+                '--skip-existing',
+                '--checkpoint',
+                checkpoint_path
+            ]
+            result = runner.invoke(args=args)
+            self.assertEqual(result.exit_code, 0, result.output)
+            rendered = on_close.call_count
+            self.assertGreater(rendered, 0)
+            self.assertIn(f'rendered: {rendered}', result.output)
+            with open(checkpoint_path, 'r', encoding='utf-8') as fd:
+                self.assertEqual(set(json.load(fd)['done']), {'17', '18'})
+            mock_flush.assert_called()
+
+            # everything is done, the seeding is resumed without rendering
+            result = runner.invoke(args=args)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(on_close.call_count, rendered)
+
+        result = runner.invoke(args=['seed', '--max-zoom', '18'])
+        self.assertNotEqual(result.exit_code, 0)
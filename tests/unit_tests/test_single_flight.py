@@ -0,0 +1,156 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from flask import request
+
+from app import app
+from app.helpers.single_flight import SingleFlight
+from app.helpers.wmts import get_coalescing_key
+from app.helpers.wmts import prepare_wmts_response
+
+TILE_PATH = '/1.0.0/inline_points/default/current/2056/20/30/40.png'
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def render(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return f'tile {self.calls}'
+
+    def start_leader(self, results, func=None):
+
+        def lead():
+            try:
+                results.append(
+                    self.single_flight.do('key', func or self.render, 5)
+                )
+            except ValueError as error:
+                results.append(error)
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        self.assertTrue(self.started.wait(5))
+        return leader
+
+    def test_coalesce(self):
+        results = []
+        leader = self.start_leader(results)
+        followers = [
+            threading.Thread(
+                target=lambda: results.
+                append(self.single_flight.do('key', self.render, 5))
+            ) for i in range(3)
+        ]
+        for follower in followers:
+            follower.start()
+        while self.single_flight.followers < 3:
+            threading.Event().wait(0.001)
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(
+            sorted(results),
+            [('tile 1', False), ('tile 1', True), ('tile 1', True),
+             ('tile 1', True)]
+        )
+        self.assertEqual(
+            self.single_flight.stats(), {
+                'in_flight': 0, 'leaders': 1, 'followers': 3, 'timeouts': 0
+            }
+        )
+
+    def test_timeout(self):
+        results = []
+        leader = self.start_leader(results)
+        result = self.single_flight.do('key', lambda: 'own tile', 0.01)
+        self.assertEqual(result, ('own tile', False))
+        self.assertEqual(self.single_flight.stats()['timeouts'], 1)
+        self.release.set()
+        leader.join(5)
+        self.assertEqual(results, [('tile 1', False)])
+
+    def test_leader_error(self):
+
+        def failing_render():
+            self.started.set()
+            self.release.wait(5)
+            raise ValueError('render failed')
+
+        results = []
+        leader = self.start_leader(results, failing_render)
+        errors = []
+
+        def follow():
+            try:
+                self.single_flight.do('key', self.render, 5)
+            except ValueError as error:
+                errors.append(error)
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        while self.single_flight.followers < 1:
+            threading.Event().wait(0.001)
+        self.release.set()
+        follower.join(5)
+        leader.join(5)
+        self.assertEqual([str(error) for error in errors], ['render failed'])
+        self.assertIs(results[0], errors[0])
+        self.assertEqual(self.calls, 0)
+        # the next call is a new leader
+        self.assertEqual(
+            self.single_flight.do('key', lambda: 'tile', 5), ('tile', False)
+        )
+
+
+class CoalescingKeyTests(unittest.TestCase):
+
+    def get_key(self, query_string):
+        with app.test_request_context(TILE_PATH, query_string=query_string):
+            return get_coalescing_key('default', TILE_PATH)
+
+    def test_key(self):
+        self.assertEqual(self.get_key({}), self.get_key({'nodata': 'true'}))
+        self.assertNotEqual(self.get_key({}), self.get_key({'gutter': '10'}))
+        self.assertNotEqual(
+            self.get_key({'gutter': '10'}), self.get_key({'gutter': '20'})
+        )
+
+    @patch('app.helpers.wmts.render_wmts_tile')
+    def test_gutters_not_coalesced(self, mock_render):
+        release = threading.Event()
+
+        def render(mode):
+            gutter = request.args['gutter']
+            release.wait(5)
+            return 200, gutter.encode(), {}, None
+
+        mock_render.side_effect = render
+        results = {}
+
+        def get_tile(gutter):
+            with app.test_request_context(
+                TILE_PATH, query_string={'gutter': gutter}
+            ):
+                results[gutter] = prepare_wmts_response('default', None)[1]
+
+        threads = [
+            threading.Thread(target=get_tile, args=(gutter,))
+            for gutter in ('10', '20')
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {'10': b'10', '20': b'20'})
+        self.assertEqual(mock_render.call_count, 2)
@@ -0,0 +1,142 @@
+import multiprocessing
+import unittest
+from unittest.mock import patch
+
+from app.helpers.shared_tile_cache import LOCK_STRIPES
+from app.helpers.shared_tile_cache import SharedTileCache
+from app.helpers.tile_cache import ENTRY_OVERHEAD
+from app.helpers.tile_cache import TileCache
+
+
+class TileCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.entry_size = len('a') + 100 + ENTRY_OVERHEAD
+        self.cache = TileCache(self.entry_size * 3, self.entry_size)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.set('a', b'x' * 100, {'ETag': '"1"'}, 60))
+        self.assertEqual(self.cache.get('a'), (b'x' * 100, {'ETag': '"1"'}))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertEqual(self.cache.size, self.entry_size)
+
+    def test_byte_budget_lru_eviction(self):
+        for key in 'abc':
+            self.cache.set(key, b'x' * 100, {}, 60)
+        # a is now the most recently used
+        self.cache.get('a')
+        self.cache.set('d', b'x' * 100, {}, 60)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('d'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertLessEqual(self.cache.size, self.cache.max_bytes)
+
+    def test_too_big_item(self):
+        self.assertFalse(self.cache.set('a', b'x' * 101, {}, 60))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_ttl(self):
+        with patch('app.helpers.tile_cache.time.monotonic', return_value=100):
+            self.cache.set('a', b'x' * 100, {}, 10)
+        with patch('app.helpers.tile_cache.time.monotonic', return_value=109):
+            self.assertIsNotNone(self.cache.get('a'))
+        with patch('app.helpers.tile_cache.time.monotonic', return_value=110):
+            self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+        self.assertEqual(self.cache.size, 0)
+
+    def test_delete_and_clear(self):
+        self.cache.set('a', b'x' * 100, {}, 60)
+        self.cache.set('b', b'x' * 100, {}, 60)
+        self.assertTrue(self.cache.delete('a'))
+        self.assertFalse(self.cache.delete('a'))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.size, 0)
+
+
+def set_shared_tile(cache, key, content):
+    cache.set(key, content, {'Content-Type': 'image/png'}, 60)
+
+
+def hold_shared_tile_cache_locks(cache, locked, release):
+    for stripe in range(LOCK_STRIPES):
+        cache._acquire(stripe)  # pylint: disable=protected-access
+    locked.set()
+    release.wait(5)
+    # exits without releasing the locks
+
+
+class SharedTileCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedTileCache(8, 1024)
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.set('a', b'x' * 100, {'ETag': '"1"'}, 60))
+        self.assertEqual(self.cache.get('a'), (b'x' * 100, {'ETag': '"1"'}))
+        # overwrite
+        self.assertTrue(self.cache.set('a', b'y' * 10, {'ETag': '"2"'}, 60))
+        self.assertEqual(self.cache.get('a'), (b'y' * 10, {'ETag': '"2"'}))
+        self.assertTrue(self.cache.delete('a'))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_too_big_item(self):
+        self.assertFalse(self.cache.set('a', b'x' * 1024, {}, 60))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_ttl(self):
+        with patch('app.helpers.shared_tile_cache.time.time', return_value=100):
+            self.cache.set('a', b'x', {}, 10)
+        with patch('app.helpers.shared_tile_cache.time.time', return_value=109):
+            self.assertIsNotNone(self.cache.get('a'))
+        with patch('app.helpers.shared_tile_cache.time.time', return_value=110):
+            self.assertIsNone(self.cache.get('a'))
+
+    def test_eviction(self):
+        for i in range(20):
+            self.cache.set(f'tile-{i}', b'x', {}, 60 + i)
+        cached = [i for i in range(20) if self.cache.get(f'tile-{i}')]
+        self.assertLessEqual(len(cached), self.cache.slots)
+        self.assertIn(19, cached)
+        self.assertGreater(self.cache.stats()['evictions'], 0)
+
+    def test_lock_held_by_other_process(self):
+        self.cache.set('a', b'x', {}, 60)
+        context = multiprocessing.get_context('fork')
+        locked = context.Event()
+        release = context.Event()
+        process = context.Process(
+            target=hold_shared_tile_cache_locks,
+            args=(self.cache, locked, release)
+        )
+        process.start()
+        self.assertTrue(locked.wait(5))
+        # given up after the lock timeout
+        self.assertIsNone(self.cache.get('a'))
+        self.assertFalse(self.cache.set('b', b'x', {}, 60))
+        self.assertEqual(self.cache.stats()['lock_timeouts'], 2)
+        # the locks of a dead process are released
+        release.set()
+        process.join(5)
+        self.assertEqual(self.cache.get('a'), (b'x', {}))
+        self.assertTrue(self.cache.set('b', b'x', {}, 60))
+
+    def test_shared_between_processes(self):
+        context = multiprocessing.get_context('fork')
+        process = context.Process(
+            target=set_shared_tile, args=(self.cache, 'a', b'from child')
+        )
+        process.start()
+        process.join()
+        self.assertEqual(
+            self.cache.get('a'), (b'from child', {
+                'Content-Type': 'image/png'
+            })
+        )
@@ -0,0 +1,170 @@
+import io
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app
+from app import settings
+from app.helpers import wmts_config
+from app.helpers.tile_cache import tile_cache
+from app.helpers.variants import get_tile_variant
+from app.helpers.variants import negotiate_variant
+from app.helpers.variants import transcode_tile
+
+RESTRICTION = {
+    'timestamps': ['current'],
+    'formats': ['png'],
+    'resolution_min': 4000.0,
+    'resolution_max': 0.1,
+    's3_resolution_max': 0.1,
+    'cache_ttl': 1800,
+    'wms_gutter': 0,
+    'wms_metatile': 1,
+}
+
+TILE_PATH = '1.0.0/some.layer/default/current/2056/20/45/27'
+
+
+def get_tile(image_format='PNG'):
+    img = Image.new('RGBA', (256, 256), (0, 0, 0, 0))
+    img.paste((255, 0, 0, 255), (10, 10, 100, 100))
+    if image_format == 'JPEG':
+        img = img.convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format=image_format)
+    return img, out.getvalue()
+
+
+class TranscodeTests(unittest.TestCase):
+
+    def test_png_to_webp(self):
+        img, content = get_tile()
+        webp = transcode_tile(content, 'webp')
+        with Image.open(io.BytesIO(webp)) as tile:
+            self.assertEqual(tile.format, 'WEBP')
+            # lossless
+            self.assertEqual(tile.convert('RGBA').tobytes(), img.tobytes())
+        self.assertLess(len(webp), len(content))
+
+    def test_jpeg_to_webp(self):
+        _, content = get_tile('JPEG')
+        with Image.open(io.BytesIO(transcode_tile(content, 'webp'))) as tile:
+            self.assertEqual(tile.format, 'WEBP')
+            self.assertEqual(tile.size, (256, 256))
+
+    def test_png_to_avif(self):
+        _, content = get_tile()
+        with Image.open(io.BytesIO(transcode_tile(content, 'avif'))) as tile:
+            self.assertEqual(tile.format, 'AVIF')
+
+
+class NegotiationTests(unittest.TestCase):
+
+    def get_variant(self, path, accept):
+        with app.test_request_context(path, headers={'Accept': accept}):
+            return get_tile_variant()
+
+    def test_explicit_variant(self):
+        self.assertEqual(self.get_variant(f'/{TILE_PATH}.webp', ''), 'webp')
+        with patch.object(settings, 'TILE_VARIANT_FORMATS', ()):
+            self.assertIsNone(self.get_variant(f'/{TILE_PATH}.webp', ''))
+
+    @patch.object(settings, 'TILE_FORMAT_NEGOTIATION', True)
+    def test_negotiation(self):
+        browser = 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+        self.assertEqual(self.get_variant(f'/{TILE_PATH}.png', browser), 'webp')
+        self.assertIsNone(self.get_variant(f'/{TILE_PATH}.png', '*/*'))
+        self.assertIsNone(self.get_variant(f'/{TILE_PATH}.png', 'image/*'))
+        self.assertIsNone(
+            self.get_variant(f'/{TILE_PATH}.png', 'image/webp;q=0')
+        )
+        with patch.object(settings, 'TILE_VARIANT_FORMATS', ('avif', 'webp')):
+            self.assertEqual(
+                self.get_variant(f'/{TILE_PATH}.jpeg', browser), 'avif'
+            )
+
+    def test_negotiation_disabled(self):
+        with app.test_request_context(
+            f'/{TILE_PATH}.png', headers={'Accept': 'image/webp'}
+        ):
+            self.assertIsNone(negotiate_variant() and get_tile_variant())
+
+
+class VariantResponseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        tile_cache.clear()
+        self.addCleanup(tile_cache.clear)
+        self.img, self.content = get_tile()
+        patcher = patch.dict(
+            wmts_config.RESTRICTIONS, {'some.layer': RESTRICTION}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def get_s3_file(wmts_path, etag=None, stream=False):
+            if wmts_path.endswith('.png'):
+                s3_resp = MagicMock(status=200)
+                s3_resp.getheaders.return_value = [
+                    ('Content-Type', 'image/png'), ('ETag', '"png"')
+                ]
+                return s3_resp, self.content
+            return None, None
+
+        for target in (
+            'app.routes.get_s3_file', 'app.helpers.variants.get_s3_file'
+        ):
+            patcher = patch(target, side_effect=get_s3_file)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('app.helpers.variants.queue_s3_file')
+    def test_variant_transcoded_from_master(self, mock_queue):
+        resp = self.app.get(f'/{TILE_PATH}.webp')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/webp')
+        self.assertEqual(resp.headers['X-Tiles-Variant'], 'transcoded from png')
+        self.assertNotIn('Vary', resp.headers)
+        with Image.open(io.BytesIO(resp.data)) as tile:
+            self.assertEqual(tile.convert('RGBA').tobytes(), self.img.tobytes())
+        mock_queue.assert_called_once()
+        self.assertEqual(mock_queue.call_args[0][1], f'{TILE_PATH}.webp')
+
+        # then served from the memory cache
+        etag = resp.headers['ETag']
+        resp = self.app.get(f'/{TILE_PATH}.webp')
+        self.assertEqual(resp.headers['X-Tiles-Memory-Cache'], 'hit')
+        self.assertEqual(resp.headers['ETag'], etag)
+        resp = self.app.get(
+            f'/{TILE_PATH}.webp', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get(
+            f'/{TILE_PATH}.webp', headers={'If-None-Match': f'W/{etag}, "1"'}
+        )
+        self.assertEqual(resp.status_code, 304)
+        mock_queue.assert_called_once()
+
+    @patch.object(settings, 'TILE_FORMAT_NEGOTIATION', True)
+    @patch('app.helpers.variants.queue_s3_file')
+    def test_negotiated_variant(self, mock_queue):
+        resp = self.app.get(
+            f'/{TILE_PATH}.png', headers={'Accept': 'image/webp,*/*'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/webp')
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        self.assertEqual(mock_queue.call_args[0][1], f'{TILE_PATH}.webp')
+
+        resp = self.app.get(f'/{TILE_PATH}.png', headers={'Accept': '*/*'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        self.assertEqual(resp.data, self.content)
+
+    def test_unsupported_layer(self):
+        resp = self.app.get(f'/{TILE_PATH.replace("some", "other")}.webp')
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,115 @@
+import unittest
+from unittest.mock import patch
+
+import requests_mock
+
+from app import app
+from app.helpers.wms import WmsBackendPool
+from app.helpers.wms import get_wms_tile
+from app.helpers.wms import parse_backend_affinity
+
+WMS_1 = 'http://wms-1/mapserv'
+WMS_2 = 'http://wms-2/mapserv'
+WMS_HEAVY = 'http://wms-heavy/mapserv'
+
+TILE_PATH = '1.0.0/{layer}/default/current/2056/20/45/27.png'
+
+
+class ParseBackendAffinityTests(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_backend_affinity(''), [])
+        self.assertEqual(
+            parse_backend_affinity(
+                '{"ch.swisstopo.swissimage*": ["%s"]}' % WMS_HEAVY
+            ), [('ch.swisstopo.swissimage*', [WMS_HEAVY])]
+        )
+
+    def test_invalid(self):
+        for value in ('[]', '{"layer": []}', '{"layer": "url"}', '{'):
+            with self.assertRaises(ValueError):
+                parse_backend_affinity(value)
+
+
+class WmsBackendPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WmsBackendPool((WMS_1, WMS_2),
+                                   [('ch.swisstopo.swissimage*', [WMS_HEAVY])])
+
+    def test_affinity(self):
+        self.assertIs(
+            self.pool.select('ch.swisstopo.swissimage-product'),
+            self.pool.backends[WMS_HEAVY]
+        )
+        self.assertIn(
+            self.pool.select('ch.swisstopo.pixelkarte-farbe').url,
+            (WMS_1, WMS_2)
+        )
+        self.assertEqual(len(self.pool.stats()), 3)
+
+    def test_least_outstanding(self):
+        self.pool.backends[WMS_1].start()
+        for _ in range(10):
+            self.assertEqual(self.pool.select('layer').url, WMS_2)
+        self.pool.backends[WMS_2].start()
+        self.pool.backends[WMS_2].start()
+        self.assertEqual(self.pool.select('layer').url, WMS_1)
+
+    def test_passive_ejection(self):
+        backend = self.pool.backends[WMS_1]
+        for _ in range(3):
+            backend.start()
+            backend.done(0.1, False)
+        self.assertTrue(self.pool.stats()[WMS_1]['ejected'])
+        self.assertEqual(self.pool.stats()[WMS_1]['ejections'], 1)
+        self.pool.backends[WMS_2].start()
+        for _ in range(10):
+            self.assertEqual(self.pool.select('layer').url, WMS_2)
+
+        # all backends ejected, they are used anyway
+        for _ in range(3):
+            self.pool.backends[WMS_2].start()
+            self.pool.backends[WMS_2].done(0.1, False)
+        self.assertEqual(self.pool.select('layer').url, WMS_1)
+
+        with patch('time.monotonic', return_value=float('inf')):
+            self.assertFalse(self.pool.stats()[WMS_1]['ejected'])
+
+    def test_success_resets_failures(self):
+        backend = self.pool.backends[WMS_1]
+        for success in (False, False, True, False, False):
+            backend.start()
+            backend.done(0.1, success)
+        self.assertFalse(self.pool.stats()[WMS_1]['ejected'])
+        self.assertEqual(self.pool.stats()[WMS_1]['failures'], 4)
+
+
+class WmsBackendRequestTests(unittest.TestCase):
+
+    @requests_mock.Mocker()
+    def test_request_sent_to_selected_backend(self, mocker):
+        pool = WmsBackendPool((WMS_1, WMS_2),
+                              [('ch.swisstopo.swissimage*', [WMS_HEAVY])])
+        for url in (WMS_1, WMS_2, WMS_HEAVY):
+            mocker.get(
+                url,
+                content=url.encode(),
+                headers={'Content-Type': 'image/png'}
+            )
+        pool.backends[WMS_1].start()
+        with patch('app.helpers.wms.wms_backend_pool', pool):
+            for layer, url in (
+                ('some.layer', WMS_2),
+                ('ch.swisstopo.swissimage-product', WMS_HEAVY)
+            ):
+                with app.test_request_context(
+                    f'/{TILE_PATH.format(layer=layer)}'
+                ):
+                    response = get_wms_tile([0, 0, 1, 1], 0)
+                self.assertEqual(response.content, url.encode())
+        stats = pool.stats()
+        self.assertEqual(stats[WMS_2]['requests'], 1)
+        self.assertEqual(stats[WMS_2]['outstanding'], 0)
+        self.assertEqual(stats[WMS_HEAVY]['requests'], 1)
+        self.assertIsNone(stats[WMS_HEAVY]['guard'])
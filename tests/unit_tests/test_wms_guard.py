@@ -0,0 +1,183 @@
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import requests.exceptions
+from werkzeug.exceptions import HTTPException
+
+from app import app
+from app import settings
+from app.helpers import wmts_config
+from app.helpers.wms import get_wms_tile
+from app.helpers.wms_guard import AdaptiveLimiter
+from app.helpers.wms_guard import CircuitBreaker
+from app.helpers.wms_guard import backend_guards
+from app.helpers.wms_guard import wms_error_cache
+
+RESTRICTION = {
+    'timestamps': ['current'],
+    'formats': ['png'],
+    'resolution_min': 4000.0,
+    'resolution_max': 0.1,
+    's3_resolution_max': 0.1,
+    'cache_ttl': 1800,
+    'wms_gutter': 0,
+    'wms_metatile': 1,
+}
+
+TILE_PATH = '1.0.0/some.layer/default/current/2056/20/45/27.png'
+
+
+class AdaptiveLimiterTests(unittest.TestCase):
+
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter(2, 1, 3, 1)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        for _ in range(2):
+            limiter.release(0.1, True)
+        # 2 + 1/2 + 1/2.5
+        self.assertAlmostEqual(limiter.limit, 2.9)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1, True)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter(10, 2, 20, 1)
+        limiter.acquire()
+        limiter.release(2, True)
+        self.assertEqual(limiter.limit, 9)
+        limiter.acquire()
+        limiter.release(0.1, False)
+        self.assertEqual(limiter.limit, 4.5)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.1, False)
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.stats()['in_flight'], 0)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def test_open_and_half_open(self):
+        breaker = CircuitBreaker(2, 10)
+        for _ in range(2):
+            self.assertTrue(breaker.acquire())
+            breaker.release(False)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.acquire())
+
+        with patch('time.monotonic', return_value=float('inf')):
+            # a single probe once the reset timeout elapsed
+            self.assertTrue(breaker.acquire())
+            self.assertFalse(breaker.acquire())
+            self.assertEqual(breaker.state, 'half-open')
+            breaker.release(False)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.acquire())
+
+        with patch('time.monotonic', return_value=float('inf')):
+            self.assertTrue(breaker.acquire())
+            breaker.release(True)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.acquire())
+        self.assertEqual(
+            breaker.stats(),
+            {
+                'state': 'closed',
+                'consecutive_failures': 0,
+                'opened': 2,
+                'rejected': 3,
+            }
+        )
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(2, 10)
+        breaker.release(False)
+        breaker.release(True)
+        breaker.release(False)
+        self.assertEqual(breaker.state, 'closed')
+
+
+@patch.object(settings, 'WMS_BACKEND_GUARD', True)
+@patch.object(settings, 'WMS_BREAKER_FAILURES', 2)
+class WmsBackendGuardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        backend_guards.clear()
+        self.addCleanup(backend_guards.clear)
+        for patcher in (
+            patch.dict(wmts_config.RESTRICTIONS, {'some.layer': RESTRICTION}),
+            patch('app.routes.get_s3_file', return_value=(None, None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('app.helpers.wms.get_wms_image')
+    def test_fail_fast_when_open(self, mock_wms_image):
+        mock_wms_image.side_effect = requests.exceptions.ConnectionError
+        for _ in range(2):
+            resp = self.app.get(f'/{TILE_PATH}')
+            self.assertEqual(resp.status_code, 502)
+            self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+        resp = self.app.get(f'/{TILE_PATH}')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(
+            resp.headers['Cache-Control'], settings.ERROR_5XX_DEFAULT_CACHE
+        )
+        self.assertEqual(mock_wms_image.call_count, 2)
+        self.assertEqual(
+            backend_guards[settings.WMS_BACKEND].stats()['breaker']['state'],
+            'open'
+        )
+
+    @patch.object(settings, 'WMS_LIMIT_INITIAL', 1)
+    @patch('app.helpers.wms.get_wms_image')
+    def test_concurrency_limit(self, mock_wms_image):
+
+        def get_wms_image(*_):
+            # a concurrent request while this one is in flight
+            with app.test_request_context(f'/{TILE_PATH}'):
+                with self.assertRaises(HTTPException) as context:
+                    get_wms_tile([0, 0, 1, 1], 0)
+            self.assertEqual(context.exception.code, 503)
+            return MagicMock(
+                status_code=200,
+                headers={'Content-Type': 'image/png'},
+                content=b'png'
+            )
+
+        mock_wms_image.side_effect = get_wms_image
+        with app.test_request_context(f'/{TILE_PATH}'):
+            self.assertEqual(get_wms_tile([0, 0, 1, 1], 0).content, b'png')
+        stats = backend_guards[settings.WMS_BACKEND].stats()
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+
+@patch.object(settings, 'WMS_ERROR_CACHE_TTL', 60)
+class WmsErrorCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        wms_error_cache.clear()
+        self.addCleanup(wms_error_cache.clear)
+
+    @patch('app.helpers.wms.get_wms_image')
+    def test_cached_error(self, mock_wms_image):
+        mock_wms_image.return_value = MagicMock(
+            status_code=200,
+            headers={'Content-Type': 'text/xml'},
+            content=b'<?xml version="1.0"?>'
+        )
+        for bbox in ([0, 0, 1, 1], [0, 0, 1, 1], [1, 1, 2, 2]):
+            with app.test_request_context(f'/{TILE_PATH}'):
+                with self.assertRaises(HTTPException) as context:
+                    get_wms_tile(bbox, 0)
+            self.assertEqual(context.exception.code, 501)
+            self.assertIn('Unable to process', context.exception.description)
+        self.assertEqual(mock_wms_image.call_count, 2)
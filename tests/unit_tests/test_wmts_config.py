@@ -0,0 +1,128 @@
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from app import app
+from app import settings
+from app.helpers import wmts_config
+from app.helpers.wmts_config import WMTS_CONFIG_INFO
+from app.helpers.wmts_config import diff_wmts_config
+from app.helpers.wmts_config import get_wmts_config_by_layer
+from app.helpers.wmts_config import get_wmts_config_from_db
+from app.helpers.wmts_config import refresh_wmts_config
+from app.helpers.wmts_config import set_wmts_config
+
+RESTRICTION = {
+    'timestamps': ['current'],
+    'formats': ['png'],
+    'resolution_min': 4000.0,
+    'resolution_max': 1.0,
+    's3_resolution_max': 1.0,
+    'cache_ttl': 1800,
+    'wms_gutter': 0,
+    'wms_metatile': 1,
+}
+
+
+class StopListening(Exception):
+    pass
+
+
+class WmtsConfigTests(unittest.TestCase):
+
+    def setUp(self):
+        restrictions = wmts_config.RESTRICTIONS
+        info = dict(WMTS_CONFIG_INFO)
+
+        def restore():
+            wmts_config.RESTRICTIONS = restrictions
+            WMTS_CONFIG_INFO.update(info)
+
+        self.addCleanup(restore)
+        set_wmts_config({'layer.a': RESTRICTION, 'layer.b': RESTRICTION})
+
+    def test_diff(self):
+        self.assertEqual(
+            diff_wmts_config({
+                'a': 1, 'b': 2, 'c': 3
+            }, {
+                'b': 2, 'c': 4, 'd': 5
+            }), {
+                'added': ['d'], 'removed': ['a'], 'changed': ['c']
+            }
+        )
+
+    @patch('app.helpers.wmts_config.get_wmts_config_from_db')
+    def test_refresh(self, mock_get_config):
+        version = WMTS_CONFIG_INFO['version']
+        refreshes = WMTS_CONFIG_INFO['refreshes']
+        updates = WMTS_CONFIG_INFO['updates']
+        mock_get_config.return_value = {
+            'layer.a': RESTRICTION, 'layer.b': RESTRICTION
+        }
+        self.assertIsNone(refresh_wmts_config())
+        self.assertEqual(WMTS_CONFIG_INFO['version'], version)
+        self.assertEqual(WMTS_CONFIG_INFO['refreshes'], refreshes + 1)
+
+        mock_get_config.return_value = {
+            'layer.a': dict(RESTRICTION, timestamps=['current', '20250101']),
+            'layer.c': RESTRICTION
+        }
+        self.assertEqual(
+            refresh_wmts_config(),
+            {
+                'added': ['layer.c'],
+                'removed': ['layer.b'],
+                'changed': ['layer.a']
+            }
+        )
+        self.assertNotEqual(WMTS_CONFIG_INFO['version'], version)
+        self.assertEqual(WMTS_CONFIG_INFO['updates'], updates + 1)
+        self.assertEqual(
+            WMTS_CONFIG_INFO['last_update'], {
+                'added': 1, 'removed': 1, 'changed': 1
+            }
+        )
+        self.assertEqual(
+            get_wmts_config_by_layer('layer.a')['timestamps'],
+            ['current', '20250101']
+        )
+        self.assertIsNone(get_wmts_config_by_layer('layer.b'))
+
+        response = app.test_client().get('/info.json')
+        self.assertEqual(
+            response.json['wmts_config']['version'],
+            WMTS_CONFIG_INFO['version']
+        )
+
+    @patch('app.helpers.wmts_config.connect_to_db')
+    def test_connection_closed(self, mock_connect):
+        column = MagicMock()
+        column.name = 'fk_dataset_id'
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.description = [column]
+        cursor.__iter__.return_value = iter([])
+        self.assertEqual(get_wmts_config_from_db(), {})
+        mock_connect.return_value.close.assert_called_once()
+
+    @patch('app.helpers.wmts_config.refresh_wmts_config')
+    @patch('app.helpers.wmts_config.connect_to_db')
+    def test_listen(self, mock_connect, mock_refresh):
+        connection = mock_connect.return_value
+        # a notification, the coalesced notifications, a timeout and a
+        # connection error
+        connection.notifies.side_effect = [
+            iter([MagicMock()]),
+            iter([MagicMock(), MagicMock()]),
+            iter([]),
+            StopListening(),
+        ]
+        with patch.object(settings, 'WMTS_CONFIG_NOTIFY_CHANNEL', 'tilesets'):
+            with self.assertRaises(StopListening):
+                # pylint: disable=protected-access
+                wmts_config._listen_and_refresh()
+        query = connection.execute.call_args.args[0]
+        self.assertEqual(query.as_string(None), 'LISTEN "tilesets"')
+        # on start, after the notification and after the timeout
+        self.assertEqual(mock_refresh.call_count, 3)
+        connection.close.assert_called_once()
@@ -27,15 +27,21 @@ initialize()
 from gunicorn.app.base import BaseApplication
 
 from app.app import app as application
+from app.app import db
 from app.helpers.logging_utils import get_logging_cfg
+from app.helpers.s3_write_queue import flush_s3_write_queue
+from app.helpers.shared_tile_cache import init_shared_tile_cache
 from app.helpers.wmts_config import init_wmts_config
+from app.helpers.wmts_config import start_wmts_config_refresher
 from app.settings import FORWARDED_PROTO_HEADER_NAME
 from app.settings import FORWARED_ALLOW_IPS
+from app.settings import GET_CAP_CACHE_PRERENDER
 from app.settings import GUNICORN_KEEPALIVE
 from app.settings import GUNICORN_WORKER_TMP_DIR
 from app.settings import WMTS_PORT
 from app.settings import WMTS_WORKERS
 from app.settings import WSGI_TIMEOUT
+from app.views import GetCapabilities
 
 initialize_flask(application)
 
@@ -46,6 +52,15 @@ def post_fork(server, worker):
     # Setup OTEL providers for this worker
     setup_trace_provider()
 
+    # Each worker reloads its copy of the tileset restrictions
+    start_wmts_config_refresher()
+
+
+def worker_exit(server, worker):
+    # Write the tiles still in the S3 write-behind queue before exiting
+    server.log.info("Worker exiting (pid: %s)", worker.pid)
+    flush_s3_write_queue()
+
 
 class StandaloneApplication(BaseApplication):
     # pylint: disable=abstract-method
@@ -74,6 +89,20 @@ def on_starting(server):
     # the logging has been configured. If we do it in the app.__init__.py module
     # the we don't have the logging yet configured and we don't get any logs
     init_wmts_config()
+    # The shared tile cache must be created before forking the workers
+    init_shared_tile_cache()
+    # The GetCapabilities documents are rendered once and inherited by the
+    # workers
+    if GET_CAP_CACHE_PRERENDER:
+        with application.app_context():
+            try:
+                GetCapabilities.prerender_cache()
+            except Exception as error:  # pylint: disable=broad-except
+                server.log.error(
+                    "Failed to pre-render the capabilities: %s", error
+                )
+            # don't share the DB connections with the workers
+            db.engine.dispose()
 
 
 # We use the port 9000 as default, otherwise we set the HTTP_PORT env variable
@@ -87,6 +116,7 @@ if __name__ == '__main__':
         'worker_tmp_dir': GUNICORN_WORKER_TMP_DIR,
         'timeout': WSGI_TIMEOUT,
         'post_fork': post_fork,
+        'worker_exit': worker_exit,
         'keepalive': GUNICORN_KEEPALIVE,
         'access_log_format':
             '%(h)s %(l)s %(u)s "%(r)s" %(s)s %(B)s Bytes '